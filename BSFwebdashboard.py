@@ -1,34 +1,106 @@
-from flask import Flask, render_template, request, redirect, url_for, jsonify, session, flash, send_file
+from flask import Flask, Response, render_template, request, redirect, url_for, jsonify, session, flash
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required
+from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.utils import safe_join
 from datetime import datetime, timedelta
-from collections import defaultdict
 import os
+import atexit
 import threading # For running MQTT in a separate thread
 import base64
-from PIL import Image
 from io import BytesIO
 from random import uniform, randint
 
 # MQTT specific imports
 import paho.mqtt.client as mqtt
+from sqlalchemy import select
 import json
 import time # Although not heavily used, keep it if needed for future sleep operations
+from ingest import BatchWriter
+from queries import tray_numbers, tray_version
+from rollups import apply_readings, data_version, define_rollup_tables, ensure_rollups
+from migrations import run_migrations
+from queryplan import check_query_plans
+from storage import DATABASE_URL, configure_engine, engine_options
+from dal import DataAccess, WriterBusy
+from events import EventHub, parse_tray_filter
+from cache import ResponseCache
+from cache_backends import create_backend
+from derivatives import VARIANTS, DerivativePipeline
+from imagestore import DEFAULT_IMAGE_DIR, ImageStore, store_attachment
+from imageserve import DEFAULT_ACCEL_PREFIX, serve_file
+from changefeed import ReadingFeed
+from consumer import ShardedConsumer
+from leader import DEFAULT_LOCK_PATH, LeaderElection, LeaderLock
+from snapshot import TraySnapshot
+from topics import DeviceHeartbeats, TopicRouter, decode_routed, parse_topic
+from uploads import (DEFAULT_MAX_UPLOAD_BYTES, RAW_IMAGE_MIMETYPES, UploadTooLarge, discard, spool_multipart,
+                     spool_to_disk, store_image, upload_metadata)
+from trayviews import NoData, TrayViews, parse_combined_args, parse_comparison_args, parse_tray_args
 
 # --- Flask App Configuration ---
 app = Flask(__name__, static_folder='static')
 app.secret_key = os.urandom(24)
-# Ensure this path matches the database path both parts will write to
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///larvae_monitoring.db'
+# Shared with mqtt_subscriber.py; WAL and the other SQLite settings come from storage.py
+app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options()
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-
-# Path to store images
-IMAGE_STORAGE_DIR = 'static/images'
-if not os.path.exists(IMAGE_STORAGE_DIR):
-    os.makedirs(IMAGE_STORAGE_DIR)
+# MQTT readings are buffered and written in batches (see ingest.py)
+app.config['INGEST_BATCH_SIZE'] = int(os.environ.get('INGEST_BATCH_SIZE', 500))
+app.config['INGEST_FLUSH_INTERVAL'] = float(os.environ.get('INGEST_FLUSH_INTERVAL', 0.2))
+app.config['INGEST_QUEUE_MAXSIZE'] = int(os.environ.get('INGEST_QUEUE_MAXSIZE', 10000))
+# embedded: the web process consumes MQTT if it wins the ingest lock (one process across all
+# gunicorn workers); external: only mqtt_subscriber.py consumes (see leader.py)
+app.config['INGEST_MODE'] = os.environ.get('INGEST_MODE', 'embedded')
+app.config['INGEST_LOCK_PATH'] = os.environ.get('INGEST_LOCK_PATH', DEFAULT_LOCK_PATH)
+app.config['INGEST_LEADER_RETRY'] = float(os.environ.get('INGEST_LEADER_RETRY', 10))
+# MQTT messages are decoded on worker threads, one shard per tray hash (see consumer.py)
+app.config['MQTT_CONSUMER_SHARDS'] = int(os.environ.get('MQTT_CONSUMER_SHARDS', 4))
+app.config['MQTT_CONSUMER_QUEUE_MAXSIZE'] = int(os.environ.get('MQTT_CONSUMER_QUEUE_MAXSIZE', 1000))
+# Image messages get their own, smaller pool so they never delay metric readings (see topics.py)
+app.config['MQTT_IMAGE_WORKERS'] = int(os.environ.get('MQTT_IMAGE_WORKERS', 2))
+app.config['MQTT_IMAGE_QUEUE_MAXSIZE'] = int(os.environ.get('MQTT_IMAGE_QUEUE_MAXSIZE', 50))
+# Largest accepted /api/upload body; uploads are streamed to disk, never held in memory (see uploads.py)
+app.config['UPLOAD_MAX_BYTES'] = int(os.environ.get('UPLOAD_MAX_BYTES', DEFAULT_MAX_UPLOAD_BYTES))
+# Gallery thumbnails are rendered on this many processes (0: only on first request) as jpeg or webp
+app.config['DERIVATIVE_WORKERS'] = int(os.environ.get('DERIVATIVE_WORKERS', 2))
+app.config['DERIVATIVE_FORMAT'] = os.environ.get('DERIVATIVE_FORMAT', 'jpeg')
+# '' serves pictures from Python; 'x-accel' (nginx) or 'x-sendfile' (Apache, lighttpd) lets the
+# front proxy send the bytes, with IMAGE_ACCEL_PREFIX as nginx's internal location (see imageserve.py)
+app.config['IMAGE_SENDFILE'] = os.environ.get('IMAGE_SENDFILE', '')
+app.config['IMAGE_ACCEL_PREFIX'] = os.environ.get('IMAGE_ACCEL_PREFIX', DEFAULT_ACCEL_PREFIX)
+# Seconds between polls for readings stored by other processes (see changefeed.py)
+app.config['READING_FEED_INTERVAL'] = float(os.environ.get('READING_FEED_INTERVAL', 0.5))
+# Writes run on one writer thread; GET endpoints read through a read-only pool (see dal.py)
+app.config['DB_READ_POOL_SIZE'] = int(os.environ.get('DB_READ_POOL_SIZE', 4))
+app.config['DB_READ_POOL_TIMEOUT'] = float(os.environ.get('DB_READ_POOL_TIMEOUT', 10))
+app.config['DB_WRITE_QUEUE_MAXSIZE'] = int(os.environ.get('DB_WRITE_QUEUE_MAXSIZE', 1000))
+app.config['DB_WRITE_TIMEOUT'] = float(os.environ.get('DB_WRITE_TIMEOUT', 30))
+# Live updates pushed to the dashboard over Server-Sent Events (see events.py)
+app.config['SSE_CLIENT_QUEUE_SIZE'] = int(os.environ.get('SSE_CLIENT_QUEUE_SIZE', 256))
+app.config['SSE_HEARTBEAT_INTERVAL'] = float(os.environ.get('SSE_HEARTBEAT_INTERVAL', 15))
+# Serialized JSON responses, reused until the data they show changes (see cache.py)
+# memory (per process), sqlite (a file shared by the workers on this host) or redis (see cache_backends.py)
+app.config['CACHE_BACKEND'] = os.environ.get('CACHE_BACKEND', 'memory')
+app.config['CACHE_URL'] = os.environ.get('CACHE_URL')
+app.config['RESPONSE_CACHE_MAX_BYTES'] = int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+app.config['RESPONSE_CACHE_COMPRESS_LEVEL'] = int(os.environ.get('RESPONSE_CACHE_COMPRESS_LEVEL', 6))
+
+# Path to store images (absolute, next to this file unless IMAGE_STORAGE_DIR is set; see imagestore.py)
+IMAGE_STORAGE_DIR = DEFAULT_IMAGE_DIR
+# Pictures are stored once per distinct content, named by hash (see imagestore.py);
+# image_files.file_path holds the key relative to IMAGE_STORAGE_DIR
+image_store = ImageStore(IMAGE_STORAGE_DIR)
+
+# Thumbnail and medium copies of every picture for the gallery (see derivatives.py)
+image_variants = DerivativePipeline(IMAGE_STORAGE_DIR, workers=app.config['DERIVATIVE_WORKERS'],
+                                    image_format=app.config['DERIVATIVE_FORMAT'])
+atexit.register(image_variants.stop)
 
 db = SQLAlchemy(app)
+with app.app_context():
+    configure_engine(db.engine)
 login_manager = LoginManager(app)
 login_manager.login_view = 'login'
 
@@ -47,6 +119,7 @@ class User(UserMixin, db.Model):
 
 class ImageFile(db.Model):
     __tablename__ = "image_files"
+    __table_args__ = (db.Index("ix_image_files_tray_timestamp", "tray_number", "timestamp"),)
     id = db.Column(db.Integer, primary_key=True)
     tray_number = db.Column(db.Integer, nullable=False)
     file_path = db.Column(db.String(255), nullable=False)
@@ -57,10 +130,14 @@ class ImageFile(db.Model):
     # New fields to store classification data
     bounding_boxes = db.Column(db.String, nullable=True) # Stored as JSON string
     masks = db.Column(db.String, nullable=True) # Stored as JSON string
+    # Picture size in pixels, to scale annotations onto the smaller variants
+    width = db.Column(db.Integer, nullable=True)
+    height = db.Column(db.Integer, nullable=True)
 
 class LarvaeData(db.Model):
     # Explicitly set table name for consistency, matching the original mqtt_subscriber.py's table name
     __tablename__ = "larvae_data"
+    __table_args__ = (db.Index("ix_larvae_data_tray_timestamp", "tray_number", "timestamp"),)
     id = db.Column(db.Integer, primary_key=True)
     tray_number = db.Column(db.Integer, nullable=False)
     length = db.Column(db.Float, nullable=False)
@@ -73,30 +150,78 @@ class LarvaeData(db.Model):
     def __repr__(self):
         return f"<LarvaeData Tray {self.tray_number} - {self.timestamp}>"
 
+# Per-tray minute/hour/day rollups of larvae_data, maintained at ingest time (see rollups.py)
+ROLLUPS = define_rollup_tables(db.metadata)
+
+# Latest reading per tray, kept in memory for the metric cards (see snapshot.py)
+tray_snapshot = TraySnapshot()
+
+# Bodies of the tray data endpoints, full and delta (see trayviews.py)
+tray_views = TrayViews(ROLLUPS, LarvaeData.__table__, tray_snapshot)
+
+# Newly stored readings, pushed to /stream/trays clients
+event_hub = EventHub(
+    client_queue_size=app.config['SSE_CLIENT_QUEUE_SIZE'],
+    heartbeat_interval=app.config['SSE_HEARTBEAT_INTERVAL'],
+)
+
+# The only read-write connection lives on its writer thread; reads use a read-only pool
+data_access = DataAccess(
+    read_pool_size=app.config['DB_READ_POOL_SIZE'],
+    read_pool_timeout=app.config['DB_READ_POOL_TIMEOUT'],
+    write_queue_max=app.config['DB_WRITE_QUEUE_MAXSIZE'],
+    write_timeout=app.config['DB_WRITE_TIMEOUT'],
+)
+
+# Cache shared by the response cache and the startup snapshot; with the sqlite or redis
+# backend, what one gunicorn worker computed serves all of them
+shared_cache = create_backend(
+    app.config['CACHE_BACKEND'],
+    app.config['CACHE_URL'],
+    max_bytes=app.config['RESPONSE_CACHE_MAX_BYTES'],
+)
+
+# Compressed JSON bodies keyed by endpoint, parameters and data version
+response_cache = ResponseCache(shared_cache, compress_level=app.config['RESPONSE_CACHE_COMPRESS_LEVEL'])
+
+def announce_readings(rows):
+    """Brings the snapshot, the response cache and the live streams up to date with stored readings."""
+    tray_snapshot.update(rows)
+    response_cache.invalidate({row['tray_number'] for row in rows})
+    event_hub.publish_readings(rows)
+
+# Every stored reading reaches announce_readings through this feed, whichever process wrote it
+reading_feed = ReadingFeed(data_access.read, LarvaeData.__table__, announce_readings,
+                           poll_interval=app.config['READING_FEED_INTERVAL'])
+
+def save_readings(connection, rows):
+    """Inserts larvae readings and folds them into the rollups, in the caller's transaction."""
+    connection.execute(LarvaeData.__table__.insert(), rows)
+    apply_readings(connection, ROLLUPS, rows, data_version(connection, LarvaeData.__table__))
+
+def insert_user(connection, user):
+    """Write job storing a new (not yet persisted) User."""
+    connection.execute(User.__table__.insert().values(username=user.username, password_hash=user.password_hash))
+
 @login_manager.user_loader
 def load_user(user_id):
     return User.query.get(int(user_id))
 
 # --- Helper Functions (From app.py) ---
-def get_latest_tray_data(tray_number):
-    """Fetches the most recent larvae data entry for a specific tray."""
-    return LarvaeData.query.filter_by(tray_number=tray_number).order_by(LarvaeData.timestamp.desc()).first()
-
-def calculate_weight_distribution_backend(weights_array):
-    """Calculates the distribution of larvae weights into predefined bins."""
-    weight_bins = {
-        "80-90": 0, "90-100": 0, "100-110": 0,
-        "110-120": 0, "120-130": 0, "130-140": 0, "140+": 0
-    }
-    for weight in weights_array:
-        if 80 <= weight < 90: weight_bins["80-90"] += 1
-        elif 90 <= weight < 100: weight_bins["90-100"] += 1
-        elif 100 <= weight < 110: weight_bins["100-110"] += 1
-        elif 110 <= weight < 120: weight_bins["110-120"] += 1
-        elif 120 <= weight < 130: weight_bins["120-130"] += 1
-        elif 130 <= weight < 140: weight_bins["130-140"] += 1
-        else: weight_bins["140+"] += 1
-    return list(weight_bins.keys()), list(weight_bins.values())
+def tray_data_version(tray_number):
+    """Version of the data a tray's responses show; keys the response cache."""
+    with data_access.read() as connection:
+        version = tray_version(connection, ROLLUPS["day"], tray_number)
+    # The snapshot behind the metric cards must have seen the readings up to that version
+    reading_feed.catch_up(version)
+    return version
+
+def fleet_data_version():
+    """Version of the data the fleet-wide responses show; keys the response cache."""
+    with data_access.read() as connection:
+        version = data_version(connection, LarvaeData.__table__)
+    reading_feed.catch_up(version)
+    return version
 
 # --- Flask Routes (From app.py) ---
 @app.route('/')
@@ -133,82 +258,42 @@ def register():
         try:
             user = User(username=username)
             user.set_password(password)
-            db.session.add(user)
-            db.session.commit()
+            data_access.write(insert_user, user)
             flash('Registration successful! Please login.', 'success')
             return redirect(url_for('login'))
         except Exception as e:
-            db.session.rollback()
             flash(f'Registration failed: {e}. Please try again.', 'danger')
 
     return render_template('register.html')
 
 @app.route('/get_tray_data/<int:tray_number>')
 @login_required
+@response_cache.cached(tray_data_version, scope_of=lambda tray_number: tray_number)
 def get_tray_data(tray_number):
     """
     Fetches and processes historical data for a specific tray,
-    including growth data and weight distribution.
+    including growth data and weight distribution. The distribution uses the
+    default bins unless ?edges=, ?bin_start=/bin_width=/bin_count= or
+    ?species=/stage= ask for others.
+
+    With ?from=/?to= (ISO 8601) and/or ?max_points= the growth series covers
+    only that window, read from the minute, hour or day rollup that fits it and
+    reduced to at most max_points (default 500) with LTTB downsampling.
+
+    Every full response carries a cursor. Passing it back as ?since=<cursor>
+    returns only what changed after it (see TrayViews.tray_data_delta); a cursor newer
+    than the data, e.g. after a database reset, gets a full response again.
     """
     try:
-        # Get all historical data for the specified tray, ordered by timestamp
-        tray_data = LarvaeData.query.filter_by(tray_number=tray_number)\
-                                  .order_by(LarvaeData.timestamp.asc())\
-                                  .all()
-
-        if not tray_data:
-            return jsonify({"error": f"No data found for tray {tray_number}"}), 404
-
-        # Process growth data (latest entry per day)
-        growth_data = {"days": [], "length": [], "weight": []}
-        daily_data = {}
-
-        if tray_data:
-            start_date = tray_data[0].timestamp.date()
-            for entry in tray_data:
-                day_number = (entry.timestamp.date() - start_date).days + 1
-                daily_data[day_number] = entry  # Keep latest entry per day
-
-            for day in sorted(daily_data.keys()):
-                entry = daily_data[day]
-                growth_data["days"].append(day)
-                growth_data["length"].append(round(entry.length, 1))
-                growth_data["weight"].append(round(entry.weight, 1))
-
-        # Get latest metrics for the tray
-        latest_entry = tray_data[-1] if tray_data else None
-
-        # Calculate weight distribution for all data in the tray
-        weight_bins = {
-            "80-90": 0, "90-100": 0, "100-110": 0,
-            "110-120": 0, "120-130": 0, "130-140": 0, "140+": 0
-        }
-
-        for entry in tray_data:
-            weight = entry.weight
-            if 80 <= weight < 90: weight_bins["80-90"] += 1
-            elif 90 <= weight < 100: weight_bins["90-100"] += 1
-            elif 100 <= weight < 110: weight_bins["100-110"] += 1
-            elif 110 <= weight < 120: weight_bins["110-120"] += 1
-            elif 120 <= weight < 130: weight_bins["120-130"] += 1
-            elif 130 <= weight < 140: weight_bins["130-140"] += 1
-            else: weight_bins["140+"] += 1
-
-        return jsonify({
-            "metrics": {
-                "length": round(latest_entry.length, 1) if latest_entry else 0,
-                "width": round(latest_entry.width, 1) if latest_entry else 0,
-                "area": round(latest_entry.area, 1) if latest_entry else 0,
-                "weight": round(latest_entry.weight, 1) if latest_entry else 0,
-                "count": latest_entry.count if latest_entry else 0
-            },
-            "growthData": growth_data,
-            "weightDistribution": {
-                "ranges": list(weight_bins.keys()),
-                "counts": list(weight_bins.values())
-            },
-            "timestamp": latest_entry.timestamp.isoformat() if latest_entry else datetime.utcnow().isoformat()
-        })
+        edges, series_range, since = parse_tray_args(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        with data_access.read() as connection:
+            return jsonify(tray_views.tray_data(connection, tray_number, edges, series_range, since))
+    except NoData as e:
+        return jsonify({"error": str(e)}), 404
     except Exception as e:
         app.logger.error(f"Error fetching tray data for tray {tray_number}: {e}")
         return jsonify({"error": str(e)}), 500
@@ -216,19 +301,31 @@ def get_tray_data(tray_number):
 @app.route('/api/images/<tray_number>')
 @login_required
 def get_images(tray_number):
+    """
+    Lists the stored pictures of a tray (or 'all') with their annotations. Each
+    entry links the original ("src") and its downscaled "variants", plus a
+    srcset and the original size so the gallery can load tiles at their size.
+    """
     try:
-        if 'json' not in globals():
-            import json
-            
-        if tray_number == 'all':
-            images = ImageFile.query.order_by(ImageFile.timestamp.desc()).all()
-        else:
-            images = ImageFile.query.filter_by(tray_number=int(tray_number)).order_by(ImageFile.timestamp.desc()).all()
+        image_files = ImageFile.__table__
+        query = select(image_files).order_by(image_files.c.timestamp.desc())
+        if tray_number != 'all':
+            query = query.where(image_files.c.tray_number == int(tray_number))
+        with data_access.read() as connection:
+            images = connection.execute(query).all()
         image_list = []
-        for img in images: 
+        for img in images:
+            # Rows whose file was missing when migration 5 ran keep their old path
+            filename = img.file_path if image_store.is_key(img.file_path) else os.path.basename(img.file_path)
+            src = url_for('get_image_file', filename=filename)
+            variant_url = lambda variant: url_for('get_image_file', filename=filename, size=variant)
             image_list.append({
                 "tray": img.tray_number,
-                "src": url_for('get_image_file', filename=os.path.basename(img.file_path)),
+                "src": src,
+                "variants": {variant: variant_url(variant) for variant in VARIANTS},
+                "srcset": image_variants.srcset(variant_url, src, img.width, img.height),
+                "width": img.width,
+                "height": img.height,
                 "timestamp": img.timestamp.isoformat(),
                 "count": img.count,
                 "avgLength": img.avg_length,
@@ -244,182 +341,178 @@ def get_images(tray_number):
 # Route to serve the actual image files from the storage directory
 @app.route('/images/<path:filename>')
 def get_image_file(filename):
-    """Serve images from the IMAGE_STORAGE_DIR."""
+    """
+    Serve images from the IMAGE_STORAGE_DIR; ?size=thumb or ?size=medium serves a
+    downscaled variant, rendering it on this first request if it does not exist yet.
+    Content-addressed names are cached by browsers for good; every response
+    answers If-None-Match and Range (see imageserve.py).
+    """
     # Ensure the path is secure and valid
-    return send_file(os.path.join(IMAGE_STORAGE_DIR, filename), mimetype='image/jpeg')
+    path = safe_join(IMAGE_STORAGE_DIR, filename)
+    if path is None or not os.path.isfile(path):
+        return jsonify({"error": "Image not found"}), 404
+    size = request.args.get('size')
+    if size is not None and size not in VARIANTS:
+        return jsonify({"error": f"size must be one of {', '.join(VARIANTS)}"}), 400
+    immutable = image_store.is_key(filename)
+    etag = image_store.digest_of(filename) if immutable else None
+    mimetype = 'image/jpeg'
+    if size is not None:
+        try:
+            path = image_variants.ensure(path, size)
+        except (OSError, ValueError) as e:
+            print(f"Could not render the {size} variant of {filename}: {e}")
+            return jsonify({"error": "Image could not be read"}), 500
+        etag = etag and f"{etag}-{size}-{image_variants.image_format}"
+        mimetype = image_variants.mimetype
+    relative_path = os.path.relpath(path, IMAGE_STORAGE_DIR).replace(os.sep, "/")
+    return serve_file(path, relative_path, mimetype, etag=etag, immutable=immutable,
+                      sendfile=app.config['IMAGE_SENDFILE'], accel_prefix=app.config['IMAGE_ACCEL_PREFIX'])
 
 @app.route('/get_combined_tray_data')
 @login_required
+@response_cache.cached(fleet_data_version)
 def get_combined_tray_data():
     """
     Fetches and processes combined data from all trays,
-    providing overall metrics, growth, and weight distribution.
+    providing overall metrics, growth, and weight distribution. Accepts the
+    same histogram parameters as get_tray_data, and ?since=<cursor> for a delta.
     """
     try:
-        # Get all unique tray numbers
-        tray_numbers = [result[0] for result in db.session.query(LarvaeData.tray_number).distinct().all()]
-
-        if not tray_numbers:
-            return jsonify({"error": "No tray data available"}), 404
-
-        # Get all historical data from all trays
-        all_data = []
-        latest_entries = [] # To calculate combined latest metrics
-
-        for tray_num in tray_numbers:
-            tray_data = LarvaeData.query.filter_by(tray_number=tray_num).all()
-            all_data.extend(tray_data)
-            latest_entry = LarvaeData.query.filter_by(tray_number=tray_num)\
-                                         .order_by(LarvaeData.timestamp.desc())\
-                                         .first()
-            if latest_entry:
-                latest_entries.append(latest_entry)
-
-        if not all_data:
-            return jsonify({"error": "No data available"}), 404
-
-        # Calculate combined latest metrics (average for length/width/area/weight, sum for count)
-        combined_metrics = {
-            "length": round(sum(e.length for e in latest_entries)/len(latest_entries), 1) if latest_entries else 0,
-            "width": round(sum(e.width for e in latest_entries)/len(latest_entries), 1) if latest_entries else 0,
-            "area": round(sum(e.area for e in latest_entries)/len(latest_entries), 1) if latest_entries else 0,
-            "weight": round(sum(e.weight for e in latest_entries)/len(latest_entries), 1) if latest_entries else 0,
-            "count": sum(e.count for e in latest_entries) if latest_entries else 0
-        }
-
-        # Calculate combined growth data (average per day across all trays)
-        growth_data = {"days": [], "length": [], "weight": []}
-        day_data = defaultdict(list) # Stores all entries for a given 'day'
-
-        # Find the earliest timestamp among all data to set a consistent start day for combined growth
-        earliest_timestamp = min(entry.timestamp for entry in all_data)
-
-        for entry in all_data:
-            day = (entry.timestamp.date() - earliest_timestamp.date()).days + 1
-            day_data[day].append(entry)
-
-        for day, entries in sorted(day_data.items()):
-            growth_data["days"].append(day)
-            growth_data["length"].append(round(sum(e.length for e in entries)/len(entries), 1))
-            growth_data["weight"].append(round(sum(e.weight for e in entries)/len(entries), 1))
-
-        # Calculate combined weight distribution for all data
-        weight_bins = {
-            "80-90": 0, "90-100": 0, "100-110": 0,
-            "110-120": 0, "120-130": 0, "130-140": 0, "140+": 0
-        }
-
-        for entry in all_data:
-            weight = entry.weight
-            if 80 <= weight < 90: weight_bins["80-90"] += 1
-            elif 90 <= weight < 100: weight_bins["90-100"] += 1
-            elif 100 <= weight < 110: weight_bins["100-110"] += 1
-            elif 110 <= weight < 120: weight_bins["110-120"] += 1
-            elif 120 <= weight < 130: weight_bins["120-130"] += 1
-            elif 130 <= weight < 140: weight_bins["130-140"] += 1
-            else: weight_bins["140+"] += 1
-
-        return jsonify({
-            "metrics": combined_metrics,
-            "growthData": growth_data,
-            "weightDistribution": {
-                "ranges": list(weight_bins.keys()),
-                "counts": list(weight_bins.values())
-            },
-            "timestamp": datetime.utcnow().isoformat()
-        })
+        edges, since = parse_combined_args(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        with data_access.read() as connection:
+            return jsonify(tray_views.combined_data(connection, edges, since))
+    except NoData as e:
+        return jsonify({"error": str(e)}), 404
     except Exception as e:
         app.logger.error(f"Error fetching combined tray data: {e}")
         return jsonify({"error": str(e)}), 500
 
 @app.route('/get_comparison_data')
 @login_required
+@response_cache.cached(fleet_data_version)
 def get_comparison_data():
     """
     Fetches data for all trays to allow comparison on the dashboard.
-    Includes latest metrics, growth data, and all individual weights for distribution.
+    Includes latest metrics, growth data, and a pre-binned weight histogram with
+    quantiles per tray. Histogram bins can be chosen with ?edges=80,90,...,
+    ?bin_start=&bin_width=&bin_count= or ?species=&stage=, and the quantile
+    precision with ?quantile_resolution= (mg, default 1). With ?since=<cursor>
+    only the trays changed after that cursor are returned (see TrayViews.comparison_data_delta).
     """
     try:
-        trays_data_for_comparison = {}
-
-        # Dynamically get all unique tray numbers from the database
-        unique_trays = LarvaeData.query.with_entities(LarvaeData.tray_number).distinct().all()
-
-        # Iterate through each unique tray number found
-        for (tray_num,) in unique_trays:
-            # Fetch all historical data for the current tray, ordered by timestamp
-            all_tray_data = LarvaeData.query.filter_by(tray_number=tray_num)\
-                                          .order_by(LarvaeData.timestamp.asc())\
-                                          .all()
-
-            if not all_tray_data:
-                # If a tray has no data, include empty data for it so the frontend can handle it
-                trays_data_for_comparison[str(tray_num)] = {
-                    'latest': {'length': 0.0, 'width': 0.0, 'area': 0.0, 'weight': 0.0, 'count': 0},
-                    'growthData': {'days': [], 'length': [], 'weight': []},
-                    'allWeights': [] # Empty list for weight distribution if no data
-                }
-                continue # Move to the next tray
-
-            # --- Process Growth Data for this Tray: Get latest measurement per day ---
-            growth_data_for_tray = {
-                "days": [],
-                "length": [],
-                "weight": []
-            }
-            daily_latest_data = {} # Key: day_number, Value: LarvaeData entry (the latest for that day)
-
-            start_date = all_tray_data[0].timestamp.date() # Start date for this specific tray
-
-            for entry in all_tray_data:
-                day_number = (entry.timestamp.date() - start_date).days + 1
-                # Overwrite with the current entry; since data is sorted ascending,
-                # the last entry for a specific day will be the latest.
-                daily_latest_data[day_number] = entry
-
-            # Populate growth_data lists from the processed daily data
-            for day in sorted(daily_latest_data.keys()):
-                entry = daily_latest_data[day]
-                growth_data_for_tray["days"].append(round(day, 1))
-                growth_data_for_tray["length"].append(round(entry.length, 1))
-                growth_data_for_tray["weight"].append(round(entry.weight, 1))
-
-            # --- Process All Individual Weights for this Tray's Distribution ---
-            all_individual_weights = [entry.weight for entry in all_tray_data]
-
-            # --- Get Latest Metrics for this Tray ---
-            latest_entry = all_tray_data[-1]
-
-            trays_data_for_comparison[str(tray_num)] = {
-                'latest': {
-                    'length': round(latest_entry.length, 1),
-                    'width': round(latest_entry.width, 1),
-                    'area': round(latest_entry.area, 1),
-                    'weight': round(latest_entry.weight, 1),
-                    'count': latest_entry.count
-                },
-                'growthData': growth_data_for_tray,
-                'allWeights': all_individual_weights # This is the key for comparison weight distribution
-            }
-
-        return jsonify({
-            'trays': trays_data_for_comparison,
-            'timestamp': datetime.utcnow().isoformat()
-        })
+        edges, resolution, since = parse_comparison_args(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        with data_access.read() as connection:
+            return jsonify(tray_views.comparison_data(connection, edges, resolution, since))
     except Exception as e:
         # Log the error for debugging purposes
         app.logger.error(f"Error in get_comparison_data: {e}")
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/ingest/status')
+@login_required
+def ingest_status():
+    """
+    Reports the state of the MQTT ingest queue (depth, drops, flushes), the
+    depth and latency of every consumer shard and image worker, messages per
+    topic kind, the last heartbeat of each device, the picture variants being
+    rendered, whether this process is the ingest leader and how far its
+    reading feed has got.
+    """
+    return jsonify(dict(ingest_writer.stats(), mode=app.config['INGEST_MODE'], consumer=mqtt_consumer.stats(),
+                        images=image_consumer.stats(), topics=mqtt_router.stats(), devices=heartbeats.stats(),
+                        variants=image_variants.stats(),
+                        election=ingest_election.stats(), feed=reading_feed.stats()))
+
+@app.route('/stream/trays')
+@login_required
+def stream_trays():
+    """
+    Server-Sent Events stream of newly stored readings ("reading" events), plus
+    "resync" events when the client should refetch instead of appending.
+    Limit it to some trays with ?trays=1,2.
+    """
+    try:
+        trays = parse_tray_filter(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    subscription = event_hub.subscribe(trays)
+    response = Response(event_hub.stream(subscription), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # Also covers clients that disconnect before the stream generator first runs
+    response.call_on_close(lambda: event_hub.unsubscribe(subscription))
+    return response
+
+@app.route('/api/stream/status')
+@login_required
+def stream_status():
+    """Reports connected stream clients and published/dropped event counts."""
+    return jsonify(event_hub.stats())
+
+@app.route('/api/cache/status')
+@login_required
+def cache_status():
+    """Reports response cache hits, misses, 304s, evictions and memory use."""
+    return jsonify(response_cache.stats())
+
+@app.route('/api/db/status')
+@login_required
+def db_status():
+    """Reports the database writer queue, read pool usage and lock-wait times."""
+    return jsonify(data_access.stats())
+
+@app.route('/api/snapshot/verify')
+@login_required
+def verify_snapshot():
+    """
+    Checks the in-memory latest-reading snapshot against the database.
+    Pass ?rewarm=1 to reload the snapshot from the database after checking.
+    """
+    reading_feed.poll() # Hand on readings stored since the last poll before comparing
+    with data_access.read() as connection:
+        mismatches = tray_snapshot.verify(connection, LarvaeData.__table__)
+        if request.args.get('rewarm'):
+            tray_snapshot.warm(connection, LarvaeData.__table__)
+            # Cached responses carry metrics from the old snapshot
+            response_cache.clear()
+    return jsonify({
+        "consistent": not mismatches,
+        "trays": len(tray_snapshot),
+        "mismatches": mismatches
+    })
+
+@app.cli.command("check-query-plans")
+def check_query_plans_command():
+    """Exits with status 1 if an endpoint query falls back to a full table scan (see queryplan.py)."""
+    db.create_all()
+    run_migrations(db.engine)
+    # Startup work normally done under __main__, so the endpoints answer as they would when serving
+    if ensure_rollups(db.session, LarvaeData.__table__, ROLLUPS):
+        db.session.commit()
+    tray_snapshot.warm(db.session, LarvaeData.__table__, shared_cache)
+    first_tray = db.session.query(LarvaeData.tray_number).first()
+    problems = check_query_plans(app, data_access.read_engine, first_tray[0] if first_tray else 1)
+    for problem in problems:
+        print(f"Full scan of {problem['table']} for {problem['path']}: {problem['sql']}")
+    if problems:
+        raise SystemExit(1)
+    print("No unexpected full table scans.")
+
 @app.route('/dashboard')
 @login_required
 def dashboard():
     """Renders the main dashboard page."""
-    # Dynamically get all unique tray numbers from the database
-    unique_tray_numbers_raw = LarvaeData.query.with_entities(LarvaeData.tray_number).distinct().all()
-
-    # Convert list of tuples to a sorted list of integers
-    unique_tray_numbers = sorted([tray_num for (tray_num,) in unique_tray_numbers_raw])
+    # Dynamically get all unique tray numbers from the database, sorted
+    with data_access.read() as connection:
+        unique_tray_numbers = tray_numbers(connection, LarvaeData.__table__)
 
     # Create a dictionary to hold the tray numbers to be passed to the template.
     # The actual data for each tray will be fetched by JavaScript via AJAX.
@@ -442,83 +535,99 @@ MQTT_BROKER = "broker.hivemq.com"
 MQTT_PORT = 1883
 MQTT_TOPIC = "bsf_monitor/larvae_data" # IMPORTANT: This MUST match the topic in your data publisher!
 
-# --- MQTT Callbacks (Modified to use Flask-SQLAlchemy's db.session) ---
+# --- MQTT Callbacks (writes go through the data-access layer's writer thread) ---
 def on_connect(client, userdata, flags, rc, properties):
     """Callback function for when the MQTT client connects to the broker."""
     if rc == 0:
         print("Connected to MQTT Broker!")
-        client.subscribe(MQTT_TOPIC)
-        print(f"Subscribed to topic: {MQTT_TOPIC}")
+        # bsf_monitor/<site>/<tray>/<kind> plus the legacy MQTT_TOPIC and its format subtopics
+        subscriptions = mqtt_router.subscriptions()
+        client.subscribe(subscriptions)
+        print(f"Subscribed to topics: {', '.join(topic for topic, _ in subscriptions)}")
     else:
         print(f"Failed to connect, return code {rc}\n")
 
-def on_message(client, userdata, msg):
-    """Callback function for when an MQTT message is received."""
-    print(f"Received message on topic {msg.topic}")
+def store_ingest_batch(items):
+    """
+    Inserts a batch of queued MQTT items in a single transaction. Each item holds
+    a larvae reading and, when the message carried a picture, its image record
+    (a bare picture on an image topic has no reading).
+    """
+    larvae_rows = [item["larvae"] for item in items if item["larvae"]]
+    image_rows = [item["image"] for item in items if item.get("image")]
+    data_access.write(save_ingest_rows, larvae_rows, image_rows)
+    reading_feed.wake()
+
+def save_ingest_rows(connection, larvae_rows, image_rows):
+    """Write job storing larvae readings and image records (either list may be empty)."""
+    if larvae_rows:
+        save_readings(connection, larvae_rows)
+    if image_rows:
+        connection.execute(ImageFile.__table__.insert(), image_rows)
+
+ingest_writer = BatchWriter(
+    store_ingest_batch,
+    batch_size=app.config['INGEST_BATCH_SIZE'],
+    flush_interval=app.config['INGEST_FLUSH_INTERVAL'],
+    max_queue=app.config['INGEST_QUEUE_MAXSIZE'],
+)
+
+def handle_mqtt_message(topic, payload):
+    """
+    Decodes one metrics or image message on its consumer shard, saves its
+    picture if it has one, and queues the reading (and image record) for writing.
+    """
+    received_at = datetime.utcnow() # Use current UTC time for consistency
+    try:
+        # JSON with a base64 picture, a binary format with raw picture bytes (see codec.py),
+        # or a bare JPEG on an image topic
+        larvae, attachments = decode_routed(topic, payload, MQTT_TOPIC, received_at)
+    except ValueError as e:
+        print(f"Rejected MQTT message on topic {topic}: {e}")
+        return
+
     try:
-        data = json.loads(msg.payload.decode('utf-8'))
-
-        # Extract relevant fields from the incoming data
-        bounding_boxes = data.get("bounding_boxes")
-        masks = data.get("masks")
-
-        image_data_base64 = data.get("image_data_base64")
-        timestamp_str = datetime.utcnow().strftime('%Y%m%d_%H%M%S')
-        image_filename = f"tray_{tray_number}_{timestamp_str}.jpg"
-        image_path = os.path.join(IMAGE_STORAGE_DIR, image_filename)
-        
-        # Decode and save the image file
-        if image_data_base64:
-            image_bytes = base64.b64decode(image_data_base64)
-            with open(image_path, 'wb') as f:
-                f.write(image_bytes)
-            print(f"Image saved to {image_path}")
-
-        # Validate incoming data (basic check, more robust validation could be added)
-        required_keys = ["tray_number", "length", "width", "area", "weight", "count"]
-        if not all(key in payload for key in required_keys):
-            print("Error: Received payload is missing required keys.")
-            return
-
-        # Use Flask's app context to interact with the database in the MQTT thread
-        with app.app_context():
-            try:
-                new_entry = LarvaeData(
-                    tray_number=payload["tray_number"],
-                    length=payload["length"],
-                    width=payload["width"],
-                    area=payload["area"],
-                    weight=payload["weight"],
-                    count=payload["count"],
-                    timestamp=datetime.utcnow() # Use current UTC time for consistency
-                )
-                
-                new_image_file = ImageFile(
-                tray_number=tray_number,
-                file_path=image_path,
-                avg_length=avg_length,
-                avg_weight=avg_weight,
-                count=larvae_count,
-                # Store bounding boxes and masks as JSON strings
-                bounding_boxes=json.dumps(bounding_boxes) if bounding_boxes else None,
-                masks=json.dumps(masks) if masks else None
-                )
-                db.session.add(new_image_file)
-                db.session.add(new_entry)
-                db.session.commit()
-                print(f"Successfully stored data for Tray {new_entry.tray_number}, ID: {new_entry.id}")
-            except Exception as e:
-                db.session.rollback() # Rollback the transaction on error
-                print(f"Error storing data to database: {e}")
-            finally:
-                # Ensure the session is removed after each message processing.
-                # This is crucial for thread safety with Flask-SQLAlchemy's scoped sessions.
-                db.session.remove()
-
-    except json.JSONDecodeError:
-        print(f"Error: Could not decode JSON from message: {msg.payload.decode()}")
+        tray_number = larvae["tray_number"] if larvae else parse_topic(topic).tray
+        item = {"larvae": larvae}
+
+        # Save the image file
+        item["image"] = store_attachment(image_store, attachments, larvae, tray_number, received_at)
+        if item["image"]:
+            print(f"Image saved as {item['image']['file_path']}")
+            image_variants.submit(image_store.path(item["image"]["file_path"]))
+
+        # The database write happens on the ingest writer thread, batched with other messages
+        if not ingest_writer.submit(item):
+            print(f"Ingest queue full, dropping reading for Tray {tray_number}")
+
     except Exception as e:
-        print(f"An unexpected error occurred in on_message: {e}")
+        print(f"An unexpected error occurred while handling an MQTT message: {e}")
+
+# Messages of one tray are handled in order on one shard; different trays (and their
+# image decoding) in parallel
+mqtt_consumer = ShardedConsumer(
+    handle_mqtt_message,
+    shards=app.config['MQTT_CONSUMER_SHARDS'],
+    max_queue=app.config['MQTT_CONSUMER_QUEUE_MAXSIZE'],
+)
+image_consumer = ShardedConsumer(
+    handle_mqtt_message,
+    shards=app.config['MQTT_IMAGE_WORKERS'],
+    max_queue=app.config['MQTT_IMAGE_QUEUE_MAXSIZE'],
+    name="mqtt-image",
+)
+heartbeats = DeviceHeartbeats()
+
+# Each kind of message goes to its own pool, so image bursts cannot hold up metric readings
+mqtt_router = TopicRouter(legacy_topic=MQTT_TOPIC)
+mqtt_router.route("metrics", mqtt_consumer.submit)
+mqtt_router.route("image", image_consumer.submit)
+mqtt_router.route("heartbeat", heartbeats.submit)
+
+def on_message(client, userdata, msg):
+    """Callback function for when an MQTT message is received; routes it by topic to a consumer pool."""
+    if not mqtt_router.dispatch(msg.topic, msg.payload):
+        print(f"Dropping MQTT message on topic {msg.topic} (unknown topic or queue full)")
 
 # --- MQTT Thread Function ---
 def run_mqtt_subscriber():
@@ -535,61 +644,107 @@ def run_mqtt_subscriber():
     finally:
         print("MQTT subscriber stopped.")
 
+def start_mqtt_subscriber():
+    """Starts the MQTT subscriber thread; called once this process wins the ingest lock."""
+    mqtt_consumer.start()
+    image_consumer.start()
+    # Registered after ingest_writer.stop, so they run first: queued messages reach the writer
+    atexit.register(mqtt_consumer.stop)
+    atexit.register(image_consumer.stop)
+    mqtt_thread = threading.Thread(target=run_mqtt_subscriber)
+    mqtt_thread.daemon = True # Allows the main program to exit even if the thread is still running
+    mqtt_thread.start()
+    print("MQTT subscriber thread started.")
+
+# Only the process holding the ingest lock consumes MQTT, so several dashboard processes
+# (or a running mqtt_subscriber.py) do not store every reading more than once
+ingest_election = LeaderElection(LeaderLock(app.config['INGEST_LOCK_PATH']), start_mqtt_subscriber,
+                                 retry_interval=app.config['INGEST_LEADER_RETRY'])
+
+def check_early_metadata(fields):
+    """Validates multipart metadata that arrived ahead of the picture, if it did."""
+    if 'tray_number' in fields:
+        upload_metadata(fields)
+
 @app.route('/api/upload', methods=['POST'])
 @login_required # Ensure only authenticated users can upload images
 def upload_image():
+    """
+    Stores an uploaded picture and its metadata (tray_number, count, avg_length,
+    avg_weight, bounding_boxes, masks). The picture is the "image" part of a
+    multipart/form-data body with the metadata in the other form fields, or a
+    raw image/jpeg body with the metadata in the query string. Older clients can
+    still send it base64 encoded in a JSON body. The picture is streamed to a
+    temporary file in the image store directory in chunks and moved into place
+    once complete. Multipart metadata sent before the image part is checked
+    before the picture is read.
+    """
+    temp_path = None
+    max_bytes = app.config['UPLOAD_MAX_BYTES']
+    request.max_content_length = max_bytes # Rejects oversized bodies with a 413 before reading them
     try:
-        data = request.get_json()
-        if not data:
-            return jsonify({"error": "No data provided"}), 400
-
-        image_data = data.get('image_data')
-        tray_number = data.get('tray_number')
-        count = data.get('count')
-        avg_length = data.get('avg_length')
-        avg_weight = data.get('avg_weight')
-        bounding_boxes_json = data.get('bounding_boxes')
-        masks_json = data.get('masks')
-        
-        if not image_data or not tray_number:
-            return jsonify({"error": "Missing image data or tray number"}), 400
-
-        # Decode the base64 image
-        image_binary = base64.b64decode(image_data)
-        
-        # Create a unique filename for the image
-        filename = f"tray_{tray_number}_{int(time.time())}.jpeg"
-        file_path = os.path.join(IMAGE_STORAGE_DIR, filename)
+        if request.mimetype == 'multipart/form-data':
+            # Parsed as it arrives, not through request.files, so the picture is written once
+            boundary = request.mimetype_params.get('boundary')
+            if not boundary:
+                return jsonify({"error": "Missing multipart boundary"}), 400
+            fields, temp_path = spool_multipart(request.stream, boundary, IMAGE_STORAGE_DIR,
+                                                check_fields=check_early_metadata, max_bytes=max_bytes)
+            if temp_path is None:
+                return jsonify({"error": "Missing image part"}), 400
+            metadata = upload_metadata(fields)
+        elif request.mimetype in RAW_IMAGE_MIMETYPES:
+            metadata = upload_metadata(request.args)
+            temp_path, _ = spool_to_disk(request.stream, IMAGE_STORAGE_DIR, max_bytes)
+        else:
+            data = request.get_json(silent=True)
+            if not data:
+                return jsonify({"error": "No data provided"}), 400
+            if not data.get('image_data'):
+                return jsonify({"error": "Missing image data or tray number"}), 400
+            metadata = upload_metadata(data)
+            temp_path, _ = spool_to_disk(BytesIO(base64.b64decode(data['image_data'])), IMAGE_STORAGE_DIR,
+                                         max_bytes)
+
+        # Valid JPEGs are stored as sent, other formats converted; the file is named by
+        # its content, so uploading the same picture twice stores it once
+        image_key, _, width, height = store_image(temp_path, image_store)
+        temp_path = None
+        image_variants.submit(image_store.path(image_key))
+
+        # Create a new ImageFile entry in the database (on the writer thread)
+        new_image = dict(metadata, file_path=image_key, width=width, height=height)
+        data_access.write(save_ingest_rows, [], [new_image])
 
-        # Save the image file
-        img = Image.open(BytesIO(image_binary))
-        img.save(file_path, 'JPEG')
-        
-        # Create a new ImageFile entry in the database
-        new_image = ImageFile(
-            file_path=file_path,
-            tray_number=tray_number,
-            count=count,
-            avg_length=avg_length,
-            avg_weight=avg_weight,
-            bounding_boxes=bounding_boxes_json,
-            masks=masks_json
-        )
-        db.session.add(new_image)
-        db.session.commit()
-        
         return jsonify({"message": "Image and data uploaded successfully"}), 200
 
+    except (UploadTooLarge, RequestEntityTooLarge):
+        return jsonify({"error": f"Upload is larger than {max_bytes} bytes"}), 413
+    except ValueError as e: # Bad metadata, base64 or image
+        return jsonify({"error": str(e)}), 400
+    except WriterBusy as e:
+        print(f"Error during image upload: {e}")
+        return jsonify({"error": "Database is busy, retry later"}), 503
     except Exception as e:
         print(f"Error during image upload: {e}")
-        db.session.rollback() # Rollback the session in case of error
         return jsonify({"error": "Internal server error"}), 500
+    finally:
+        discard(temp_path)
+
+# This block runs under gunicorn, `flask run` and the CLI commands as well as below. Image render
+# workers (see derivatives.py) are spawned processes that re-import this file as __mp_main__ and
+# must not start any of it
+if __name__ != '__mp_main__':
+    data_access.start()
+    ingest_writer.start()
+    # atexit runs in reverse order: drain the ingest queue before the database writer stops
+    atexit.register(data_access.stop)
+    atexit.register(ingest_writer.stop)
 
-# --- Main Execution Block ---
-if __name__ == '__main__':
     # Initialize database and add dummy data within Flask app context
     with app.app_context():
         db.create_all() # Creates tables if they don't exist
+        run_migrations(db.engine) # Brings existing tables up to the current schema (see migrations.py)
         # Create test user if none exists
         if not User.query.filter_by(username='testuser').first():
             admin_user = User(username='testuser')
@@ -658,12 +813,21 @@ if __name__ == '__main__':
             db.session.commit()
             print("Dummy data added for demonstration including new trays.")
 
-    # Start MQTT subscriber in a separate thread
-    mqtt_thread = threading.Thread(target=run_mqtt_subscriber)
-    mqtt_thread.daemon = True # Allows the main program to exit even if the thread is still running
-    mqtt_thread.start()
-    print("MQTT subscriber thread started.")
+        # Backfill the rollups from the raw readings (including any dummy data just added)
+        if ensure_rollups(db.session, LarvaeData.__table__, ROLLUPS):
+            db.session.commit()
+        # Follow from the current last reading before warming, so nothing falls in between
+        reading_feed.start()
+        tray_snapshot.warm(db.session, LarvaeData.__table__, shared_cache)
+    atexit.register(reading_feed.stop)
 
+    if app.config['INGEST_MODE'] == 'embedded':
+        ingest_election.start()
+    else:
+        print("MQTT ingestion runs in mqtt_subscriber.py (INGEST_MODE=external)")
+
+# --- Main Execution Block ---
+if __name__ == '__main__':
     # Start Flask app in the main thread
     print("Starting Flask application...")
     # use_reloader=False is important to prevent the MQTT thread from being started twice
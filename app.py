@@ -1,24 +1,80 @@
-from flask import Flask, render_template, request, redirect, url_for, jsonify, session, flash
+from flask import Flask, Response, render_template, request, redirect, url_for, jsonify, session, flash
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required
+from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime, timedelta
-from collections import defaultdict
 import os
+import atexit
 import threading # For running MQTT in a separate thread
 import paho.mqtt.client as mqtt
 import json
 import time # Although not heavily used, keep it if needed for future sleep operations
 from random import uniform, randint
+from ingest import (DEFAULT_BATCH_MAX_BYTES, DEFAULT_BATCH_MAX_ROWS, BatchWriter, IngestReport, NDJSON_MIMETYPES,
+                    TooManyRows, insert_in_chunks, iter_chunks, iter_ndjson, limit_records, validated_readings)
+from queries import tray_numbers, tray_version
+from rollups import apply_readings, data_version, define_rollup_tables, ensure_rollups
+from migrations import run_migrations
+from queryplan import check_query_plans
+from storage import DATABASE_URL, configure_engine, engine_options
+from dal import DataAccess, WriterBusy
+from events import EventHub, parse_tray_filter
+from cache import ResponseCache
+from cache_backends import create_backend
+from changefeed import ReadingFeed
+from codec import decode_message, format_for_content_type
+from consumer import ShardedConsumer
+from leader import DEFAULT_LOCK_PATH, LeaderElection, LeaderLock
+from snapshot import TraySnapshot
+from topics import DeviceHeartbeats, TopicRouter, decode_routed
+from trayviews import NoData, TrayViews, parse_combined_args, parse_comparison_args, parse_tray_args
 
 # --- Flask App Configuration ---
 app = Flask(__name__)
 app.secret_key = os.urandom(24)
-# Ensure this path matches the database path both parts will write to
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///larvae_monitoring.db'
+# Shared with mqtt_subscriber.py; WAL and the other SQLite settings come from storage.py
+app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options()
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# MQTT readings are buffered and written in batches (see ingest.py)
+app.config['INGEST_BATCH_SIZE'] = int(os.environ.get('INGEST_BATCH_SIZE', 500))
+app.config['INGEST_FLUSH_INTERVAL'] = float(os.environ.get('INGEST_FLUSH_INTERVAL', 0.2))
+app.config['INGEST_QUEUE_MAXSIZE'] = int(os.environ.get('INGEST_QUEUE_MAXSIZE', 10000))
+app.config['INGEST_INSERT_CHUNK_SIZE'] = int(os.environ.get('INGEST_INSERT_CHUNK_SIZE', 100))
+app.config['INGEST_BATCH_MAX_ROWS'] = int(os.environ.get('INGEST_BATCH_MAX_ROWS', DEFAULT_BATCH_MAX_ROWS))
+app.config['INGEST_BATCH_MAX_BYTES'] = int(os.environ.get('INGEST_BATCH_MAX_BYTES', DEFAULT_BATCH_MAX_BYTES))
+# embedded: the web process consumes MQTT if it wins the ingest lock (one process across all
+# gunicorn workers); external: only mqtt_subscriber.py consumes (see leader.py)
+app.config['INGEST_MODE'] = os.environ.get('INGEST_MODE', 'embedded')
+app.config['INGEST_LOCK_PATH'] = os.environ.get('INGEST_LOCK_PATH', DEFAULT_LOCK_PATH)
+app.config['INGEST_LEADER_RETRY'] = float(os.environ.get('INGEST_LEADER_RETRY', 10))
+# MQTT messages are decoded on worker threads, one shard per tray hash (see consumer.py)
+app.config['MQTT_CONSUMER_SHARDS'] = int(os.environ.get('MQTT_CONSUMER_SHARDS', 4))
+app.config['MQTT_CONSUMER_QUEUE_MAXSIZE'] = int(os.environ.get('MQTT_CONSUMER_QUEUE_MAXSIZE', 1000))
+# Image messages get their own, smaller pool so they never delay metric readings (see topics.py)
+app.config['MQTT_IMAGE_WORKERS'] = int(os.environ.get('MQTT_IMAGE_WORKERS', 2))
+app.config['MQTT_IMAGE_QUEUE_MAXSIZE'] = int(os.environ.get('MQTT_IMAGE_QUEUE_MAXSIZE', 50))
+# Seconds between polls for readings stored by other processes (see changefeed.py)
+app.config['READING_FEED_INTERVAL'] = float(os.environ.get('READING_FEED_INTERVAL', 0.5))
+# Writes run on one writer thread; GET endpoints read through a read-only pool (see dal.py)
+app.config['DB_READ_POOL_SIZE'] = int(os.environ.get('DB_READ_POOL_SIZE', 4))
+app.config['DB_READ_POOL_TIMEOUT'] = float(os.environ.get('DB_READ_POOL_TIMEOUT', 10))
+app.config['DB_WRITE_QUEUE_MAXSIZE'] = int(os.environ.get('DB_WRITE_QUEUE_MAXSIZE', 1000))
+app.config['DB_WRITE_TIMEOUT'] = float(os.environ.get('DB_WRITE_TIMEOUT', 30))
+# Live updates pushed to the dashboard over Server-Sent Events (see events.py)
+app.config['SSE_CLIENT_QUEUE_SIZE'] = int(os.environ.get('SSE_CLIENT_QUEUE_SIZE', 256))
+app.config['SSE_HEARTBEAT_INTERVAL'] = float(os.environ.get('SSE_HEARTBEAT_INTERVAL', 15))
+# Serialized JSON responses, reused until the data they show changes (see cache.py)
+# memory (per process), sqlite (a file shared by the workers on this host) or redis (see cache_backends.py)
+app.config['CACHE_BACKEND'] = os.environ.get('CACHE_BACKEND', 'memory')
+app.config['CACHE_URL'] = os.environ.get('CACHE_URL')
+app.config['RESPONSE_CACHE_MAX_BYTES'] = int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+app.config['RESPONSE_CACHE_COMPRESS_LEVEL'] = int(os.environ.get('RESPONSE_CACHE_COMPRESS_LEVEL', 6))
 
 db = SQLAlchemy(app)
+with app.app_context():
+    configure_engine(db.engine)
 login_manager = LoginManager(app)
 login_manager.login_view = 'login'
 
@@ -37,6 +93,7 @@ class User(UserMixin, db.Model):
 
 class LarvaeData(db.Model):
     __tablename__ = "larvae_data"
+    __table_args__ = (db.Index("ix_larvae_data_tray_timestamp", "tray_number", "timestamp"),)
     id = db.Column(db.Integer, primary_key=True)
     tray_number = db.Column(db.Integer, nullable=False)
     length = db.Column(db.Float, nullable=False)
@@ -49,6 +106,59 @@ class LarvaeData(db.Model):
     def __repr__(self):
         return f"<LarvaData Tray {self.tray_number}: Count={self.count} at {self.timestamp}>"
 
+# Per-tray minute/hour/day rollups of larvae_data, maintained at ingest time (see rollups.py)
+ROLLUPS = define_rollup_tables(db.metadata)
+
+# Latest reading per tray, kept in memory for the metric cards (see snapshot.py)
+tray_snapshot = TraySnapshot()
+
+# Bodies of the tray data endpoints, full and delta (see trayviews.py)
+tray_views = TrayViews(ROLLUPS, LarvaeData.__table__, tray_snapshot)
+
+# Newly stored readings, pushed to /stream/trays clients
+event_hub = EventHub(
+    client_queue_size=app.config['SSE_CLIENT_QUEUE_SIZE'],
+    heartbeat_interval=app.config['SSE_HEARTBEAT_INTERVAL'],
+)
+
+# The only read-write connection lives on its writer thread; reads use a read-only pool
+data_access = DataAccess(
+    read_pool_size=app.config['DB_READ_POOL_SIZE'],
+    read_pool_timeout=app.config['DB_READ_POOL_TIMEOUT'],
+    write_queue_max=app.config['DB_WRITE_QUEUE_MAXSIZE'],
+    write_timeout=app.config['DB_WRITE_TIMEOUT'],
+)
+
+# Cache shared by the response cache and the startup snapshot; with the sqlite or redis
+# backend, what one gunicorn worker computed serves all of them
+shared_cache = create_backend(
+    app.config['CACHE_BACKEND'],
+    app.config['CACHE_URL'],
+    max_bytes=app.config['RESPONSE_CACHE_MAX_BYTES'],
+)
+
+# Compressed JSON bodies keyed by endpoint, parameters and data version
+response_cache = ResponseCache(shared_cache, compress_level=app.config['RESPONSE_CACHE_COMPRESS_LEVEL'])
+
+def announce_readings(rows):
+    """Brings the snapshot, the response cache and the live streams up to date with stored readings."""
+    tray_snapshot.update(rows)
+    response_cache.invalidate({row['tray_number'] for row in rows})
+    event_hub.publish_readings(rows)
+
+# Every stored reading reaches announce_readings through this feed, whichever process wrote it
+reading_feed = ReadingFeed(data_access.read, LarvaeData.__table__, announce_readings,
+                           poll_interval=app.config['READING_FEED_INTERVAL'])
+
+def save_readings(connection, rows):
+    """Inserts larvae readings and folds them into the rollups, in the caller's transaction."""
+    connection.execute(LarvaeData.__table__.insert(), rows)
+    apply_readings(connection, ROLLUPS, rows, data_version(connection, LarvaeData.__table__))
+
+def insert_user(connection, user):
+    """Write job storing a new (not yet persisted) User."""
+    connection.execute(User.__table__.insert().values(username=user.username, password_hash=user.password_hash))
+
 @login_manager.user_loader
 def load_user(user_id):
     return User.query.get(int(user_id))
@@ -56,57 +166,94 @@ def load_user(user_id):
 @app.route('/api/larvae_data', methods=['POST'])
 def receive_larvae_data():
     """
-    Receives JSON data from the larvae monitoring script and saves it to the database.
+    Receives a reading from the larvae monitoring script and saves it to the database.
+    The body is JSON, or a binary format chosen by Content-Type (see codec.py).
     """
+    body = request.get_data()
+    if not body:
+        return jsonify({"error": "No data received"}), 400
     try:
-        data = request.json
-        if not data:
-            return jsonify({"error": "No JSON data received"}), 400
-
-        # Validate required fields
-        required_fields = ["tray_number", "length", "width", "area", "weight", "count", "timestamp"]
-        if not all(field in data for field in required_fields):
-            return jsonify({"error": "Missing one or more required fields"}), 400
-
-        new_larvae_entry = LarvaeData(
-            tray_number=data['tray_number'],
-            length=data['length'],
-            width=data['width'],
-            area=data['area'],
-            weight=data['weight'],
-            count=data['count'],
-            timestamp=datetime.fromisoformat(data['timestamp'])
-        )
-        db.session.add(new_larvae_entry)
-        db.session.commit()
-        
-        print(f"Received and saved data for Tray {data['tray_number']}")
+        # Decoded and validated in one pass (see ingest.parse_reading)
+        row, _ = decode_message(body, format_for_content_type(request.mimetype))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        data_access.write(save_readings, [row])
+        reading_feed.wake()
         return jsonify({"message": "Data received and saved successfully"}), 201
+    except WriterBusy as e:
+        print(f"Error saving data: {e}")
+        return jsonify({"error": "Database is busy, retry later"}), 503
     except Exception as e:
-        db.session.rollback()
         print(f"Error receiving or saving data: {e}")
         return jsonify({"error": "An unexpected error occurred"}), 500
 
+@app.route('/api/larvae_data/batch', methods=['POST'])
+def receive_larvae_data_batch():
+    """
+    Receives many readings in one request, either as a JSON array or as a streamed
+    NDJSON body (Content-Type: application/x-ndjson, one object per line).
+    Rows are validated as they are read and handed to the database writer in
+    chunks of INGEST_BATCH_SIZE rows, each committed on its own, so memory use
+    does not grow with the body. Bodies over INGEST_BATCH_MAX_BYTES or
+    INGEST_BATCH_MAX_ROWS rows are refused with a 413; for an NDJSON body the
+    chunks before the limit are already stored. Responds with per-row
+    accept/reject counts and how many rows were stored.
+    A chunk is read in full before its write is queued, so a slow upload never
+    holds up the database writer.
+    """
+    request.max_content_length = app.config['INGEST_BATCH_MAX_BYTES'] # 413 before an oversized body is read
+    max_rows = app.config['INGEST_BATCH_MAX_ROWS']
+    report = IngestReport()
+    stored = 0
+    try:
+        if request.mimetype in NDJSON_MIMETYPES:
+            records = iter_ndjson(request.stream)
+        else:
+            data = request.get_json(silent=True)
+            if not isinstance(data, list):
+                return jsonify({"error": "Expected a JSON array or an NDJSON body"}), 400
+            if len(data) > max_rows: # Refused before anything is stored
+                raise TooManyRows(f"at most {max_rows} rows are accepted per request")
+            records = enumerate(data, 1)
+
+        rows = validated_readings(limit_records(records, max_rows), report)
+        for chunk in iter_chunks(rows, app.config['INGEST_BATCH_SIZE']):
+            data_access.write(insert_in_chunks, LarvaeData.__table__, chunk, app.config['INGEST_INSERT_CHUNK_SIZE'],
+                              lambda connection, chunk: apply_readings(
+                                  connection, ROLLUPS, chunk, data_version(connection, LarvaeData.__table__)))
+            stored += len(chunk)
+            reading_feed.wake()
+    except (TooManyRows, RequestEntityTooLarge) as e:
+        error = str(e) if isinstance(e, TooManyRows) else f"Body is larger than {request.max_content_length} bytes"
+        return jsonify(dict(report.as_dict(), error=error, stored=stored)), 413
+    except WriterBusy as e:
+        print(f"Error saving batch of larvae data: {e}")
+        return jsonify({"error": "Database is busy, retry later", "stored": stored}), 503
+    except Exception as e:
+        print(f"Error saving batch of larvae data: {e}")
+        return jsonify({"error": "An unexpected error occurred", "stored": stored}), 500
+
+    print(f"Batch ingest: {report.accepted} accepted, {report.rejected} rejected")
+    status = 201 if report.accepted else 400
+    return jsonify(dict(report.as_dict(), stored=stored)), status
+
 # --- Helper Functions (From app.py) ---
-def get_latest_tray_data(tray_number):
-    """Fetches the most recent larvae data entry for a specific tray."""
-    return LarvaeData.query.filter_by(tray_number=tray_number).order_by(LarvaeData.timestamp.desc()).first()
-
-def calculate_weight_distribution_backend(weights_array):
-    """Calculates the distribution of larvae weights into predefined bins."""
-    weight_bins = {
-        "80-90": 0, "90-100": 0, "100-110": 0,
-        "110-120": 0, "120-130": 0, "130-140": 0, "140+": 0
-    }
-    for weight in weights_array:
-        if 80 <= weight < 90: weight_bins["80-90"] += 1
-        elif 90 <= weight < 100: weight_bins["90-100"] += 1
-        elif 100 <= weight < 110: weight_bins["100-110"] += 1
-        elif 110 <= weight < 120: weight_bins["110-120"] += 1
-        elif 120 <= weight < 130: weight_bins["120-130"] += 1
-        elif 130 <= weight < 140: weight_bins["130-140"] += 1
-        else: weight_bins["140+"] += 1
-    return list(weight_bins.keys()), list(weight_bins.values())
+def tray_data_version(tray_number):
+    """Version of the data a tray's responses show; keys the response cache."""
+    with data_access.read() as connection:
+        version = tray_version(connection, ROLLUPS["day"], tray_number)
+    # The snapshot behind the metric cards must have seen the readings up to that version
+    reading_feed.catch_up(version)
+    return version
+
+def fleet_data_version():
+    """Version of the data the fleet-wide responses show; keys the response cache."""
+    with data_access.read() as connection:
+        version = data_version(connection, LarvaeData.__table__)
+    reading_feed.catch_up(version)
+    return version
 
 # --- Flask Routes (From app.py) ---
 @app.route('/')
@@ -143,258 +290,184 @@ def register():
         try:
             user = User(username=username)
             user.set_password(password)
-            db.session.add(user)
-            db.session.commit()
+            data_access.write(insert_user, user)
             flash('Registration successful! Please login.', 'success')
             return redirect(url_for('login'))
         except Exception as e:
-            db.session.rollback()
             flash(f'Registration failed: {e}. Please try again.', 'danger')
 
     return render_template('register.html')
 
 @app.route('/get_tray_data/<int:tray_number>')
 @login_required
+@response_cache.cached(tray_data_version, scope_of=lambda tray_number: tray_number)
 def get_tray_data(tray_number):
     """
     Fetches and processes historical data for a specific tray,
-    including growth data and weight distribution.
+    including growth data and weight distribution. The distribution uses the
+    default bins unless ?edges=, ?bin_start=/bin_width=/bin_count= or
+    ?species=/stage= ask for others.
+
+    With ?from=/?to= (ISO 8601) and/or ?max_points= the growth series covers
+    only that window, read from the minute, hour or day rollup that fits it and
+    reduced to at most max_points (default 500) with LTTB downsampling.
+
+    Every full response carries a cursor. Passing it back as ?since=<cursor>
+    returns only what changed after it (see TrayViews.tray_data_delta); a cursor newer
+    than the data, e.g. after a database reset, gets a full response again.
     """
     try:
-        # Get all historical data for the specified tray, ordered by timestamp
-        tray_data = LarvaeData.query.filter_by(tray_number=tray_number)\
-                                  .order_by(LarvaeData.timestamp.asc())\
-                                  .all()
-
-        if not tray_data:
-            return jsonify({"error": f"No data found for tray {tray_number}"}), 404
-
-        # Process growth data (latest entry per day)
-        growth_data = {"days": [], "length": [], "weight": []}
-        daily_data = {}
-
-        if tray_data:
-            start_date = tray_data[0].timestamp.date()
-            for entry in tray_data:
-                day_number = (entry.timestamp.date() - start_date).days + 1
-                daily_data[day_number] = entry  # Keep latest entry per day
-
-            for day in sorted(daily_data.keys()):
-                entry = daily_data[day]
-                growth_data["days"].append(day)
-                growth_data["length"].append(round(entry.length, 1))
-                growth_data["weight"].append(round(entry.weight, 1))
-
-        # Get latest metrics for the tray
-        latest_entry = tray_data[-1] if tray_data else None
-
-        # Calculate weight distribution for all data in the tray
-        weight_bins = {
-            "80-90": 0, "90-100": 0, "100-110": 0,
-            "110-120": 0, "120-130": 0, "130-140": 0, "140+": 0
-        }
-
-        for entry in tray_data:
-            weight = entry.weight
-            if 80 <= weight < 90: weight_bins["80-90"] += 1
-            elif 90 <= weight < 100: weight_bins["90-100"] += 1
-            elif 100 <= weight < 110: weight_bins["100-110"] += 1
-            elif 110 <= weight < 120: weight_bins["110-120"] += 1
-            elif 120 <= weight < 130: weight_bins["120-130"] += 1
-            elif 130 <= weight < 140: weight_bins["130-140"] += 1
-            else: weight_bins["140+"] += 1
-
-        return jsonify({
-            "metrics": {
-                "length": round(latest_entry.length, 1) if latest_entry else 0,
-                "width": round(latest_entry.width, 1) if latest_entry else 0,
-                "area": round(latest_entry.area, 1) if latest_entry else 0,
-                "weight": round(latest_entry.weight, 1) if latest_entry else 0,
-                "count": latest_entry.count if latest_entry else 0
-            },
-            "growthData": growth_data,
-            "weightDistribution": {
-                "ranges": list(weight_bins.keys()),
-                "counts": list(weight_bins.values())
-            },
-            "timestamp": latest_entry.timestamp.isoformat() if latest_entry else datetime.utcnow().isoformat()
-        })
+        edges, series_range, since = parse_tray_args(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        with data_access.read() as connection:
+            return jsonify(tray_views.tray_data(connection, tray_number, edges, series_range, since))
+    except NoData as e:
+        return jsonify({"error": str(e)}), 404
     except Exception as e:
         app.logger.error(f"Error fetching tray data for tray {tray_number}: {e}")
         return jsonify({"error": str(e)}), 500
 
 @app.route('/get_combined_tray_data')
 @login_required
+@response_cache.cached(fleet_data_version)
 def get_combined_tray_data():
     """
     Fetches and processes combined data from all trays,
-    providing overall metrics, growth, and weight distribution.
+    providing overall metrics, growth, and weight distribution. Accepts the
+    same histogram parameters as get_tray_data, and ?since=<cursor> for a delta.
     """
     try:
-        # Get all unique tray numbers
-        tray_numbers = [result[0] for result in db.session.query(LarvaeData.tray_number).distinct().all()]
-
-        if not tray_numbers:
-            return jsonify({"error": "No tray data available"}), 404
-
-        # Get all historical data from all trays
-        all_data = []
-        latest_entries = [] # To calculate combined latest metrics
-
-        for tray_num in tray_numbers:
-            tray_data = LarvaeData.query.filter_by(tray_number=tray_num).all()
-            all_data.extend(tray_data)
-            latest_entry = LarvaeData.query.filter_by(tray_number=tray_num)\
-                                         .order_by(LarvaeData.timestamp.desc())\
-                                         .first()
-            if latest_entry:
-                latest_entries.append(latest_entry)
-
-        if not all_data:
-            return jsonify({"error": "No data available"}), 404
-
-        # Calculate combined latest metrics (average for length/width/area/weight, sum for count)
-        combined_metrics = {
-            "length": round(sum(e.length for e in latest_entries)/len(latest_entries), 1) if latest_entries else 0,
-            "width": round(sum(e.width for e in latest_entries)/len(latest_entries), 1) if latest_entries else 0,
-            "area": round(sum(e.area for e in latest_entries)/len(latest_entries), 1) if latest_entries else 0,
-            "weight": round(sum(e.weight for e in latest_entries)/len(latest_entries), 1) if latest_entries else 0,
-            "count": sum(e.count for e in latest_entries) if latest_entries else 0
-        }
-
-        # Calculate combined growth data (average per day across all trays)
-        growth_data = {"days": [], "length": [], "weight": []}
-        day_data = defaultdict(list) # Stores all entries for a given 'day'
-
-        # Find the earliest timestamp among all data to set a consistent start day for combined growth
-        earliest_timestamp = min(entry.timestamp for entry in all_data)
-
-        for entry in all_data:
-            day = (entry.timestamp.date() - earliest_timestamp.date()).days + 1
-            day_data[day].append(entry)
-
-        for day, entries in sorted(day_data.items()):
-            growth_data["days"].append(day)
-            growth_data["length"].append(round(sum(e.length for e in entries)/len(entries), 1))
-            growth_data["weight"].append(round(sum(e.weight for e in entries)/len(entries), 1))
-
-        # Calculate combined weight distribution for all data
-        weight_bins = {
-            "80-90": 0, "90-100": 0, "100-110": 0,
-            "110-120": 0, "120-130": 0, "130-140": 0, "140+": 0
-        }
-
-        for entry in all_data:
-            weight = entry.weight
-            if 80 <= weight < 90: weight_bins["80-90"] += 1
-            elif 90 <= weight < 100: weight_bins["90-100"] += 1
-            elif 100 <= weight < 110: weight_bins["100-110"] += 1
-            elif 110 <= weight < 120: weight_bins["110-120"] += 1
-            elif 120 <= weight < 130: weight_bins["120-130"] += 1
-            elif 130 <= weight < 140: weight_bins["130-140"] += 1
-            else: weight_bins["140+"] += 1
-
-        return jsonify({
-            "metrics": combined_metrics,
-            "growthData": growth_data,
-            "weightDistribution": {
-                "ranges": list(weight_bins.keys()),
-                "counts": list(weight_bins.values())
-            },
-            "timestamp": datetime.utcnow().isoformat()
-        })
+        edges, since = parse_combined_args(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        with data_access.read() as connection:
+            return jsonify(tray_views.combined_data(connection, edges, since))
+    except NoData as e:
+        return jsonify({"error": str(e)}), 404
     except Exception as e:
         app.logger.error(f"Error fetching combined tray data: {e}")
         return jsonify({"error": str(e)}), 500
 
 @app.route('/get_comparison_data')
 @login_required
+@response_cache.cached(fleet_data_version)
 def get_comparison_data():
     """
     Fetches data for all trays to allow comparison on the dashboard.
-    Includes latest metrics, growth data, and all individual weights for distribution.
+    Includes latest metrics, growth data, and a pre-binned weight histogram with
+    quantiles per tray. Histogram bins can be chosen with ?edges=80,90,...,
+    ?bin_start=&bin_width=&bin_count= or ?species=&stage=, and the quantile
+    precision with ?quantile_resolution= (mg, default 1). With ?since=<cursor>
+    only the trays changed after that cursor are returned (see TrayViews.comparison_data_delta).
     """
     try:
-        trays_data_for_comparison = {}
-
-        # Dynamically get all unique tray numbers from the database
-        unique_trays = LarvaeData.query.with_entities(LarvaeData.tray_number).distinct().all()
-
-        # Iterate through each unique tray number found
-        for (tray_num,) in unique_trays:
-            # Fetch all historical data for the current tray, ordered by timestamp
-            all_tray_data = LarvaeData.query.filter_by(tray_number=tray_num)\
-                                          .order_by(LarvaeData.timestamp.asc())\
-                                          .all()
-
-            if not all_tray_data:
-                # If a tray has no data, include empty data for it so the frontend can handle it
-                trays_data_for_comparison[str(tray_num)] = {
-                    'latest': {'length': 0.0, 'width': 0.0, 'area': 0.0, 'weight': 0.0, 'count': 0},
-                    'growthData': {'days': [], 'length': [], 'weight': []},
-                    'allWeights': [] # Empty list for weight distribution if no data
-                }
-                continue # Move to the next tray
-
-            # --- Process Growth Data for this Tray: Get latest measurement per day ---
-            growth_data_for_tray = {
-                "days": [],
-                "length": [],
-                "weight": []
-            }
-            daily_latest_data = {} # Key: day_number, Value: LarvaeData entry (the latest for that day)
-
-            start_date = all_tray_data[0].timestamp.date() # Start date for this specific tray
-
-            for entry in all_tray_data:
-                day_number = (entry.timestamp.date() - start_date).days + 1
-                # Overwrite with the current entry; since data is sorted ascending,
-                # the last entry for a specific day will be the latest.
-                daily_latest_data[day_number] = entry
-
-            # Populate growth_data lists from the processed daily data
-            for day in sorted(daily_latest_data.keys()):
-                entry = daily_latest_data[day]
-                growth_data_for_tray["days"].append(round(day, 1))
-                growth_data_for_tray["length"].append(round(entry.length, 1))
-                growth_data_for_tray["weight"].append(round(entry.weight, 1))
-
-            # --- Process All Individual Weights for this Tray's Distribution ---
-            all_individual_weights = [entry.weight for entry in all_tray_data]
-
-            # --- Get Latest Metrics for this Tray ---
-            latest_entry = all_tray_data[-1]
-
-            trays_data_for_comparison[str(tray_num)] = {
-                'latest': {
-                    'length': round(latest_entry.length, 1),
-                    'width': round(latest_entry.width, 1),
-                    'area': round(latest_entry.area, 1),
-                    'weight': round(latest_entry.weight, 1),
-                    'count': latest_entry.count
-                },
-                'growthData': growth_data_for_tray,
-                'allWeights': all_individual_weights # This is the key for comparison weight distribution
-            }
-
-        return jsonify({
-            'trays': trays_data_for_comparison,
-            'timestamp': datetime.utcnow().isoformat()
-        })
+        edges, resolution, since = parse_comparison_args(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        with data_access.read() as connection:
+            return jsonify(tray_views.comparison_data(connection, edges, resolution, since))
     except Exception as e:
         # Log the error for debugging purposes
         app.logger.error(f"Error in get_comparison_data: {e}")
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/ingest/status')
+@login_required
+def ingest_status():
+    """
+    Reports the state of the MQTT ingest queue (depth, drops, flushes), the
+    depth and latency of every consumer shard and image worker, messages per
+    topic kind, the last heartbeat of each device, whether this process is
+    the ingest leader and how far its reading feed has got.
+    """
+    return jsonify(dict(ingest_writer.stats(), mode=app.config['INGEST_MODE'], consumer=mqtt_consumer.stats(),
+                        images=image_consumer.stats(), topics=mqtt_router.stats(), devices=heartbeats.stats(),
+                        election=ingest_election.stats(), feed=reading_feed.stats()))
+
+@app.route('/stream/trays')
+@login_required
+def stream_trays():
+    """
+    Server-Sent Events stream of newly stored readings ("reading" events), plus
+    "resync" events when the client should refetch instead of appending.
+    Limit it to some trays with ?trays=1,2.
+    """
+    try:
+        trays = parse_tray_filter(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    subscription = event_hub.subscribe(trays)
+    response = Response(event_hub.stream(subscription), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # Also covers clients that disconnect before the stream generator first runs
+    response.call_on_close(lambda: event_hub.unsubscribe(subscription))
+    return response
+
+@app.route('/api/stream/status')
+@login_required
+def stream_status():
+    """Reports connected stream clients and published/dropped event counts."""
+    return jsonify(event_hub.stats())
+
+@app.route('/api/cache/status')
+@login_required
+def cache_status():
+    """Reports response cache hits, misses, 304s, evictions and memory use."""
+    return jsonify(response_cache.stats())
+
+@app.route('/api/db/status')
+@login_required
+def db_status():
+    """Reports the database writer queue, read pool usage and lock-wait times."""
+    return jsonify(data_access.stats())
+
+@app.route('/api/snapshot/verify')
+@login_required
+def verify_snapshot():
+    """
+    Checks the in-memory latest-reading snapshot against the database.
+    Pass ?rewarm=1 to reload the snapshot from the database after checking.
+    """
+    reading_feed.poll() # Hand on readings stored since the last poll before comparing
+    with data_access.read() as connection:
+        mismatches = tray_snapshot.verify(connection, LarvaeData.__table__)
+        if request.args.get('rewarm'):
+            tray_snapshot.warm(connection, LarvaeData.__table__)
+            # Cached responses carry metrics from the old snapshot
+            response_cache.clear()
+    return jsonify({
+        "consistent": not mismatches,
+        "trays": len(tray_snapshot),
+        "mismatches": mismatches
+    })
+
+@app.cli.command("check-query-plans")
+def check_query_plans_command():
+    """Exits with status 1 if an endpoint query falls back to a full table scan (see queryplan.py)."""
+    db.create_all()
+    run_migrations(db.engine)
+    first_tray = db.session.query(LarvaeData.tray_number).first()
+    problems = check_query_plans(app, data_access.read_engine, first_tray[0] if first_tray else 1)
+    for problem in problems:
+        print(f"Full scan of {problem['table']} for {problem['path']}: {problem['sql']}")
+    if problems:
+        raise SystemExit(1)
+    print("No unexpected full table scans.")
+
 @app.route('/dashboard')
 @login_required
 def dashboard():
     """Renders the main dashboard page."""
-    # Dynamically get all unique tray numbers from the database
-    unique_tray_numbers_raw = LarvaeData.query.with_entities(LarvaeData.tray_number).distinct().all()
-
-    # Convert list of tuples to a sorted list of integers
-    unique_tray_numbers = sorted([tray_num for (tray_num,) in unique_tray_numbers_raw])
+    # Dynamically get all unique tray numbers from the database, sorted
+    with data_access.read() as connection:
+        unique_tray_numbers = tray_numbers(connection, LarvaeData.__table__)
 
     # Create a dictionary to hold the tray numbers to be passed to the template.
     # The actual data for each tray will be fetched by JavaScript via AJAX.
@@ -419,46 +492,73 @@ MQTT_TOPIC = "bsf_monitor/larvae_data" # IMPORTANT: This MUST match the topic in
 
 mqtt_client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
 
-# --- MQTT Callbacks (Modified to use Flask-SQLAlchemy's db.session) ---
+# --- MQTT Callbacks (writes go through the data-access layer's writer thread) ---
 def on_connect(client, userdata, flags, rc, properties):
     """Callback function for when the MQTT client connects to the broker."""
     if rc == 0:
         print("Connected to MQTT Broker!")
-        client.subscribe(MQTT_TOPIC)
-        print(f"Subscribed to topic: {MQTT_TOPIC}")
+        # bsf_monitor/<site>/<tray>/<kind> plus the legacy MQTT_TOPIC and its format subtopics
+        subscriptions = mqtt_router.subscriptions()
+        client.subscribe(subscriptions)
+        print(f"Subscribed to topics: {', '.join(topic for topic, _ in subscriptions)}")
     else:
         print(f"Failed to connect, return code {rc}\n")
 
+def store_larvae_rows(rows):
+    """Inserts a batch of larvae readings in a single transaction on the database writer."""
+    data_access.write(save_readings, rows)
+    reading_feed.wake()
+
+ingest_writer = BatchWriter(
+    store_larvae_rows,
+    batch_size=app.config['INGEST_BATCH_SIZE'],
+    flush_interval=app.config['INGEST_FLUSH_INTERVAL'],
+    max_queue=app.config['INGEST_QUEUE_MAXSIZE'],
+)
+
+def handle_mqtt_message(topic, payload):
+    """
+    Decodes and validates one metrics or image message on its tray's consumer
+    shard, then queues its reading for writing (this app keeps no pictures).
+    """
+    try:
+        # Validated here so one bad reading cannot fail a whole batch later
+        row, _ = decode_routed(topic, payload, MQTT_TOPIC, received_at=datetime.utcnow())
+    except ValueError as e:
+        print(f"Rejected MQTT message on topic {topic}: {e}")
+        return
+    if row is None: # A bare picture
+        return
+
+    # The write itself happens on the ingest writer thread, batched with other readings
+    if not ingest_writer.submit(row):
+        print(f"Ingest queue full, dropping reading for Tray {row['tray_number']}")
+
+# Messages of one tray are handled in order on one shard; different trays in parallel
+mqtt_consumer = ShardedConsumer(
+    handle_mqtt_message,
+    shards=app.config['MQTT_CONSUMER_SHARDS'],
+    max_queue=app.config['MQTT_CONSUMER_QUEUE_MAXSIZE'],
+)
+image_consumer = ShardedConsumer(
+    handle_mqtt_message,
+    shards=app.config['MQTT_IMAGE_WORKERS'],
+    max_queue=app.config['MQTT_IMAGE_QUEUE_MAXSIZE'],
+    name="mqtt-image",
+)
+heartbeats = DeviceHeartbeats()
+
+# Each kind of message goes to its own pool; heartbeats are only counted
+mqtt_router = TopicRouter(legacy_topic=MQTT_TOPIC)
+mqtt_router.route("metrics", mqtt_consumer.submit)
+mqtt_router.route("image", image_consumer.submit)
+mqtt_router.route("heartbeat", heartbeats.submit)
+
 def on_message(client, userdata, msg):
     """Callback function for when a message is received from the broker."""
-    # Process the message only if it's on the expected topic
-    if msg.topic == MQTT_TOPIC:
-        try:
-            payload = json.loads(msg.payload.decode())
-            print(f"Received data: {payload}")
-
-            # Push a new application context for this thread
-            # This is CRITICAL for using the database within a separate thread
-            with app.app_context():
-                # Create a new LarvaData instance and save it to the database
-                new_data = LarvaeData(
-                    tray_number=payload.get("tray_number"),
-                    length=payload.get("length"),
-                    width=payload.get("width"),
-                    area=payload.get("area"),
-                    weight=payload.get("weight"),
-                    count=payload.get("count"),
-                    timestamp=datetime.utcnow()
-                )
-                db.session.add(new_data)
-                db.session.commit()
-                print("Data saved to database.")
-
-        except json.JSONDecodeError as e:
-            print(f"Error decoding JSON payload: {e}")
-        except Exception as e:
-            print(f"An error occurred while processing MQTT message: {e}")
-            db.session.rollback() # Rollback the session on error
+    # Process the message only if it's on one of the expected topics; decoding happens on a consumer pool
+    if not mqtt_router.dispatch(msg.topic, msg.payload):
+        print(f"Dropping MQTT message on topic {msg.topic} (unknown topic or queue full)")
 
 # --- MQTT Thread Function ---
 def run_mqtt_subscriber():
@@ -475,17 +575,47 @@ def run_mqtt_subscriber():
     finally:
         print("MQTT subscriber stopped.")
 
+def start_mqtt_subscriber():
+    """Starts the MQTT subscriber thread; called once this process wins the ingest lock."""
+    mqtt_consumer.start()
+    image_consumer.start()
+    # Registered after ingest_writer.stop, so they run first: queued messages reach the writer
+    atexit.register(mqtt_consumer.stop)
+    atexit.register(image_consumer.stop)
+    print("Starting MQTT subscriber thread...")
+    mqtt_thread = threading.Thread(target=run_mqtt_subscriber)
+    mqtt_thread.daemon = True
+    mqtt_thread.start()
+    print("MQTT subscriber thread started.")
+
+# Only the process holding the ingest lock consumes MQTT, so N gunicorn workers
+# (or a running mqtt_subscriber.py) do not store every reading N times
+ingest_election = LeaderElection(LeaderLock(app.config['INGEST_LOCK_PATH']), start_mqtt_subscriber,
+                                 retry_interval=app.config['INGEST_LEADER_RETRY'])
+
 # This block will run on Render and locally
-# It starts the MQTT subscriber thread immediately after the app is created
-print("Starting MQTT subscriber thread...")
-mqtt_thread = threading.Thread(target=run_mqtt_subscriber)
-mqtt_thread.daemon = True
-mqtt_thread.start()
-print("MQTT subscriber thread started.")
+data_access.start()
+ingest_writer.start()
+# atexit runs in reverse order: drain the ingest queue before the database writer stops
+atexit.register(data_access.stop)
+atexit.register(ingest_writer.stop)
 
 # Initialize database and add dummy data within Flask app context
 with app.app_context():
     db.create_all() # Creates tables if they don't exist
+    run_migrations(db.engine) # Brings existing tables up to the current schema (see migrations.py)
+    # Backfill the rollups from the raw readings on the first start after an upgrade
+    if ensure_rollups(db.session, LarvaeData.__table__, ROLLUPS):
+        db.session.commit()
+    # Follow from the current last reading before warming, so nothing falls in between
+    reading_feed.start()
+    tray_snapshot.warm(db.session, LarvaeData.__table__, shared_cache)
+atexit.register(reading_feed.stop)
+
+if app.config['INGEST_MODE'] == 'embedded':
+    ingest_election.start()
+else:
+    print("MQTT ingestion runs in mqtt_subscriber.py (INGEST_MODE=external)")
 
 # --- Main Execution Block ---
 if __name__ == '__main__':
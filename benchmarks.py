@@ -0,0 +1,361 @@
+"""
+Micro-benchmarks for the ingest and query hot paths.
+
+Run one with `python benchmarks.py <name>`, or `python benchmarks.py --list`
+to see what is available. Each benchmark prints the best of a few repeats so
+results are comparable between runs on the same machine.
+"""
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+from array import array
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    """Registers a function as a named benchmark."""
+    def register(function):
+        BENCHMARKS[name] = function
+        return function
+    return register
+
+
+def best_time(function, *args, repeat=3):
+    """Best wall-clock time of `repeat` calls, in seconds, plus the last result."""
+    best, result = None, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def report(label, seconds, items=None):
+    rate = f"  {items / seconds:>14,.0f} /s" if items else ""
+    print(f"  {label:<40} {seconds * 1000:>10.1f} ms{rate}")
+
+
+def legacy_weight_bins(weights_array):
+    """The if/elif ladder the endpoints used before histogram.py, kept as the baseline."""
+    weight_bins = {
+        "80-90": 0, "90-100": 0, "100-110": 0,
+        "110-120": 0, "120-130": 0, "130-140": 0, "140+": 0
+    }
+    for weight in weights_array:
+        if 80 <= weight < 90: weight_bins["80-90"] += 1
+        elif 90 <= weight < 100: weight_bins["90-100"] += 1
+        elif 100 <= weight < 110: weight_bins["100-110"] += 1
+        elif 110 <= weight < 120: weight_bins["110-120"] += 1
+        elif 120 <= weight < 130: weight_bins["120-130"] += 1
+        elif 130 <= weight < 140: weight_bins["130-140"] += 1
+        else: weight_bins["140+"] += 1
+    return list(weight_bins.keys()), list(weight_bins.values())
+
+
+@benchmark("histogram")
+def bench_histogram(args):
+    """Bins 10^6 weights with the legacy ladder and with histogram.compute_histogram."""
+    import histogram
+
+    count = args.count or 1_000_000
+    rng = random.Random(42)
+    weights = array("d", (rng.uniform(60, 170) for _ in range(count)))
+    print(f"Binning {count:,} weights into {len(histogram.DEFAULT_WEIGHT_EDGES)} bins "
+          f"(NumPy {'enabled' if histogram.np is not None else 'not installed'})")
+
+    seconds, (_, legacy_counts) = best_time(legacy_weight_bins, weights)
+    report("legacy if/elif ladder", seconds, count)
+
+    seconds, result = best_time(histogram.compute_histogram, weights)
+    report("compute_histogram", seconds, count)
+    assert result.folded_counts() == legacy_counts, "histogram engine disagrees with the legacy ladder"
+
+    chunks = [weights[index:index + count // 10] for index in range(0, count, count // 10)]
+    seconds, merged = best_time(
+        lambda: histogram.merge_histograms(histogram.compute_histogram(chunk) for chunk in chunks))
+    report("10 partial histograms + merge", seconds, count)
+    assert merged.counts == result.counts and merged.below == result.below
+
+
+def _latency_summary(samples):
+    ordered = sorted(samples)
+    pick = lambda q: ordered[min(int(q * len(ordered)), len(ordered) - 1)] * 1000
+    return f"p50 {pick(0.5):7.2f} ms   p99 {pick(0.99):7.2f} ms   max {ordered[-1] * 1000:7.2f} ms"
+
+
+def _contended_reads(writer_engine, reader_engine, reads, seed_rows=20000, write_batch=50):
+    """
+    Times `reads` per-tray queries on reader_engine while a thread keeps inserting
+    batches through writer_engine. Returns (latencies, failed reads, rows written per second).
+    """
+    from sqlalchemy import Column, DateTime, Float, Index, Integer, MetaData, Table, select
+    from datetime import datetime, timedelta
+
+    metadata = MetaData()
+    larvae = Table(
+        "larvae_data", metadata,
+        Column("id", Integer, primary_key=True),
+        Column("tray_number", Integer, nullable=False),
+        Column("weight", Float, nullable=False),
+        Column("timestamp", DateTime, nullable=False),
+        Index("ix_larvae_data_tray_timestamp", "tray_number", "timestamp"),
+    )
+    metadata.create_all(writer_engine)
+    rng = random.Random(7)
+    start = datetime(2025, 1, 1)
+    make_row = lambda index: {"tray_number": rng.randrange(20), "weight": rng.uniform(60, 170),
+                              "timestamp": start + timedelta(seconds=index)}
+    with writer_engine.begin() as connection:
+        connection.execute(larvae.insert(), [make_row(index) for index in range(seed_rows)])
+
+    stop = threading.Event()
+    written = [0]
+
+    def write():
+        index = seed_rows
+        while not stop.is_set():
+            with writer_engine.begin() as connection:
+                connection.execute(larvae.insert(), [make_row(index + offset) for offset in range(write_batch)])
+            index += write_batch
+            written[0] += write_batch
+
+    writer = threading.Thread(target=write, daemon=True)
+    writer.start()
+    began_reading = time.perf_counter()
+    latencies, failures = [], 0
+    query = select(larvae).where(larvae.c.tray_number == 3).order_by(larvae.c.timestamp.desc()).limit(50)
+    try:
+        for _ in range(reads):
+            began = time.perf_counter()
+            try:
+                with reader_engine.connect() as connection:
+                    connection.execute(query).all()
+            except Exception:
+                failures += 1
+            latencies.append(time.perf_counter() - began)
+    finally:
+        stop.set()
+        writer.join()
+    return latencies, failures, written[0] / (time.perf_counter() - began_reading)
+
+
+@benchmark("contention")
+def bench_sqlite_contention(args):
+    """Read latency under a concurrent writer, default SQLite settings vs the storage.py profile."""
+    from sqlalchemy import create_engine
+    import storage
+
+    reads = args.count or 2000
+    print(f"{reads:,} per-tray reads while another thread inserts batches of 50 rows")
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "default.db")
+        plain = lambda: create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False})
+        writer_engine, reader_engine = plain(), plain()
+        latencies, failures, written = _contended_reads(writer_engine, reader_engine, reads)
+        print(f"  {'default (rollback journal)':<28} {_latency_summary(latencies)}"
+              f"   failed {failures}   {written:,.0f} rows/s written")
+        writer_engine.dispose()
+        reader_engine.dispose()
+
+        path = os.path.join(directory, "tuned.db")
+        writer_engine = storage.create_storage_engine(path)
+        with writer_engine.connect():
+            pass # The first writer connection switches the new file to WAL before readers open it
+        reader_engine = storage.create_storage_engine(path, read_only=True)
+        latencies, failures, written = _contended_reads(writer_engine, reader_engine, reads)
+        print(f"  {'storage.py (WAL, read-only)':<28} {_latency_summary(latencies)}"
+              f"   failed {failures}   {written:,.0f} rows/s written")
+        writer_engine.dispose()
+        reader_engine.dispose()
+
+
+
+def legacy_mqtt_reading(payload):
+    """What on_message did per message before ingest.decode_reading, kept as the baseline."""
+    from datetime import datetime
+    import json
+
+    payload = json.loads(payload.decode())
+    required_keys = ["tray_number", "length", "width", "area", "weight", "count"]
+    if not all(payload.get(key) is not None for key in required_keys):
+        return None
+    return {
+        "tray_number": payload["tray_number"],
+        "length": payload["length"],
+        "width": payload["width"],
+        "area": payload["area"],
+        "weight": payload["weight"],
+        "count": payload["count"],
+        "timestamp": datetime.utcnow(),
+    }
+
+
+@benchmark("ingest")
+def bench_ingest(args):
+    """MQTT messages per second on one core: decode + validate, then ORM vs Core inserts."""
+    from datetime import datetime
+    import json
+    from sqlalchemy import Column, DateTime, Float, Integer, create_engine
+    from sqlalchemy.orm import declarative_base, sessionmaker
+    import ingest
+
+    count = args.count or 200_000
+    rng = random.Random(11)
+    payloads = [json.dumps({
+        "tray_number": rng.randrange(1, 40), "length": rng.uniform(5, 20), "width": rng.uniform(1, 4),
+        "area": rng.uniform(10, 90), "weight": rng.uniform(60, 170), "count": rng.randrange(1, 700),
+    }).encode() for _ in range(count)]
+    print(f"Decoding and validating {count:,} MQTT payloads on one thread "
+          f"(orjson {'enabled' if ingest.orjson is not None else 'not installed'})")
+
+    seconds, _ = best_time(lambda: [legacy_mqtt_reading(payload) for payload in payloads])
+    report("decode() + json.loads + key check", seconds, count)
+    now = datetime.utcnow()
+    seconds, rows = best_time(lambda: [ingest.decode_reading(payload, now) for payload in payloads])
+    report("ingest.decode_reading", seconds, count)
+    if ingest.orjson is not None:
+        fast_loads, ingest.orjson = ingest.orjson, None
+        seconds, _ = best_time(lambda: [ingest.decode_reading(payload, now) for payload in payloads])
+        report("ingest.decode_reading (stdlib json)", seconds, count)
+        ingest.orjson = fast_loads
+
+    Base = declarative_base()
+
+    class Reading(Base):
+        __tablename__ = "larvae_data"
+        id = Column(Integer, primary_key=True)
+        tray_number = Column(Integer, nullable=False)
+        length = Column(Float, nullable=False)
+        width = Column(Float, nullable=False)
+        area = Column(Float, nullable=False)
+        weight = Column(Float, nullable=False)
+        count = Column(Integer, nullable=False)
+        timestamp = Column(DateTime, nullable=False)
+
+    inserts = min(count, 5000)
+    print(f"Storing {inserts:,} readings in a temporary SQLite file")
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_engine(f"sqlite:///{os.path.join(directory, 'ingest.db')}")
+        Base.metadata.create_all(engine)
+        Session = sessionmaker(bind=engine)
+
+        def orm_per_message():
+            for row in rows[:inserts]:
+                session = Session()
+                entry = Reading(**row)
+                session.add(entry)
+                session.commit()
+                session.refresh(entry)
+                session.close()
+
+        def core_batches(batch_size=500):
+            for start in range(0, inserts, batch_size):
+                with engine.begin() as connection:
+                    connection.execute(Reading.__table__.insert(), rows[start:start + batch_size])
+
+        seconds, _ = best_time(orm_per_message, repeat=1)
+        report("ORM add/commit/refresh per message", seconds, inserts)
+        seconds, _ = best_time(core_batches)
+        report("Core insert, batches of 500", seconds, inserts)
+        engine.dispose()
+
+
+@benchmark("payloads")
+def bench_payloads(args):
+    """Decode cost and bytes on the wire of JSON vs struct vs MessagePack readings."""
+    import base64
+    import json
+    import codec
+
+    count = args.count or 100_000
+    rng = random.Random(13)
+    readings = [{
+        "tray_number": rng.randrange(1, 40), "length": rng.uniform(5, 20), "width": rng.uniform(1, 4),
+        "area": rng.uniform(10, 90), "weight": rng.uniform(60, 170), "count": rng.randrange(1, 700),
+    } for _ in range(count)]
+    image = rng.randbytes(50_000) # Stands in for a ~50 KB JPEG
+    annotations = {"bounding_boxes": [[10, 20, 30, 40]] * 8}
+
+    def as_json(reading, picture=None):
+        data = dict(reading)
+        if picture:
+            data.update(annotations, image_data_base64=base64.b64encode(picture).decode("ascii"))
+        return json.dumps(data).encode()
+
+    encoders = {"json": as_json, "struct": lambda reading, picture=None: codec.encode_struct(
+        reading, picture, annotations if picture else None)}
+    if codec.msgpack is not None:
+        encoders["msgpack"] = lambda reading, picture=None: codec.encode_msgpack(
+            reading, picture, annotations if picture else None)
+    else:
+        print("msgpack is not installed; MessagePack is skipped")
+
+    from datetime import datetime
+    now = datetime.utcnow()
+    with_image = min(count, 2000)
+    for fmt, encode in encoders.items():
+        print(f"{fmt}:")
+        payloads = [encode(reading) for reading in readings]
+        seconds, _ = best_time(lambda: [codec.decode_message(payload, fmt, now) for payload in payloads])
+        report(f"reading, {sum(map(len, payloads)) / count:.0f} bytes", seconds, count)
+        payloads = [encode(reading, image) for reading in readings[:with_image]]
+        seconds, _ = best_time(lambda: [codec.decode_message(payload, fmt, now) for payload in payloads])
+        report(f"reading + 50 KB image, {sum(map(len, payloads)) / with_image:,.0f} bytes", seconds, with_image)
+
+
+@benchmark("uploads")
+def bench_uploads(args):
+    """Uploaded JPEGs stored per second: Pillow decode + re-encode vs header check + passthrough."""
+    from io import BytesIO
+    from PIL import Image
+    from imagestore import ImageStore
+    import uploads
+
+    count = args.count or 50
+    source = BytesIO()
+    Image.effect_noise((1920, 1080), 40).convert("RGB").save(source, "JPEG", quality=90)
+    jpeg = source.getvalue()
+    print(f"Storing {count} uploads of a 1920x1080 JPEG ({len(jpeg) / 1024:,.0f} KB)")
+
+    with tempfile.TemporaryDirectory() as directory:
+        def reencode():
+            for index in range(count):
+                img = Image.open(BytesIO(jpeg))
+                img.save(os.path.join(directory, f"reencoded_{index}.jpeg"), "JPEG")
+
+        def passthrough():
+            store = ImageStore(os.path.join(directory, "store"))
+            for _ in range(count):
+                temp_path, _ = uploads.spool_to_disk(BytesIO(jpeg), store.root)
+                key, _, _, _ = uploads.store_image(temp_path, store)
+                os.remove(store.path(key)) # Otherwise every later upload is deduplicated
+
+        seconds, _ = best_time(reencode)
+        report("Image.open + save('JPEG')", seconds, count)
+        seconds, _ = best_time(passthrough)
+        report("spool_to_disk + store_image", seconds, count)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("name", nargs="?", help="benchmark to run")
+    parser.add_argument("--list", action="store_true", help="list the available benchmarks")
+    parser.add_argument("--count", type=int, help="number of items to process")
+    args = parser.parse_args()
+
+    if args.list or not args.name:
+        for name, function in BENCHMARKS.items():
+            print(f"{name:<16} {function.__doc__}")
+        return
+    if args.name not in BENCHMARKS:
+        parser.error(f"unknown benchmark '{args.name}'")
+    BENCHMARKS[args.name](args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""
+Response cache for the dashboard's JSON endpoints.
+
+Between two readings every dashboard user gets byte-identical JSON, so the
+serialized body is kept, gzip-compressed, under a key made of the endpoint,
+its query parameters and the data version of what it shows: the tray's
+version for per-tray views, the global version for fleet-wide ones. A new
+reading changes the version, so a stale entry can never be served, even when
+the reading was stored by another process; invalidate() additionally frees
+the entries of the trays that changed as soon as this process stores one.
+
+Each entry has an ETag. A client sending it back in If-None-Match gets a 304
+without a body; otherwise the compressed body is sent as is to clients that
+accept gzip. Where entries are kept, and so whether gunicorn workers share
+them, is up to the cache backend.
+"""
+import gzip
+import hashlib
+import threading
+from collections import defaultdict
+from functools import wraps
+
+from flask import Response, make_response, request
+
+from cache_backends import DEFAULT_MAX_BYTES, MemoryBackend
+
+DEFAULT_COMPRESS_LEVEL = 6
+ETAG_LENGTH = 40 # Hex SHA-1, stored in front of the compressed body
+
+
+class CachedResponse:
+    """One serialized JSON body, stored gzip-compressed, with its ETag."""
+
+    def __init__(self, body, scope=None, compress_level=DEFAULT_COMPRESS_LEVEL):
+        self.etag = hashlib.sha1(body).hexdigest()
+        self.compressed = gzip.compress(body, compress_level, mtime=0)
+        self.scope = scope # Tray number, or None for views over every tray
+
+    def to_bytes(self):
+        return self.etag.encode() + self.compressed
+
+    @classmethod
+    def from_bytes(cls, value):
+        entry = cls.__new__(cls)
+        entry.etag, entry.compressed, entry.scope = value[:ETAG_LENGTH].decode(), value[ETAG_LENGTH:], None
+        return entry
+
+    def response(self):
+        """The entry as a response to the current request: 304, gzip or plain."""
+        if request.if_none_match.contains_weak(self.etag):
+            response = Response(status=304)
+        elif "gzip" in request.accept_encodings:
+            response = Response(self.compressed, mimetype="application/json")
+            response.headers["Content-Encoding"] = "gzip"
+        else:
+            response = Response(gzip.decompress(self.compressed), mimetype="application/json")
+        # Weak, because the same ETag covers the gzip and the plain encoding
+        response.set_etag(self.etag, weak=True)
+        response.headers["Cache-Control"] = "private, no-cache"
+        response.vary.add("Accept-Encoding")
+        return response
+
+
+class ResponseCache:
+    """
+    CachedResponse entries stored in a cache backend (see cache_backends.py).
+    Hit, miss and 304 counts are this process's; the backend's own stats are
+    reported alongside them.
+    """
+
+    def __init__(self, backend=None, compress_level=DEFAULT_COMPRESS_LEVEL, ttl=None):
+        self.backend = backend if backend is not None else MemoryBackend(DEFAULT_MAX_BYTES)
+        self.compress_level = compress_level
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._scopes = defaultdict(set) # scope -> keys this process stored for it
+        self._stats = {"hits": 0, "misses": 0, "not_modified": 0, "invalidations": 0}
+
+    @staticmethod
+    def key(version):
+        """Cache key of the current request for data at `version`."""
+        parts = (request.path, tuple(sorted(request.args.items(multi=True))), version)
+        return "response:" + hashlib.sha1(repr(parts).encode()).hexdigest()
+
+    def _count(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def get(self, key):
+        value = self.backend.get(key)
+        if value is None:
+            self._count("misses")
+            return None
+        self._count("hits")
+        return CachedResponse.from_bytes(value)
+
+    def put(self, key, body, scope=None):
+        """Stores a serialized body and returns its entry."""
+        entry = CachedResponse(body, scope, self.compress_level)
+        self.backend.set(key, entry.to_bytes(), self.ttl)
+        with self._lock:
+            self._scopes[scope].add(key)
+        return entry
+
+    def invalidate(self, trays):
+        """
+        Drops the entries this process stored for the given trays, and its
+        fleet-wide entries. Other processes' entries are keyed by the old data
+        version, so they are never served again and age out of the backend.
+        """
+        with self._lock:
+            stale = set(self._scopes.pop(None, ()))
+            for tray in set(trays):
+                stale |= self._scopes.pop(tray, set())
+            self._stats["invalidations"] += len(stale)
+        self.backend.delete(stale)
+
+    def clear(self):
+        with self._lock:
+            self._scopes.clear()
+        self.backend.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["backend"] = self.backend.stats()
+        return stats
+
+    def cached(self, version_of, scope_of=lambda **view_args: None):
+        """
+        Decorator for a JSON view. version_of(**view_args) returns the data
+        version the view would show and scope_of(**view_args) the tray it
+        belongs to (None for every tray). Only 200 responses are cached.
+        """
+        def decorator(view):
+            @wraps(view)
+            def wrapper(**view_args):
+                key = self.key(version_of(**view_args))
+                entry = self.get(key)
+                if entry is None:
+                    response = make_response(view(**view_args))
+                    if response.status_code != 200 or not response.is_json:
+                        return response
+                    entry = self.put(key, response.get_data(), scope_of(**view_args))
+                if request.if_none_match.contains_weak(entry.etag):
+                    self._count("not_modified")
+                return entry.response()
+            return wrapper
+        return decorator
@@ -0,0 +1,343 @@
+"""
+Byte-value key/value stores behind the response cache and the shared snapshot.
+
+Under gunicorn every worker is its own process, so an in-process cache is
+duplicated and cold in each of them. The backends share one interface
+(get, set, delete, clear, stats) and differ in who can see the entries:
+
+  * MemoryBackend: an LRU in this process, bounded by total bytes
+  * SQLiteBackend: a separate SQLite file shared by every worker on the host
+  * RedisBackend: any Redis-protocol server, shared by every host
+
+Entries are a cache, never the only copy of anything: a backend that fails
+(a locked file, an unreachable server) reports a miss and counts the error
+instead of failing the request. create_backend() picks one from the
+CACHE_BACKEND / CACHE_URL settings; `python cache_backends.py` runs the
+same checks against all three, using resp.StandInServer for Redis.
+"""
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from resp import RespClient, RespError
+from storage import BASE_DIR
+
+DEFAULT_MAX_BYTES = 32 * 1024 * 1024
+DEFAULT_SQLITE_PATH = os.path.join(BASE_DIR, "instance", "cache.db")
+BACKENDS = ("memory", "sqlite", "redis")
+
+
+class CacheBackend:
+    """Interface of the cache backends. Keys are strings, values bytes."""
+
+    name = None
+
+    def __init__(self):
+        self._stats_lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "sets": 0, "errors": 0}
+
+    def _count(self, key, amount=1):
+        with self._stats_lock:
+            self._stats[key] += amount
+
+    def get(self, key):
+        """Value stored under `key`, or None."""
+        raise NotImplementedError
+
+    def set(self, key, value, ttl=None):
+        """Stores `value`, expiring after `ttl` seconds if given."""
+        raise NotImplementedError
+
+    def delete(self, keys):
+        """Removes the given keys (missing ones are ignored)."""
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def stats(self):
+        with self._stats_lock:
+            return dict(self._stats, backend=self.name)
+
+
+class MemoryBackend(CacheBackend):
+    """Least-recently-used entries of this process, bounded by their total size."""
+
+    name = "memory"
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        super().__init__()
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict() # key -> (value, expires)
+        self.size = 0
+        self._stats["evictions"] = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] is not None and entry[1] <= time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self._count("misses")
+                return None
+            self._entries.move_to_end(key)
+        self._count("hits")
+        return entry[0]
+
+    def set(self, key, value, ttl=None):
+        if len(value) > self.max_bytes:
+            return
+        expires = time.monotonic() + ttl if ttl else None
+        evicted = 0
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (value, expires)
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                evicted += 1
+        self._count("sets")
+        if evicted:
+            self._count("evictions", evicted)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[0])
+
+    def delete(self, keys):
+        with self._lock:
+            for key in keys:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        stats = super().stats()
+        with self._lock:
+            stats.update(entries=len(self._entries), bytes=self.size, max_bytes=self.max_bytes)
+        return stats
+
+
+class SQLiteBackend(CacheBackend):
+    """
+    Entries in their own SQLite file, so every worker on the host shares them.
+    The file is separate from the monitoring database: cache traffic never
+    takes its write lock, and deleting the file only empties the cache.
+    """
+
+    name = "sqlite"
+    TRIM_EVERY = 64 # Sets between two checks of the total size
+    TOUCH_AFTER = 30.0 # Seconds before a read refreshes an entry's LRU time
+
+    def __init__(self, path=DEFAULT_SQLITE_PATH, max_bytes=DEFAULT_MAX_BYTES, timeout=1.0):
+        super().__init__()
+        self.path = path
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self._local = threading.local()
+        self._sets = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        connection = self._connection()
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS cache_entries ("
+            "key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, "
+            "expires REAL, used REAL NOT NULL)")
+        connection.execute("CREATE INDEX IF NOT EXISTS ix_cache_entries_used ON cache_entries (used)")
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            # Autocommit; losing the last writes on a crash only costs a few misses
+            connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None,
+                                         check_same_thread=False)
+            connection.execute("PRAGMA synchronous=OFF")
+            self._local.connection = connection
+        return connection
+
+    def get(self, key):
+        now = time.time()
+        try:
+            connection = self._connection()
+            row = connection.execute(
+                "SELECT value, expires, used FROM cache_entries WHERE key = ?", (key,)).fetchone()
+            if row is not None and row[1] is not None and row[1] <= now:
+                connection.execute("DELETE FROM cache_entries WHERE key = ?", (key,))
+                row = None
+            elif row is not None and now - row[2] > self.TOUCH_AFTER:
+                connection.execute("UPDATE cache_entries SET used = ? WHERE key = ?", (now, key))
+        except sqlite3.Error:
+            self._count("errors")
+            return None
+        self._count("hits" if row is not None else "misses")
+        return row[0] if row is not None else None
+
+    def set(self, key, value, ttl=None):
+        if len(value) > self.max_bytes:
+            return
+        now = time.time()
+        try:
+            self._connection().execute(
+                "INSERT OR REPLACE INTO cache_entries (key, value, size, expires, used) VALUES (?, ?, ?, ?, ?)",
+                (key, value, len(value), now + ttl if ttl else None, now))
+            self._count("sets")
+            with self._stats_lock:
+                self._sets += 1
+                trim = self._sets % self.TRIM_EVERY == 0
+            if trim:
+                self.trim()
+        except sqlite3.Error:
+            self._count("errors")
+
+    def trim(self):
+        """Drops expired entries, then the least recently used ones until under max_bytes."""
+        connection = self._connection()
+        connection.execute("DELETE FROM cache_entries WHERE expires <= ?", (time.time(),))
+        total = connection.execute("SELECT total(size) FROM cache_entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # Keep the most recently used entries that fit in 90% of the cap
+        connection.execute(
+            "DELETE FROM cache_entries WHERE key NOT IN ("
+            "SELECT key FROM (SELECT key, sum(size) OVER (ORDER BY used DESC) AS running "
+            "FROM cache_entries) WHERE running <= ?)", (self.max_bytes * 0.9,))
+
+    def delete(self, keys):
+        keys = list(keys)
+        if not keys:
+            return
+        try:
+            self._connection().executemany("DELETE FROM cache_entries WHERE key = ?", [(key,) for key in keys])
+        except sqlite3.Error:
+            self._count("errors")
+
+    def clear(self):
+        self._connection().execute("DELETE FROM cache_entries")
+
+    def stats(self):
+        stats = super().stats()
+        try:
+            entries, size = self._connection().execute(
+                "SELECT count(*), total(size) FROM cache_entries").fetchone()
+            stats.update(entries=entries, bytes=int(size), max_bytes=self.max_bytes, path=self.path)
+        except sqlite3.Error:
+            pass
+        return stats
+
+
+class RedisBackend(CacheBackend):
+    """
+    Entries on a Redis-protocol server. Memory limits and eviction are the
+    server's (maxmemory / maxmemory-policy); entries are written with the
+    default TTL so a server without an eviction policy does not fill up.
+    """
+
+    name = "redis"
+
+    def __init__(self, url="redis://localhost:6379/0", prefix="bsf:", default_ttl=3600, timeout=2.0):
+        super().__init__()
+        self.url = url
+        self.prefix = prefix
+        self.default_ttl = default_ttl
+        self.client = RespClient(url, timeout)
+
+    def _execute(self, *args):
+        try:
+            return self.client.execute(*args)
+        except (OSError, ConnectionError, RespError) as e:
+            self._count("errors")
+            print(f"Cache server error ({self.url}): {e}")
+            return None
+
+    def get(self, key):
+        value = self._execute("GET", self.prefix + key)
+        self._count("hits" if value is not None else "misses")
+        return value
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl or self.default_ttl
+        args = ("SET", self.prefix + key, value) + (("PX", int(ttl * 1000)) if ttl else ())
+        if self._execute(*args) is not None:
+            self._count("sets")
+
+    def delete(self, keys):
+        keys = [self.prefix + key for key in keys]
+        if keys:
+            self._execute("DEL", *keys)
+
+    def clear(self):
+        # FLUSHDB would also drop other applications' keys; entries expire on their own
+        pass
+
+    def stats(self):
+        stats = super().stats()
+        stats["url"] = self.url
+        return stats
+
+
+def create_backend(name="memory", url=None, max_bytes=DEFAULT_MAX_BYTES):
+    """
+    Backend named by the CACHE_BACKEND setting. `url` is the SQLite file for
+    "sqlite" and a redis://host:port/db URL for "redis".
+    """
+    if name == "memory":
+        return MemoryBackend(max_bytes)
+    if name == "sqlite":
+        return SQLiteBackend(url or DEFAULT_SQLITE_PATH, max_bytes)
+    if name == "redis":
+        return RedisBackend(url or "redis://localhost:6379/0")
+    raise ValueError(f"unknown cache backend '{name}' (expected one of {', '.join(BACKENDS)})")
+
+
+def check_backend(backend):
+    """
+    Exercises the backend contract: round trips, misses, overwrites, deletes
+    and expiry. Returns a list of failure messages (empty when all pass).
+    """
+    failures = []
+
+    def expect(label, actual, expected):
+        if actual != expected:
+            failures.append(f"{backend.name}: {label}: expected {expected!r}, got {actual!r}")
+
+    backend.clear()
+    value = bytes(range(256)) * 4 # Every byte value, including CR and LF
+    backend.set("check:a", value)
+    expect("round trip", backend.get("check:a"), value)
+    expect("missing key", backend.get("check:missing"), None)
+    backend.set("check:a", b"second")
+    expect("overwrite", backend.get("check:a"), b"second")
+    backend.set("check:b", b"")
+    expect("empty value", backend.get("check:b"), b"")
+    backend.delete(["check:a", "check:b", "check:missing"])
+    expect("delete", (backend.get("check:a"), backend.get("check:b")), (None, None))
+    backend.set("check:ttl", b"short", ttl=0.05)
+    time.sleep(0.1)
+    expect("expiry", backend.get("check:ttl"), None)
+    return failures
+
+
+if __name__ == "__main__":
+    from resp import StandInServer
+
+    server = StandInServer().start()
+    with tempfile.TemporaryDirectory() as directory:
+        backends = [MemoryBackend(), SQLiteBackend(os.path.join(directory, "cache.db")), RedisBackend(server.url)]
+        failures = []
+        for backend in backends:
+            problems = check_backend(backend)
+            print(f"{backend.name:<8} {'ok' if not problems else 'FAILED'}")
+            failures += problems
+    server.stop()
+    for failure in failures:
+        print(failure)
+    raise SystemExit(1 if failures else 0)
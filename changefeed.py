@@ -0,0 +1,116 @@
+"""
+Follows larvae_data for readings stored by any process.
+
+Once ingestion runs in its own process (or in another gunicorn worker), a
+web process no longer sees the readings it did not write itself: its tray
+snapshot, response cache and live streams would go stale. ReadingFeed polls
+larvae_data for rows above the highest id it has handed on and passes every
+new page to a callback, so all web processes announce the same readings,
+whoever stored them. Local writers call wake() to have their rows picked up
+at once instead of at the next poll.
+"""
+import threading
+import time
+
+from sqlalchemy import func, select
+
+DEFAULT_POLL_INTERVAL = 0.5
+DEFAULT_PAGE_SIZE = 1000
+
+
+class ReadingFeed:
+    """
+    Background poller passing newly stored larvae_data rows to `on_rows`, in
+    id order and in pages of at most `page_size`. `read` is a context
+    manager factory yielding a connection (DataAccess.read).
+    """
+
+    def __init__(self, read, larvae, on_rows, poll_interval=DEFAULT_POLL_INTERVAL,
+                 page_size=DEFAULT_PAGE_SIZE, name="reading-feed"):
+        self.read = read
+        self.larvae = larvae
+        self.on_rows = on_rows
+        self.poll_interval = poll_interval
+        self.page_size = page_size
+        self.name = name
+        self.cursor = None
+        self._poll_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._stats = {"polls": 0, "rows": 0, "errors": 0}
+
+    def start(self, cursor=None):
+        """
+        Starts following rows above `cursor` (default: the current highest id,
+        i.e. only rows stored from now on).
+        """
+        if self.cursor is None:
+            if cursor is None:
+                with self.read() as connection:
+                    cursor = connection.execute(select(func.coalesce(func.max(self.larvae.c.id), 0))).scalar()
+            self.cursor = cursor
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=5.0):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def wake(self):
+        """Polls now rather than at the next interval (after a local write)."""
+        self._wake.set()
+
+    def catch_up(self, version):
+        """
+        Polls synchronously if rows up to `version` have not been handed on
+        yet, so a response built for that version sees them.
+        """
+        if self.cursor is not None and version > self.cursor:
+            self.poll()
+
+    def poll(self):
+        """Hands on every row above the cursor. Returns the number of rows."""
+        handed_on = 0
+        with self._poll_lock:
+            if self.cursor is None:
+                return 0
+            while True:
+                with self.read() as connection:
+                    rows = connection.execute(
+                        select(self.larvae).where(self.larvae.c.id > self.cursor)
+                        .order_by(self.larvae.c.id).limit(self.page_size)
+                    ).mappings().all()
+                self._stats["polls"] += 1
+                if not rows:
+                    break
+                rows = [dict(row) for row in rows]
+                self.on_rows(rows)
+                self.cursor = rows[-1]["id"]
+                handed_on += len(rows)
+                self._stats["rows"] += len(rows)
+                if len(rows) < self.page_size:
+                    break
+        return handed_on
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+            if self._stop.is_set():
+                break
+            try:
+                self.poll()
+            except Exception as e:
+                self._stats["errors"] += 1
+                print(f"Reading feed poll failed: {e}")
+                time.sleep(self.poll_interval)
+
+    def stats(self):
+        return dict(self._stats, cursor=self.cursor, poll_interval=self.poll_interval,
+                    running=self._thread is not None and self._thread.is_alive())
@@ -0,0 +1,216 @@
+"""
+Wire formats for sensor readings: JSON, a fixed struct layout and MessagePack.
+
+Old devices keep publishing JSON on MQTT_TOPIC, with any picture base64
+encoded inside it. Newer ones can publish on MQTT_TOPIC + "/struct" or
+"/msgpack" (or POST with the matching Content-Type) and send the picture
+as raw bytes.
+
+The struct layout is little-endian, a 42-byte header followed by the
+picture and then an optional UTF-8 JSON object of annotations
+(bounding_boxes, masks):
+
+    offset  size  field
+    0       1     magic 0xC1 (a byte never valid in JSON, UTF-8 or MessagePack)
+    1       1     layout version (1)
+    2       4     tray_number      uint32
+    6       16    length, width, area, weight   float32 each
+    22      4     count            uint32
+    26      8     timestamp        float64 seconds since the epoch (UTC), 0 = not set
+    34      4     image size       uint32, bytes of picture after the header
+    38      4     annotations size uint32, bytes of JSON after the picture
+
+The float32 measurements are rounded to 4 decimal places when decoded.
+
+A MessagePack payload is a map with the same keys as the JSON one, except
+that the picture is a binary "image" value. MessagePack needs the optional
+msgpack package; without it those messages are rejected.
+"""
+import base64
+import json
+import struct
+from datetime import datetime, timezone
+
+from ingest import READING_SCHEMA, loads, parse_reading
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+STRUCT_MAGIC = 0xC1
+STRUCT_VERSION = 1
+STRUCT_HEADER = struct.Struct("<BBIffffIdII")
+FORMATS = ("json", "struct", "msgpack")
+CONTENT_TYPES = {
+    "application/json": "json",
+    "application/x-bsf-reading": "struct",
+    "application/msgpack": "msgpack",
+    "application/x-msgpack": "msgpack",
+    "application/vnd.msgpack": "msgpack",
+}
+_MSGPACK_TRAY_KEY = b"\xabtray_number" # fixstr of length 11
+
+
+def format_for_topic(topic, base_topic):
+    """Format of a message on `base_topic` or one of its /struct, /msgpack, /json subtopics (None otherwise)."""
+    if topic == base_topic:
+        return "json"
+    prefix = base_topic + "/"
+    if topic.startswith(prefix) and topic[len(prefix):] in FORMATS:
+        return topic[len(prefix):]
+    return None
+
+
+def format_for_content_type(mimetype):
+    """Format of an HTTP body by its mimetype; anything unknown is treated as JSON."""
+    return CONTENT_TYPES.get(mimetype, "json")
+
+
+def sniff_format(payload):
+    """Format of a payload recognised by its first byte (struct magic, MessagePack map, else JSON)."""
+    first = payload[0] if payload else 0
+    if first == STRUCT_MAGIC:
+        return "struct"
+    if 0x80 <= first <= 0x8F or first in (0xDE, 0xDF):
+        return "msgpack"
+    return "json"
+
+
+def decode_message(payload, fmt="json", received_at=None, tray_number=None):
+    """
+    Decodes a reading in the given format. Returns (row, attachments): the
+    larvae_data row, validated as by ingest.parse_reading, and a dict holding
+    the raw picture bytes ("image", None without one) and "bounding_boxes" /
+    "masks" when sent. `tray_number`, when given (from the topic), fills in a
+    missing tray number and must match a present one. Raises ValueError for
+    anything malformed.
+    """
+    if fmt == "struct":
+        row, attachments = decode_struct(payload, received_at)
+        _check_tray(row, tray_number)
+        return row, attachments
+    if fmt == "msgpack":
+        if msgpack is None:
+            raise ValueError("MessagePack payloads need the msgpack package")
+        try:
+            data = msgpack.unpackb(payload, raw=False)
+        except Exception as e:
+            raise ValueError(f"invalid MessagePack: {e}")
+        row = _parse(data, received_at, tray_number)
+        return row, _attachments(data, data.get("image"))
+    try:
+        data = loads(payload)
+    except ValueError as e:
+        raise ValueError(f"invalid JSON: {e}")
+    row = _parse(data, received_at, tray_number)
+    image = data.get("image_data_base64")
+    try:
+        image = base64.b64decode(image) if image else None
+    except (TypeError, ValueError):
+        raise ValueError("image_data_base64 is not valid base64")
+    return row, _attachments(data, image)
+
+
+def _parse(data, received_at, tray_number):
+    if tray_number is not None and isinstance(data, dict):
+        data.setdefault("tray_number", tray_number)
+    row = parse_reading(data, received_at)
+    _check_tray(row, tray_number)
+    return row
+
+
+def _check_tray(row, tray_number):
+    if tray_number is not None and row["tray_number"] != tray_number:
+        raise ValueError(f"tray_number {row['tray_number']} does not match the topic's tray {tray_number}")
+
+
+def _attachments(data, image):
+    return {"image": image or None, "bounding_boxes": data.get("bounding_boxes"), "masks": data.get("masks")}
+
+
+def decode_struct(payload, received_at=None):
+    """Decodes the fixed struct layout (see the module docstring)."""
+    if len(payload) < STRUCT_HEADER.size:
+        raise ValueError(f"struct payload shorter than its {STRUCT_HEADER.size}-byte header")
+    magic, version, tray, length, width, area, weight, count, timestamp, image_size, annotations_size = \
+        STRUCT_HEADER.unpack_from(payload)
+    if magic != STRUCT_MAGIC or version != STRUCT_VERSION:
+        raise ValueError(f"unknown struct layout (magic {magic:#x}, version {version})")
+    image_end = STRUCT_HEADER.size + image_size
+    if len(payload) != image_end + annotations_size:
+        raise ValueError("struct payload size does not match its header")
+
+    if received_at is None:
+        if not timestamp:
+            raise ValueError("missing fields: timestamp")
+        received_at = datetime.fromtimestamp(timestamp, timezone.utc).replace(tzinfo=None)
+    # float32 carries ~7 significant digits; rounding drops the noise of widening it (12.3 -> 12.300000190...)
+    # Checked by parse_reading like the other formats, since a float32 can hold NaN or infinity
+    row = parse_reading({"tray_number": tray, "length": round(length, 4), "width": round(width, 4),
+                         "area": round(area, 4), "weight": round(weight, 4), "count": count}, received_at)
+
+    annotations = {}
+    if annotations_size:
+        try:
+            annotations = json.loads(bytes(payload[image_end:]))
+        except ValueError as e:
+            raise ValueError(f"invalid annotations JSON: {e}")
+    image = bytes(payload[STRUCT_HEADER.size:image_end]) if image_size else None
+    return row, _attachments(annotations, image)
+
+
+def encode_struct(reading, image=None, annotations=None):
+    """
+    Encodes a reading (a dict with the larvae_data fields; a datetime
+    timestamp is optional) in the struct layout, for publishers and tests.
+    """
+    timestamp = reading.get("timestamp")
+    if isinstance(timestamp, datetime):
+        timestamp = timestamp.replace(tzinfo=timezone.utc).timestamp()
+    image = image or b""
+    annotations = json.dumps(annotations, separators=(",", ":")).encode() if annotations else b""
+    header = STRUCT_HEADER.pack(
+        STRUCT_MAGIC, STRUCT_VERSION, reading["tray_number"], reading["length"], reading["width"],
+        reading["area"], reading["weight"], reading["count"], timestamp or 0.0, len(image), len(annotations))
+    return header + image + annotations
+
+
+def encode_msgpack(reading, image=None, annotations=None):
+    """Encodes a reading as a MessagePack map (needs the msgpack package)."""
+    data = {field: reading[field] for field, _ in READING_SCHEMA}
+    timestamp = reading.get("timestamp")
+    if timestamp is not None:
+        data["timestamp"] = timestamp.isoformat() if isinstance(timestamp, datetime) else timestamp
+    if image:
+        data["image"] = image
+    data.update(annotations or {})
+    return msgpack.packb(data)
+
+
+def peek_tray(payload):
+    """
+    Tray number of a struct or MessagePack payload read without decoding it,
+    or None (including for JSON, see consumer.tray_key).
+    """
+    if payload[:1] == bytes((STRUCT_MAGIC,)):
+        if len(payload) >= 6:
+            return struct.unpack_from("<I", payload, 2)[0]
+        return None
+    if sniff_format(payload) != "msgpack":
+        return None
+    start = payload.find(_MSGPACK_TRAY_KEY)
+    if start < 0:
+        return None
+    position = start + len(_MSGPACK_TRAY_KEY)
+    marker = payload[position:position + 1]
+    if not marker:
+        return None
+    if marker[0] < 0x80:
+        return marker[0]
+    sizes = {0xCC: ">B", 0xCD: ">H", 0xCE: ">I", 0xCF: ">Q", 0xD0: ">b", 0xD1: ">h", 0xD2: ">i", 0xD3: ">q"}
+    if marker[0] in sizes:
+        layout = struct.Struct(sizes[marker[0]])
+        if len(payload) >= position + 1 + layout.size:
+            return layout.unpack_from(payload, position + 1)[0]
+    return None
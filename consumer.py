@@ -0,0 +1,143 @@
+"""
+Parallel MQTT message consumer, sharded by tray.
+
+paho runs every on_message callback on its single network thread, so
+decoding a large image message there delays the messages of every other
+tray. ShardedConsumer hands raw messages to a fixed set of worker threads
+instead. The shard is chosen from the message's tray number, so one tray's
+messages are always handled by the same worker, in arrival order, while
+different trays are handled in parallel.
+
+The tray number is found without decoding the payload: at its fixed offset
+in the struct format, and with a byte-level search in JSON and MessagePack
+(base64 image data never contains a quote character, so it cannot fool the
+JSON search). Messages without a recognisable tray number all go to shard 0.
+"""
+import queue
+import re
+import threading
+import time
+import zlib
+
+from codec import peek_tray
+from dal import WaitStats
+
+DEFAULT_SHARDS = 4
+DEFAULT_SHARD_QUEUE_SIZE = 1000
+TRAY_NUMBER = re.compile(rb'"tray_number"\s*:\s*"?(-?\w+)')
+
+
+def tray_key(payload):
+    """Tray number of a raw JSON, struct or MessagePack payload as bytes, or None if it has none."""
+    tray = peek_tray(payload)
+    if tray is not None:
+        return str(tray).encode()
+    match = TRAY_NUMBER.search(payload)
+    return match.group(1) if match else None
+
+
+def shard_for(key, shards):
+    """Shard index of a tray key; numeric keys map tray N to shard N % shards."""
+    if key is None:
+        return 0
+    try:
+        return int(key) % shards
+    except ValueError:
+        return zlib.crc32(key) % shards
+
+
+class Shard:
+    """One worker thread with its own bounded queue and timings."""
+
+    def __init__(self, index, handler, max_queue, name="mqtt-shard"):
+        self.index = index
+        self.name = name
+        self.handler = handler
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stats = {"processed": 0, "failed": 0, "dropped": 0}
+        self.queue_wait = WaitStats()
+        self.processing = WaitStats()
+
+    def _count(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def offer(self, message):
+        try:
+            self._queue.put_nowait((message, time.perf_counter()))
+            return True
+        except queue.Full:
+            self._count("dropped")
+            return False
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name=f"{self.name}-{self.index}", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout):
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            message, queued_at = job
+            started = time.perf_counter()
+            self.queue_wait.record(started - queued_at)
+            try:
+                self.handler(*message)
+                self._count("processed")
+            except Exception as e:
+                print(f"{self.name} {self.index} failed to handle a message: {e}")
+                self._count("failed")
+            self.processing.record(time.perf_counter() - started)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats.update(shard=self.index, queue_depth=self._queue.qsize(), queue_max=self._queue.maxsize,
+                     queue_wait=self.queue_wait.as_dict(), processing=self.processing.as_dict())
+        return stats
+
+
+class ShardedConsumer:
+    """
+    Dispatches (topic, payload) messages to `shards` worker threads, each
+    calling handler(topic, payload). submit() never blocks: when the tray's
+    shard queue is full the message is dropped and counted. A caller that
+    already knows the tray (from the topic) passes it as `key`.
+    """
+
+    def __init__(self, handler, shards=DEFAULT_SHARDS, max_queue=DEFAULT_SHARD_QUEUE_SIZE, name="mqtt-shard"):
+        self.shards = [Shard(index, handler, max_queue, name) for index in range(max(1, shards))]
+
+    def submit(self, topic, payload, key=None):
+        if key is None:
+            key = tray_key(payload)
+        shard = self.shards[shard_for(key, len(self.shards))]
+        return shard.offer((topic, payload))
+
+    def start(self):
+        for shard in self.shards:
+            shard.start()
+        return self
+
+    def stop(self, timeout=5.0):
+        """Handles the messages already queued, then stops the workers."""
+        for shard in self.shards:
+            shard.stop(timeout)
+
+    def stats(self):
+        shards = [shard.stats() for shard in self.shards]
+        return {
+            "shards": shards,
+            "queue_depth": sum(shard["queue_depth"] for shard in shards),
+            "processed": sum(shard["processed"] for shard in shards),
+            "dropped": sum(shard["dropped"] for shard in shards),
+        }
@@ -1,4 +1,5 @@
 from app import app, db, LarvaeData, User
+from migrations import run_migrations
 import random
 from datetime import datetime, timedelta
 from werkzeug.security import generate_password_hash
@@ -11,6 +12,7 @@ with app.app_context():
     # Create all database tables based on the models defined in app.py
     print("Creating database tables...")
     db.create_all()
+    run_migrations(db.engine)
     print("Database tables created successfully!")
 
     # Check if any users exist. If not, create a default admin user.
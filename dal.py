@@ -0,0 +1,237 @@
+"""
+Data-access layer: one serialized writer and a pool of read-only connections.
+
+SQLite lets a single connection write at a time. When request threads, the
+MQTT ingest thread and the web app's sessions all write through a shared
+pool they queue on SQLite's lock in no particular order, and a reader that
+upgrades to a writer can fail outright. Here every write is a job run on one
+writer thread that owns the only read-write connection; callers get a Future
+(or block on it). GET endpoints read through a separate pool of read-only
+connections, which in WAL mode never wait for the writer.
+
+Both halves time their waits: how long write jobs sat in the queue, how long
+BEGIN IMMEDIATE waited for SQLite's write lock (held by another process such
+as the standalone subscriber) and how long readers waited for a pooled
+connection. stats() reports them.
+"""
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+from storage import DATABASE_PATH, create_storage_engine
+
+STOP_POLL_INTERVAL = 0.5 # Seconds an idle writer waits before checking whether it was stopped
+
+
+class WriterBusy(Exception):
+    """Raised when the write queue stays full for longer than the caller will wait."""
+
+
+class WaitStats:
+    """Thread-safe count, total and maximum of a series of wait times."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        with self._lock:
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                "count": self.count,
+                "avg_ms": round(self.total / self.count * 1000, 3) if self.count else 0.0,
+                "max_ms": round(self.max * 1000, 3),
+                "total_ms": round(self.total * 1000, 3),
+            }
+
+
+class SerializedWriter:
+    """
+    Runs write jobs one at a time on a dedicated thread. A job is a function
+    called as function(connection, *args) inside its own transaction, which
+    starts with BEGIN IMMEDIATE so the write lock is taken up front.
+    """
+
+    def __init__(self, engine, max_queue=1000, write_timeout=30.0, name="db-writer"):
+        self.engine = engine
+        self.name = name
+        self.write_timeout = write_timeout
+        self._jobs = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        self._stats = {"completed": 0, "failed": 0}
+        self.queue_wait = WaitStats()
+        self.lock_wait = WaitStats()
+
+        # Let SQLAlchemy's begin event issue the BEGIN instead of the driver
+        event.listen(engine, "connect", self._disable_driver_transactions)
+        event.listen(engine, "begin", self._begin_immediate)
+
+    @staticmethod
+    def _disable_driver_transactions(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    def _begin_immediate(self, connection):
+        started = time.perf_counter()
+        connection.exec_driver_sql("BEGIN IMMEDIATE")
+        self.lock_wait.record(time.perf_counter() - started)
+
+    @property
+    def queue_depth(self):
+        return self._jobs.qsize()
+
+    def submit(self, function, *args, timeout=5.0):
+        """
+        Queues function(connection, *args) and returns a Future for its result.
+        Raises WriterBusy if the queue is still full after `timeout` seconds.
+        """
+        if self._thread is None or not self._thread.is_alive() or self._stopping.is_set():
+            raise RuntimeError(f"{self.name} is not running")
+        future = Future()
+        try:
+            self._jobs.put((function, args, future, time.perf_counter()), timeout=timeout)
+        except queue.Full:
+            raise WriterBusy(f"{self.name} queue is full")
+        return future
+
+    def write(self, function, *args, timeout=None):
+        """
+        Runs a write job and waits for its result (re-raising its exception), at
+        most `timeout` seconds (write_timeout by default) once it is queued.
+        Raises WriterBusy when that runs out: a job still queued is cancelled,
+        one already running is left to finish.
+        """
+        future = self.submit(function, *args)
+        try:
+            return future.result(self.write_timeout if timeout is None else timeout)
+        except FutureTimeout:
+            state = "cancelled" if future.cancel() else "still running"
+            raise WriterBusy(f"{self.name} did not finish the write in time ({state})")
+
+    def start(self):
+        """Starts the writer thread if it is not already running."""
+        if self._thread is None or not self._thread.is_alive():
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=5.0):
+        """
+        Refuses new jobs and stops the writer thread once the queued ones are
+        done, waiting for it at most `timeout` seconds.
+        """
+        if self._thread is not None and self._thread.is_alive():
+            self._stopping.set()
+            try:
+                self._jobs.put_nowait(None) # Wakes an idle writer; a full queue is drained first anyway
+            except queue.Full:
+                pass
+            self._thread.join(timeout)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["queue_depth"] = self.queue_depth
+        stats["queue_max"] = self._jobs.maxsize
+        stats["queue_wait"] = self.queue_wait.as_dict()
+        stats["lock_wait"] = self.lock_wait.as_dict()
+        return stats
+
+    def _count(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def _run(self):
+        with self.engine.connect() as connection:
+            while True:
+                try:
+                    job = self._jobs.get(timeout=STOP_POLL_INTERVAL)
+                except queue.Empty:
+                    if self._stopping.is_set():
+                        break
+                    continue
+                if job is None:
+                    break
+                function, args, future, queued_at = job
+                self.queue_wait.record(time.perf_counter() - queued_at)
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    with connection.begin():
+                        result = function(connection, *args)
+                except BaseException as e:
+                    self._count("failed")
+                    future.set_exception(e)
+                else:
+                    self._count("completed")
+                    future.set_result(result)
+
+
+class ReadPool:
+    """Pool of read-only connections that records how long checkouts wait."""
+
+    def __init__(self, engine, size):
+        self.engine = engine
+        self.size = size
+        self.checkout_wait = WaitStats()
+
+    @contextmanager
+    def connection(self):
+        started = time.perf_counter()
+        with self.engine.connect() as connection:
+            self.checkout_wait.record(time.perf_counter() - started)
+            yield connection
+
+    def stats(self):
+        return {
+            "pool_size": self.size,
+            "checked_out": self.engine.pool.checkedout(),
+            "checkout_wait": self.checkout_wait.as_dict(),
+        }
+
+
+class DataAccess:
+    """The writer and the read pool for one database file."""
+
+    def __init__(self, path=DATABASE_PATH, read_pool_size=4, read_pool_timeout=10, write_queue_max=1000,
+                 write_timeout=30):
+        self.writer = SerializedWriter(create_storage_engine(path, pool_size=1, max_overflow=0),
+                                       max_queue=write_queue_max, write_timeout=write_timeout)
+        self.readers = ReadPool(create_storage_engine(path, read_only=True, pool_size=read_pool_size,
+                                                      max_overflow=0, pool_timeout=read_pool_timeout),
+                                read_pool_size)
+
+    @property
+    def read_engine(self):
+        return self.readers.engine
+
+    def read(self):
+        """Context manager yielding a read-only connection from the pool."""
+        return self.readers.connection()
+
+    def write(self, function, *args):
+        """Runs function(connection, *args) on the writer thread and returns its result."""
+        return self.writer.write(function, *args)
+
+    def start(self):
+        self.writer.start()
+        return self
+
+    def stop(self):
+        self.writer.stop()
+
+    def stats(self):
+        return {"writer": self.writer.stats(), "readers": self.readers.stats()}
@@ -0,0 +1,159 @@
+"""
+Downscaled variants of stored pictures for the evidence gallery.
+
+A gallery tile needs a few hundred pixels, but every stored picture is a
+full camera frame. DerivativePipeline renders a "thumb" and a "medium"
+variant of each new picture on a process pool, so resizing never competes
+with request threads for the GIL. A variant that does not exist yet (older
+pictures, a busy pool, a crash) is rendered on its first request instead and
+kept on disk. Variant paths are derived from the original's name, so nothing
+about them is stored in the database.
+"""
+import multiprocessing
+import os
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, features
+
+VARIANTS = {"thumb": 320, "medium": 1280} # Longest edge in pixels
+FORMATS = {
+    "jpeg": (".jpg", "JPEG", "image/jpeg"),
+    "webp": (".webp", "WEBP", "image/webp"),
+}
+DEFAULT_WORKERS = 2
+DEFAULT_MAX_PENDING = 200
+QUALITY = 80
+
+
+def image_size(source):
+    """(width, height) of a picture file or file object from its header alone, or (None, None)."""
+    try:
+        with Image.open(source) as img:
+            return img.size
+    except (OSError, ValueError):
+        return None, None
+
+
+def variant_size(width, height, variant):
+    """Size of a variant of a width x height picture (pictures are never scaled up)."""
+    scale = min(1.0, VARIANTS[variant] / max(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def render(original, target, max_edge, image_format, quality=QUALITY):
+    """
+    Writes `original` scaled down to fit max_edge x max_edge to `target`.
+    Runs in pool processes, so it only takes picklable arguments.
+    """
+    with Image.open(original) as img:
+        img.draft("RGB", (max_edge, max_edge)) # JPEG decodes straight at 1/2, 1/4 or 1/8 scale
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        img.thumbnail((max_edge, max_edge))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(target), prefix=".derived-", suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                img.save(f, image_format, quality=quality)
+            os.replace(temp_path, target)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+    return target
+
+
+class DerivativePipeline:
+    """
+    Renders VARIANTS of pictures stored in `directory` into
+    <directory>/derived/<variant>/. submit() queues every variant of a new
+    picture on the process pool (skipped when `max_pending` renders are
+    already queued); ensure() returns a variant's path, rendering it first if
+    needed. With workers=0 nothing is rendered in the background.
+    """
+
+    def __init__(self, directory, workers=DEFAULT_WORKERS, image_format="jpeg", max_pending=DEFAULT_MAX_PENDING):
+        if image_format == "webp" and not features.check("webp"):
+            print("Pillow was built without WebP support; image variants are stored as JPEG")
+            image_format = "jpeg"
+        self.directory = directory
+        self.workers = workers
+        self.image_format = image_format
+        self.extension, self.pil_format, self.mimetype = FORMATS[image_format]
+        self.max_pending = max_pending
+        self._pool = None
+        self._lock = threading.Lock()
+        self._pending = {} # target path -> Future
+        self._stats = {"queued": 0, "rendered": 0, "on_request": 0, "skipped": 0, "failed": 0}
+
+    def path(self, original, variant):
+        """Variant path mirroring the original's path below `directory` (so sharded stores stay sharded)."""
+        stem = os.path.splitext(os.path.relpath(original, self.directory))[0]
+        return os.path.join(self.directory, "derived", variant, stem + self.extension)
+
+    def _count(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def _executor(self):
+        if self._pool is None and self.workers > 0:
+            # spawn: forking a process that runs writer and consumer threads could copy held locks
+            self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._pool
+
+    def submit(self, original):
+        """Queues the variants of a newly stored picture that do not exist yet."""
+        if self.workers <= 0:
+            return
+        for variant, max_edge in VARIANTS.items():
+            target = self.path(original, variant)
+            with self._lock:
+                if target in self._pending or os.path.exists(target):
+                    continue
+                if len(self._pending) >= self.max_pending:
+                    self._stats["skipped"] += 1 # Rendered on first request instead
+                    continue
+                future = self._executor().submit(render, original, target, max_edge, self.pil_format)
+                self._pending[target] = future
+                self._stats["queued"] += 1
+            future.add_done_callback(lambda future, target=target: self._finished(target, future))
+
+    def _finished(self, target, future):
+        with self._lock:
+            self._pending.pop(target, None)
+        error = future.exception()
+        if error is not None:
+            print(f"Rendering {target} failed: {error}")
+        self._count("failed" if error is not None else "rendered")
+
+    def ensure(self, original, variant):
+        """Path of a variant of `original`, rendering it now if it does not exist yet."""
+        target = self.path(original, variant)
+        if os.path.exists(target):
+            return target
+        with self._lock:
+            future = self._pending.get(target)
+        if future is not None:
+            future.result() # Already being rendered in the background
+            return target
+        render(original, target, VARIANTS[variant], self.pil_format)
+        self._count("on_request")
+        return target
+
+    def stop(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, pending=len(self._pending), workers=self.workers, format=self.image_format)
+
+    def srcset(self, url_for_variant, original_url, width, height):
+        """A srcset value listing every variant and the original with their widths."""
+        if not width or not height:
+            return None
+        candidates = [f"{url_for_variant(variant)} {variant_size(width, height, variant)[0]}w"
+                      for variant, max_edge in VARIANTS.items() if max(width, height) > max_edge]
+        return ", ".join(candidates + [f"{original_url} {width}w"])
@@ -0,0 +1,167 @@
+"""
+In-process publish/subscribe hub for live tray updates.
+
+The ingest paths publish every stored reading to an EventHub, and each
+/stream/trays client holds a Subscription: a bounded queue of events,
+optionally limited to some trays. stream() turns a subscription into a
+Server-Sent Events body with periodic keep-alive comments so proxies do not
+close an idle connection.
+
+A client that reads too slowly never holds up ingestion. When its queue is
+full the oldest event is dropped and the client is sent a "resync" event,
+telling the dashboard to refetch the view instead of appending points.
+"""
+import itertools
+import json
+import queue
+import threading
+import time
+
+DEFAULT_CLIENT_QUEUE_SIZE = 256
+DEFAULT_HEARTBEAT_INTERVAL = 15.0
+RETRY_MILLISECONDS = 5000
+
+
+def format_event(event_type, data, event_id=None):
+    """Serializes one event in the text/event-stream format."""
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event_type}")
+    lines.append(f"data: {json.dumps(data, separators=(',', ':'))}")
+    return "\n".join(lines) + "\n\n"
+
+
+def reading_event(row):
+    """Event payload for one stored larvae reading."""
+    return {
+        "tray_number": row["tray_number"],
+        "length": row["length"],
+        "width": row["width"],
+        "area": row["area"],
+        "weight": row["weight"],
+        "count": row["count"],
+        "timestamp": row["timestamp"].isoformat(),
+    }
+
+
+class Subscription:
+    """Bounded event queue of one client, optionally filtered to a set of trays."""
+
+    def __init__(self, trays=None, max_queue=DEFAULT_CLIENT_QUEUE_SIZE):
+        self.trays = set(trays) if trays else None
+        self._queue = queue.Queue(maxsize=max_queue)
+        self.dropped = 0
+        self.overflowed = False
+
+    def wants(self, tray_number):
+        return self.trays is None or tray_number is None or tray_number in self.trays
+
+    def offer(self, event):
+        """Queues an event, dropping the oldest one if the client has fallen behind."""
+        while True:
+            try:
+                self._queue.put_nowait(event)
+                return
+            except queue.Full:
+                try:
+                    self._queue.get_nowait()
+                    self.dropped += 1
+                    self.overflowed = True
+                except queue.Empty:
+                    pass
+
+    def get(self, timeout):
+        """Next queued event, or None if nothing arrives within `timeout` seconds."""
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class EventHub:
+    """Fans published events out to every subscription that wants them."""
+
+    def __init__(self, client_queue_size=DEFAULT_CLIENT_QUEUE_SIZE, heartbeat_interval=DEFAULT_HEARTBEAT_INTERVAL):
+        self.client_queue_size = client_queue_size
+        self.heartbeat_interval = heartbeat_interval
+        self._lock = threading.Lock()
+        self._subscriptions = set()
+        self._ids = itertools.count(1)
+        self.published = 0
+
+    def subscribe(self, trays=None):
+        subscription = Subscription(trays, self.client_queue_size)
+        with self._lock:
+            self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def publish(self, event_type, data, tray_number=None):
+        """Sends an event to every subscriber interested in `tray_number` (None means all)."""
+        with self._lock:
+            event = (next(self._ids), event_type, data)
+            self.published += 1
+            for subscription in self._subscriptions:
+                if subscription.wants(tray_number):
+                    subscription.offer(event)
+
+    def publish_readings(self, rows):
+        """
+        Publishes stored readings. A batch larger than a client queue would only
+        overflow it, so it is announced as one "resync" event per tray instead.
+        """
+        if not self._subscriptions:
+            return
+        if len(rows) > self.client_queue_size:
+            for tray_number in sorted({row["tray_number"] for row in rows}):
+                self.publish("resync", {"tray_number": tray_number}, tray_number)
+            return
+        for row in rows:
+            self.publish("reading", reading_event(row), row["tray_number"])
+
+    def stream(self, subscription):
+        """
+        Generator producing the text/event-stream body for a subscription. The
+        subscription is removed when the client disconnects and the generator closes.
+        """
+        try:
+            yield f"retry: {RETRY_MILLISECONDS}\n\n"
+            last_sent = time.monotonic()
+            while True:
+                event = subscription.get(timeout=self.heartbeat_interval)
+                if subscription.overflowed:
+                    subscription.overflowed = False
+                    yield format_event("resync", {"dropped": subscription.dropped})
+                if event is not None:
+                    event_id, event_type, data = event
+                    yield format_event(event_type, data, event_id)
+                    last_sent = time.monotonic()
+                elif time.monotonic() - last_sent >= self.heartbeat_interval:
+                    yield ": keep-alive\n\n"
+                    last_sent = time.monotonic()
+        finally:
+            self.unsubscribe(subscription)
+
+    def stats(self):
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        return {
+            "clients": len(subscriptions),
+            "published": self.published,
+            "dropped": sum(subscription.dropped for subscription in subscriptions),
+        }
+
+
+def parse_tray_filter(args):
+    """Reads ?trays=1,2,3 into a set of tray numbers (None means every tray)."""
+    raw = args.get("trays")
+    if not raw:
+        return None
+    try:
+        return {int(tray) for tray in raw.split(",") if tray.strip()}
+    except ValueError:
+        raise ValueError("trays must be a comma separated list of tray numbers")
@@ -0,0 +1,255 @@
+"""
+Weight histogram engine shared by every dashboard endpoint and the rollups.
+
+Histograms are described by a sorted list of bin edges: readings in
+[edges[i], edges[i + 1]) land in bin i, anything at or above the last edge
+lands in an open-ended "<last>+" bin, and readings under the first edge are
+counted separately as "below". Bin lookup is a sorted-edges search: NumPy's
+searchsorted over a contiguous float64 array when NumPy is installed, else
+bisect over an array('d'). Edge sets can be chosen per species and growth
+stage through named profiles.
+
+Quantiles come from a QuantileSketch, a fixed-resolution histogram whose
+counts simply add up when sketches are merged.
+"""
+import json
+import math
+import os
+from array import array
+from bisect import bisect_right
+from collections import Counter
+from itertools import repeat
+
+from sqlalchemy import case, literal
+
+try:
+    import numpy as np
+except ImportError: # NumPy is optional; the bisect path gives the same counts
+    np = None
+
+DEFAULT_WEIGHT_EDGES = [80, 90, 100, 110, 120, 130, 140]
+DEFAULT_QUANTILES = (0.05, 0.25, 0.5, 0.75, 0.95)
+MAX_BINS = 200
+
+# Bin edges (mg) per (species, growth stage). A stage of None is the species
+# default. Extra profiles can be supplied as JSON through WEIGHT_BIN_PROFILES,
+# e.g. {"hermetia_illucens/early": [0, 5, 10, 20, 40]}.
+BIN_PROFILES = {
+    ("hermetia_illucens", None): DEFAULT_WEIGHT_EDGES,
+    ("hermetia_illucens", "early"): [0, 5, 10, 15, 20, 30, 40],
+    ("hermetia_illucens", "mid"): [40, 50, 60, 70, 80, 90, 100],
+    ("hermetia_illucens", "late"): DEFAULT_WEIGHT_EDGES,
+    ("hermetia_illucens", "prepupa"): [120, 140, 160, 180, 200, 220, 240],
+}
+DEFAULT_SPECIES = "hermetia_illucens"
+
+
+def register_profile(species, stage, edges):
+    """Adds or replaces the bin edges used for a species (and optionally a growth stage)."""
+    BIN_PROFILES[(species, stage)] = validate_edges([float(edge) for edge in edges])
+
+
+def _load_profiles_from_environment():
+    raw = os.environ.get("WEIGHT_BIN_PROFILES")
+    if not raw:
+        return
+    for key, edges in json.loads(raw).items():
+        species, _, stage = key.partition("/")
+        register_profile(species, stage or None, edges)
+
+
+def profile_edges(species=None, stage=None):
+    """
+    Edges for a species and growth stage (the species default when stage is
+    None). Raises ValueError when no such profile exists.
+    """
+    edges = BIN_PROFILES.get((species or DEFAULT_SPECIES, stage))
+    if edges is None:
+        raise ValueError(f"no bin profile for species '{species or DEFAULT_SPECIES}'"
+                         + (f" and stage '{stage}'" if stage else ""))
+    return list(edges)
+
+
+def validate_edges(edges):
+    """Checks that edges are finite, strictly increasing and not too many."""
+    if not all(math.isfinite(edge) for edge in edges):
+        raise ValueError("edges must be finite numbers")
+    if len(edges) < 2 or any(low >= high for low, high in zip(edges, edges[1:])):
+        raise ValueError("edges must hold at least two strictly increasing values")
+    if len(edges) > MAX_BINS:
+        raise ValueError(f"at most {MAX_BINS} edges are allowed")
+    return edges
+
+
+def _format_edge(edge):
+    return f"{edge:g}"
+
+
+def bin_labels(edges):
+    """Labels for the bins defined by `edges`, e.g. ["80-90", ..., "140+"]."""
+    labels = [f"{_format_edge(low)}-{_format_edge(high)}" for low, high in zip(edges, edges[1:])]
+    labels.append(f"{_format_edge(edges[-1])}+")
+    return labels
+
+
+def parse_bin_edges(args, default=DEFAULT_WEIGHT_EDGES):
+    """
+    Reads histogram edges from request arguments, either as an explicit list
+    (?edges=80,90,100), as a regular grid (?bin_start=80&bin_width=10&bin_count=6)
+    or as a named profile (?species=hermetia_illucens&stage=early). Returns
+    `default` when none is given. Raises ValueError on bad input.
+    """
+    if args.get("edges"):
+        if args["edges"].count(",") >= MAX_BINS: # Refuse before parsing a huge list
+            raise ValueError(f"at most {MAX_BINS} edges are allowed")
+        try:
+            edges = [float(edge) for edge in args["edges"].split(",") if edge.strip()]
+        except ValueError:
+            raise ValueError("edges must be a comma separated list of numbers")
+    elif args.get("bin_start") or args.get("bin_width") or args.get("bin_count"):
+        try:
+            start = float(args.get("bin_start", default[0]))
+            width = float(args.get("bin_width", 10))
+            count = int(args.get("bin_count", len(default) - 1))
+        except ValueError:
+            raise ValueError("bin_start, bin_width and bin_count must be numbers")
+        if width <= 0 or count < 1:
+            raise ValueError("bin_width must be positive and bin_count at least 1")
+        if count + 1 > MAX_BINS: # Checked before the edges are built, so a huge count costs nothing
+            raise ValueError(f"bin_count must be at most {MAX_BINS - 1}")
+        edges = [start + width * index for index in range(count + 1)]
+    elif args.get("species") or args.get("stage"):
+        return profile_edges(args.get("species"), args.get("stage"))
+    else:
+        return list(default)
+    return validate_edges(edges)
+
+
+def bin_index(weight, edges):
+    """Bin of a single weight: -1 below the first edge, len(edges) - 1 for the open last bin."""
+    return bisect_right(edges, weight) - 1
+
+
+class Histogram:
+    """Bin counts over `edges`, plus the number of values under the first edge."""
+
+    def __init__(self, edges, counts=None, below=0):
+        self.edges = list(edges)
+        self.counts = list(counts) if counts is not None else [0] * len(self.edges)
+        self.below = below
+
+    @property
+    def labels(self):
+        return bin_labels(self.edges)
+
+    @property
+    def total(self):
+        return sum(self.counts) + self.below
+
+    def merge(self, other):
+        """Adds the counts of another histogram with the same edges into this one."""
+        if other.edges != self.edges:
+            raise ValueError("cannot merge histograms with different edges")
+        self.counts = [mine + theirs for mine, theirs in zip(self.counts, other.counts)]
+        self.below += other.below
+        return self
+
+    def folded_counts(self):
+        """
+        Counts with readings under the first edge added to the open last bin,
+        the layout the dashboard's tray and combined charts have always used.
+        """
+        counts = list(self.counts)
+        counts[-1] += self.below
+        return counts
+
+    def as_dict(self):
+        return {"edges": self.edges, "ranges": self.labels, "counts": self.counts, "below": self.below}
+
+
+def compute_histogram(weights, edges=DEFAULT_WEIGHT_EDGES):
+    """
+    Bins an iterable of weights. Uses NumPy searchsorted/bincount over a float64
+    array when available, otherwise bisect over an array('d').
+    """
+    edges = list(edges)
+    bins = len(edges)
+    if np is not None:
+        values = np.asarray(weights, dtype=np.float64)
+        indices = np.searchsorted(np.asarray(edges, dtype=np.float64), values, side="right")
+        tally = np.bincount(indices, minlength=bins + 1)
+        return Histogram(edges, tally[1:].tolist(), int(tally[0]))
+
+    if not isinstance(weights, array):
+        weights = array("d", weights)
+    tally = Counter(map(bisect_right, repeat(edges), weights))
+    return Histogram(edges, [tally.get(index, 0) for index in range(1, bins + 1)], tally.get(0, 0))
+
+
+def merge_histograms(histograms, edges=DEFAULT_WEIGHT_EDGES):
+    """Sums partial histograms (e.g. one per tray or per chunk) into one."""
+    merged = Histogram(edges)
+    for histogram in histograms:
+        merged.merge(histogram)
+    return merged
+
+
+def sql_bin_index(column, edges):
+    """SQL CASE expression with the same bin numbering as bin_index()."""
+    whens = [(column < edges[0], literal(-1))]
+    whens += [(column < high, literal(index)) for index, high in enumerate(edges[1:])]
+    return case(*whens, else_=literal(len(edges) - 1))
+
+
+class QuantileSketch:
+    """
+    Mergeable quantile summary: counts of values per cell of width `resolution`.
+    Quantiles are interpolated linearly within a cell, so they are accurate to
+    within one cell width, and merging two sketches is just adding counts.
+    """
+
+    def __init__(self, resolution=1.0):
+        self.resolution = resolution
+        self.cells = {}
+        self.total = 0
+
+    def add_cell(self, cell, count):
+        """Adds `count` values that fall in cell number `cell`."""
+        self.cells[cell] = self.cells.get(cell, 0) + count
+        self.total += count
+
+    def add(self, value):
+        self.add_cell(math.floor(value / self.resolution), 1)
+
+    def merge(self, other):
+        """Adds another sketch of the same resolution into this one."""
+        if other.resolution != self.resolution:
+            raise ValueError("cannot merge sketches with different resolutions")
+        for cell, count in other.cells.items():
+            self.add_cell(cell, count)
+        return self
+
+    def quantile(self, q):
+        """Approximate value below which a fraction `q` of the values fall."""
+        if not self.total:
+            return None
+        target = q * self.total
+        seen = 0
+        for cell in sorted(self.cells):
+            count = self.cells[cell]
+            if seen + count >= target:
+                fraction = (target - seen) / count if count else 0
+                return (cell + fraction) * self.resolution
+            seen += count
+        return (max(self.cells) + 1) * self.resolution
+
+    def summary(self, quantiles=DEFAULT_QUANTILES, digits=1):
+        """Quantiles as a {"p5": ..., "p50": ...} dict."""
+        return {
+            f"p{q * 100:g}": (round(value, digits) if value is not None else None)
+            for q in quantiles
+            for value in [self.quantile(q)]
+        }
+
+
+_load_profiles_from_environment()
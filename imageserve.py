@@ -0,0 +1,58 @@
+"""
+HTTP caching and proxy offload for stored pictures.
+
+Content-addressed pictures (see imagestore.py) never change under their
+name, so they are served with their hash as a strong ETag and a year-long
+"immutable" Cache-Control: a browser that has a picture never asks again.
+Files under any other name get a validator from their mtime and size and
+must be revalidated. Either way If-None-Match is answered with 304 and
+Range requests with 206 (Werkzeug's conditional responses).
+
+With IMAGE_SENDFILE set, the worker only answers the conditional part and
+hands the bytes to the front proxy: "x-accel" returns an X-Accel-Redirect
+to an nginx internal location, "x-sendfile" an X-Sendfile header for
+Apache mod_xsendfile or lighttpd. The proxy then streams the file and
+serves ranges itself.
+"""
+import os
+from urllib.parse import quote
+
+from flask import Response, request, send_file
+
+SENDFILE_MODES = ("", "x-sendfile", "x-accel")
+DEFAULT_ACCEL_PREFIX = "/protected-images/"
+IMMUTABLE_CACHE_CONTROL = "private, max-age=31536000, immutable"
+REVALIDATE_CACHE_CONTROL = "private, no-cache"
+
+
+def file_etag(path):
+    stat = os.stat(path)
+    return f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+
+
+def serve_file(path, relative_path, mimetype, etag=None, immutable=False, sendfile="",
+               accel_prefix=DEFAULT_ACCEL_PREFIX):
+    """
+    Response for the file at `path`. `relative_path` is its path below the
+    directory the proxy maps `accel_prefix` to; `etag` defaults to one made
+    from the file's mtime and size. `immutable` marks a name whose content
+    never changes.
+    """
+    if sendfile not in SENDFILE_MODES:
+        raise ValueError(f"unknown sendfile mode '{sendfile}'")
+    if not sendfile:
+        response = send_file(path, mimetype=mimetype, conditional=True, etag=etag or file_etag(path))
+        response.headers["Accept-Ranges"] = "bytes" # Werkzeug only sets it on 206 responses
+    else:
+        etag = etag or file_etag(path)
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+        else:
+            response = Response(mimetype=mimetype)
+            if sendfile == "x-accel":
+                response.headers["X-Accel-Redirect"] = accel_prefix.rstrip("/") + "/" + quote(relative_path)
+            else:
+                response.headers["X-Sendfile"] = os.path.abspath(path)
+        response.set_etag(etag)
+    response.headers["Cache-Control"] = IMMUTABLE_CACHE_CONTROL if immutable else REVALIDATE_CACHE_CONTROL
+    return response
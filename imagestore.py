@@ -0,0 +1,158 @@
+"""
+Content-addressed picture storage.
+
+Pictures are named by the SHA-256 of their bytes and spread over two levels
+of subdirectories taken from the hash (ab/cd/abcd....jpg), so no directory
+grows past a few hundred entries, two pictures can never collide on a name,
+and a picture received twice is stored once. The relative path, the "key",
+is what image_files.file_path holds. Files are moved into place with
+os.replace from a temporary file in the same directory tree, so a key never
+points at a partial file.
+"""
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import tempfile
+
+from derivatives import image_size
+from storage import BASE_DIR
+
+# Absolute like DATABASE_PATH, so every entry point finds the same pictures whatever its working directory
+DEFAULT_IMAGE_DIR = os.path.abspath(os.path.join(BASE_DIR, os.environ.get("IMAGE_STORAGE_DIR", "static/images")))
+HASH_CHUNK_SIZE = 64 * 1024
+KEY_PATTERN = re.compile(r"^[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}\.[a-z0-9]+$")
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ImageStore:
+    """Stores files under `root` by content hash; see the module docstring."""
+
+    def __init__(self, root=DEFAULT_IMAGE_DIR):
+        # Not created here: the directories are made as files arrive, so a missing
+        # (unmounted) store stays visible to the migrations instead of being replaced
+        self.root = root
+
+    @staticmethod
+    def legacy_path(file_path, root=DEFAULT_IMAGE_DIR):
+        """
+        The file an image_files row from before the store points at, or None.
+        Those rows hold paths like static/images/tray_1_<time>.jpg, relative to
+        the directory the app was started from, which was normally BASE_DIR.
+        """
+        for path in (os.path.join(BASE_DIR, file_path), os.path.join(root, os.path.basename(file_path))):
+            if os.path.isfile(path):
+                return path
+        return None
+
+    @staticmethod
+    def is_key(value):
+        return bool(value) and KEY_PATTERN.match(value) is not None
+
+    @staticmethod
+    def key_for(digest, extension=".jpg"):
+        return f"{digest[:2]}/{digest[2:4]}/{digest}{extension}"
+
+    @staticmethod
+    def digest_of(key):
+        """The content hash a key was made from."""
+        return key.rsplit("/", 1)[-1].split(".", 1)[0]
+
+    def path(self, key):
+        return os.path.join(self.root, *key.split("/"))
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+    def put_file(self, source, extension=".jpg"):
+        """
+        Moves the file at `source` (on the same filesystem as the store) into
+        the store and returns its key. If the same content is already stored,
+        `source` is deleted instead.
+        """
+        key = self.key_for(file_digest(source), extension)
+        target = self.path(key)
+        if os.path.exists(target):
+            os.remove(source)
+            return key
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(source, target)
+        return key
+
+    def link_file(self, source, extension=".jpg"):
+        """
+        Adds the content of `source` to the store and leaves `source` in place:
+        a hard link when possible, a copy otherwise. Returns its key.
+        """
+        key = self.key_for(file_digest(source), extension)
+        target = self.path(key)
+        if os.path.exists(target):
+            return key
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(target), prefix=".store-", suffix=".part")
+        os.close(fd)
+        try:
+            os.remove(temp_path)
+            try:
+                os.link(source, temp_path)
+            except OSError: # Another filesystem, or links not supported
+                shutil.copyfile(source, temp_path)
+            os.replace(temp_path, target)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return key
+
+    def put_bytes(self, data, extension=".jpg"):
+        """Stores `data` unless the same bytes are already stored. Returns its key."""
+        key = self.key_for(hashlib.sha256(data).hexdigest(), extension)
+        target = self.path(key)
+        if os.path.exists(target):
+            return key
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(target), prefix=".store-", suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, target)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        return key
+
+
+def store_attachment(store, attachments, larvae, tray_number, received_at):
+    """
+    Stores the picture of a decoded MQTT message (see topics.decode_routed) and
+    returns its image_files row, or None when the message had no picture.
+    Shared by the dashboard's embedded subscriber and mqtt_subscriber.py.
+    """
+    image_bytes = attachments["image"]
+    if not image_bytes:
+        return None
+    key = store.put_bytes(image_bytes, ".jpg") # A repeated picture is stored once
+    width, height = image_size(io.BytesIO(image_bytes))
+    bounding_boxes, masks = attachments["bounding_boxes"], attachments["masks"]
+    return {
+        "tray_number": tray_number,
+        "file_path": key,
+        "timestamp": received_at,
+        "avg_length": larvae["length"] if larvae else None,
+        "avg_weight": larvae["weight"] if larvae else None,
+        "count": larvae["count"] if larvae else None,
+        # Bounding boxes and masks are stored as JSON strings
+        "bounding_boxes": json.dumps(bounding_boxes) if bounding_boxes else None,
+        "masks": json.dumps(masks) if masks else None,
+        "width": width,
+        "height": height,
+    }
@@ -0,0 +1,334 @@
+"""
+Queue-backed ingestion for larvae readings.
+
+MQTT callbacks run on the paho network thread, so they must never wait on a
+database commit. Instead they hand decoded readings to a BatchWriter, whose
+dedicated writer thread drains the queue and stores everything it collected
+in a single transaction per flush.
+
+It also holds the decoding and validation shared by every ingest path (the
+MQTT subscribers and the HTTP endpoints) and the helpers behind the bulk HTTP
+endpoint: NDJSON streaming and chunked multi-row inserts.
+
+Validation is compiled into READING_SCHEMA, a tuple of (field, converter)
+pairs, so a valid reading is converted in a single pass; only a reading that
+fails is examined again to say what is wrong. The converters are strict:
+booleans, fractional counts or tray numbers, NaN, infinities and values out
+of range are refused rather than coerced.
+JSON is decoded with orjson when it is installed.
+"""
+import json
+import queue
+import threading
+import time
+
+from downsample import parse_timestamp
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+READING_FIELDS = ["tray_number", "length", "width", "area", "weight", "count", "timestamp"]
+MAX_INTEGER = 2**32 - 1 # tray_number and count are uint32 in the struct layout (see codec.py)
+MAX_MEASUREMENT = 1e6 # mm, mm^2 or mg; anything larger is a sensor or encoding fault
+
+
+class OutOfRange(ValueError):
+    """A numeric field holds a number, but not one the field can take."""
+
+
+def whole_number(value):
+    """Converts a tray number or count, refusing booleans, fractions and values out of range."""
+    if isinstance(value, bool):
+        raise OutOfRange("must be a number, not a boolean")
+    if isinstance(value, float):
+        if not value.is_integer():
+            raise OutOfRange("must be a whole number")
+        value = int(value)
+    else:
+        value = int(value)
+    if not 0 <= value <= MAX_INTEGER:
+        raise OutOfRange(f"must be between 0 and {MAX_INTEGER}")
+    return value
+
+
+def measurement(value):
+    """Converts a length, width, area or weight, refusing booleans, NaN, infinities and values out of range."""
+    if isinstance(value, bool):
+        raise OutOfRange("must be a number, not a boolean")
+    value = float(value)
+    if not 0 <= value <= MAX_MEASUREMENT: # Also false for NaN
+        raise OutOfRange(f"must be a finite number between 0 and {MAX_MEASUREMENT:g}")
+    return value
+
+
+# Column converters of a larvae_data row, in insert order (the timestamp is handled apart)
+READING_SCHEMA = (
+    ("tray_number", whole_number),
+    ("length", measurement),
+    ("width", measurement),
+    ("area", measurement),
+    ("weight", measurement),
+    ("count", whole_number),
+)
+NDJSON_MIMETYPES = ("application/x-ndjson", "application/jsonl", "application/x-jsonlines")
+# Keeps 7 columns x 100 rows under SQLite's bound-parameter limit on old builds (999)
+INSERT_CHUNK_SIZE = 100
+MAX_REPORTED_ERRORS = 50
+DEFAULT_BATCH_MAX_ROWS = 50000
+DEFAULT_BATCH_MAX_BYTES = 16 * 1024 * 1024
+
+
+class BatchWriter:
+    """
+    Collects submitted items on a bounded queue and passes them to `handler`
+    in batches. A batch is flushed when it reaches `batch_size` items or when
+    `flush_interval` seconds have passed since its first item arrived,
+    whichever comes first.
+    """
+
+    def __init__(self, handler, batch_size=500, flush_interval=0.2, max_queue=10000, name="ingest-writer"):
+        self.handler = handler
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.name = name
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stats = {"submitted": 0, "dropped": 0, "stored": 0, "failed": 0, "flushes": 0}
+
+    @property
+    def queue_depth(self):
+        """Number of items waiting to be written."""
+        return self._queue.qsize()
+
+    def stats(self):
+        """Returns a snapshot of the writer counters, including the current queue depth."""
+        with self._lock:
+            stats = dict(self._stats)
+        stats["queue_depth"] = self.queue_depth
+        stats["queue_max"] = self._queue.maxsize
+        stats["batch_size"] = self.batch_size
+        stats["flush_interval"] = self.flush_interval
+        return stats
+
+    def submit(self, item):
+        """
+        Queues an item for writing without blocking. Returns False (and counts
+        the item as dropped) when the queue is full.
+        """
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self._count("dropped")
+            return False
+        self._count("submitted")
+        return True
+
+    def start(self):
+        """Starts the writer thread if it is not already running."""
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=5.0):
+        """Stops the writer thread after flushing whatever is still queued."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _count(self, key, amount=1):
+        with self._lock:
+            self._stats[key] += amount
+
+    def _run(self):
+        while not (self._stop.is_set() and self._queue.empty()):
+            try:
+                first = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+
+            batch = [first]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._flush(batch)
+
+    def _flush(self, batch):
+        try:
+            self.handler(batch)
+            self._count("stored", len(batch))
+        except Exception as e:
+            print(f"Batch write of {len(batch)} items failed: {e}")
+            if len(batch) == 1:
+                self._count("failed")
+            else:
+                # Retry one by one so a single bad item does not sink the whole batch
+                for item in batch:
+                    try:
+                        self.handler([item])
+                        self._count("stored")
+                    except Exception as item_error:
+                        print(f"Dropping item that could not be written: {item_error}")
+                        self._count("failed")
+        finally:
+            self._count("flushes")
+
+
+def loads(payload):
+    """Decodes JSON from bytes or str. Errors are json.JSONDecodeError (a ValueError) either way."""
+    return orjson.loads(payload) if orjson is not None else json.loads(payload)
+
+
+def parse_reading(data, received_at=None):
+    """
+    Validates one reading and converts it into a row for the larvae_data table.
+    With `received_at` the reading is stamped with that time and needs no
+    timestamp of its own (MQTT); otherwise its ISO 8601 timestamp is stored as
+    naive UTC, converted from any offset it carries. Raises ValueError
+    describing the first problem found.
+    """
+    try:
+        row = {field: convert(data[field]) for field, convert in READING_SCHEMA}
+        row["timestamp"] = received_at or parse_timestamp(data["timestamp"])
+        return row
+    except (KeyError, TypeError, ValueError, AttributeError):
+        raise ValueError(_reading_error(data, received_at is None))
+
+
+def _reading_error(data, needs_timestamp):
+    """Describes why `data` is not a valid reading (the slow path of parse_reading)."""
+    if not isinstance(data, dict):
+        return "reading must be a JSON object"
+    fields = READING_FIELDS if needs_timestamp else READING_FIELDS[:-1]
+    missing = [field for field in fields if data.get(field) is None]
+    if missing:
+        return f"missing fields: {', '.join(missing)}"
+    for field, convert in READING_SCHEMA:
+        try:
+            convert(data[field])
+        except OutOfRange as e:
+            return f"{field} {e}"
+        except (TypeError, ValueError):
+            return "numeric fields must be numbers"
+    return "timestamp must be an ISO 8601 string"
+
+
+def decode_reading(payload, received_at=None):
+    """Decodes a JSON payload straight into a larvae_data row (see parse_reading)."""
+    try:
+        data = loads(payload)
+    except ValueError as e:
+        raise ValueError(f"invalid JSON: {e}")
+    return parse_reading(data, received_at)
+
+
+def iter_ndjson(stream):
+    """
+    Reads newline-delimited JSON from a binary stream one line at a time.
+    Yields (line_number, value) pairs; lines that fail to parse yield the
+    ValueError instead of a value so the caller can count them as rejected.
+    """
+    for line_number, line in enumerate(stream, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield line_number, loads(line)
+        except ValueError as e:
+            yield line_number, ValueError(f"invalid JSON: {e}")
+
+
+class TooManyRows(ValueError):
+    """A bulk request holds more rows than the configured limit."""
+
+
+def limit_records(records, max_rows):
+    """Passes (row_number, value) pairs through, raising TooManyRows on the one past `max_rows`."""
+    for seen, record in enumerate(records, 1):
+        if seen > max_rows:
+            raise TooManyRows(f"at most {max_rows} rows are accepted per request")
+        yield record
+
+
+def iter_chunks(rows, size):
+    """Splits an iterable into lists of at most `size` items, reading only one list ahead."""
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class IngestReport:
+    """Per-request accept/reject bookkeeping for bulk ingestion."""
+
+    def __init__(self):
+        self.accepted = 0
+        self.rejected = 0
+        self.errors = []
+
+    def reject(self, row, reason):
+        self.rejected += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({"row": row, "error": reason})
+
+    def as_dict(self):
+        return {"accepted": self.accepted, "rejected": self.rejected, "errors": self.errors}
+
+
+def validated_readings(records, report):
+    """
+    Turns (row_number, value) pairs into table rows, recording each row as
+    accepted or rejected on `report` as it streams past.
+    """
+    for row_number, value in records:
+        if isinstance(value, Exception):
+            report.reject(row_number, str(value))
+            continue
+        try:
+            row = parse_reading(value)
+        except ValueError as e:
+            report.reject(row_number, str(e))
+            continue
+        report.accepted += 1
+        yield row
+
+
+def insert_in_chunks(connection, table, rows, chunk_size=INSERT_CHUNK_SIZE, on_chunk=None):
+    """
+    Inserts rows from an iterable using multi-row INSERT statements of at most
+    `chunk_size` rows, so the input never has to be held in memory at once.
+    `on_chunk(connection, chunk)` is called after each chunk is inserted.
+    Runs inside the caller's transaction and returns the number of rows inserted.
+    """
+    inserted = 0
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            inserted += _insert_chunk(connection, table, chunk, on_chunk)
+            chunk = []
+    if chunk:
+        inserted += _insert_chunk(connection, table, chunk, on_chunk)
+    return inserted
+
+
+def _insert_chunk(connection, table, chunk, on_chunk):
+    connection.execute(table.insert().values(chunk))
+    if on_chunk is not None:
+        on_chunk(connection, chunk)
+    return len(chunk)
@@ -0,0 +1,116 @@
+"""
+Leader election for MQTT ingestion, based on an exclusive file lock.
+
+Every process that may consume MQTT readings (each gunicorn worker that
+embeds the subscriber, and mqtt_subscriber.py) competes for the same lock
+file next to the database. Only the holder subscribes; the others keep
+retrying in the background. The operating system releases the lock when
+its holder exits or crashes, so another process takes over within one
+retry interval, and a stale lock file left on disk never blocks anyone.
+"""
+import os
+import threading
+import time
+
+from storage import DATABASE_PATH
+
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
+    import msvcrt
+
+DEFAULT_LOCK_PATH = os.path.join(os.path.dirname(DATABASE_PATH), "ingest.lock")
+
+
+class LeaderLock:
+    """Non-blocking exclusive lock on a file, held until release() or process exit."""
+
+    def __init__(self, path=DEFAULT_LOCK_PATH):
+        self.path = path
+        self._file = None
+
+    @property
+    def held(self):
+        return self._file is not None
+
+    def try_acquire(self):
+        """Takes the lock if no other process holds it. Returns whether it is held."""
+        if self._file is not None:
+            return True
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        lock_file = open(self.path, "a+")
+        try:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            lock_file.close()
+            return False
+        # Informational only: who holds the lock, for someone looking at the file
+        lock_file.seek(0)
+        lock_file.truncate()
+        lock_file.write(f"{os.getpid()}\n")
+        lock_file.flush()
+        self._file = lock_file
+        return True
+
+    def release(self):
+        if self._file is not None:
+            if fcntl is not None:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+
+
+class LeaderElection:
+    """
+    Background thread that retries a LeaderLock every `retry_interval`
+    seconds and calls on_elected() once, when this process wins it.
+    """
+
+    def __init__(self, lock, on_elected, retry_interval=10.0, name="ingest-election"):
+        self.lock = lock
+        self.on_elected = on_elected
+        self.retry_interval = retry_interval
+        self.name = name
+        self.elected_at = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def is_leader(self):
+        return self.lock.held
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        announced = False
+        while not self._stop.is_set():
+            if self.lock.try_acquire():
+                self.elected_at = time.time()
+                print(f"Process {os.getpid()} is the ingest leader ({self.lock.path})")
+                self.on_elected()
+                return
+            if not announced:
+                print(f"Another process holds {self.lock.path}; process {os.getpid()} will not consume MQTT")
+                announced = True
+            self._stop.wait(self.retry_interval)
+
+    def stats(self):
+        return {
+            "pid": os.getpid(),
+            "leader": self.is_leader,
+            "elected_at": self.elected_at,
+            "lock_path": self.lock.path,
+        }
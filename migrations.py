@@ -0,0 +1,234 @@
+"""
+Versioned schema migrations for the SQLite database.
+
+db.create_all() only creates tables that are missing; it never adds a column
+or an index to a table that already exists. Changes to the schema of existing
+deployments are therefore written here as numbered migrations. The version a
+database has reached is kept in SQLite's PRAGMA user_version, and
+run_migrations() applies every newer migration in order.
+
+Each migration runs in one transaction with its user_version update, so one
+that fails is rolled back as a whole (file changes excepted). Migrations are
+still written to be safe to run again (IF NOT EXISTS, checking for columns
+first), so a retry after a crash simply finishes the work.
+
+Several processes may start at once (gunicorn workers, the dashboard and
+mqtt_subscriber.py). Each migration therefore runs under BEGIN IMMEDIATE,
+which holds SQLite's write lock, and re-reads user_version inside that
+transaction: whoever comes second waits, then finds the migration applied
+and skips it.
+
+Migrations that move or delete picture files (5 and 6) only run once the
+image directory exists: while it is missing (a volume not mounted, say) they raise
+MigrationDeferred, are left unapplied and run at a later start.
+"""
+import os
+import time
+
+from sqlalchemy import inspect
+from sqlalchemy.exc import OperationalError
+
+LOCK_RETRY_INTERVAL = 0.5 # Seconds between attempts while another process migrates
+
+MIGRATIONS = [] # (version, description, function), in version order
+
+
+class MigrationDeferred(Exception):
+    """A migration cannot run yet; it is rolled back, and it and the later ones are retried next start."""
+
+
+def migration(version, description):
+    """Registers a function as the migration to schema `version`."""
+    def register(function):
+        if MIGRATIONS and version <= MIGRATIONS[-1][0]:
+            raise ValueError(f"migration {version} is out of order")
+        MIGRATIONS.append((version, description, function))
+        return function
+    return register
+
+
+def schema_version(connection):
+    return connection.exec_driver_sql("PRAGMA user_version").scalar()
+
+
+def _set_schema_version(connection, version):
+    # PRAGMA does not take bound parameters; version is always an int from MIGRATIONS
+    connection.exec_driver_sql(f"PRAGMA user_version = {int(version)}")
+
+
+def _columns(connection, table):
+    return {column["name"] for column in inspect(connection).get_columns(table)}
+
+
+def _has_table(connection, table):
+    return inspect(connection).has_table(table)
+
+
+def _require_image_dir(connection):
+    """
+    Returns the image directory, or raises MigrationDeferred if it does not
+    exist although image_files has rows, whose files would then be lost track of.
+    """
+    from imagestore import DEFAULT_IMAGE_DIR
+    if not os.path.isdir(DEFAULT_IMAGE_DIR) and connection.exec_driver_sql(
+            "SELECT 1 FROM image_files LIMIT 1").first() is not None:
+        raise MigrationDeferred(f"image directory {DEFAULT_IMAGE_DIR} does not exist")
+    return DEFAULT_IMAGE_DIR
+
+
+@migration(1, "composite (tray_number, timestamp) indexes")
+def add_tray_timestamp_indexes(connection):
+    # Every per-tray query filters on tray_number and orders or ranges on timestamp
+    for table in ("larvae_data", "image_files"):
+        if _has_table(connection, table):
+            connection.exec_driver_sql(
+                f"CREATE INDEX IF NOT EXISTS ix_{table}_tray_timestamp ON {table} (tray_number, timestamp)")
+
+
+@migration(2, "bounding_boxes and masks columns on image_files")
+def add_image_annotation_columns(connection):
+    if not _has_table(connection, "image_files"):
+        return
+    existing = _columns(connection, "image_files")
+    for column in ("bounding_boxes", "masks"):
+        if column not in existing:
+            connection.exec_driver_sql(f"ALTER TABLE image_files ADD COLUMN {column} VARCHAR")
+
+
+@migration(3, "data version column on the rollup tables")
+def add_rollup_versions(connection):
+    # Existing buckets get version 0: every cursor handed out from now on is at least the
+    # highest id already stored, so no client can be behind them
+    for resolution in ("minute", "hour", "day"):
+        table = f"larvae_rollup_{resolution}"
+        if _has_table(connection, table) and "version" not in _columns(connection, table):
+            connection.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+
+
+@migration(4, "width and height columns on image_files")
+def add_image_dimension_columns(connection):
+    if not _has_table(connection, "image_files"):
+        return
+    existing = _columns(connection, "image_files")
+    for column in ("width", "height"):
+        if column not in existing:
+            connection.exec_driver_sql(f"ALTER TABLE image_files ADD COLUMN {column} INTEGER")
+    # Filled from the picture headers; rows whose file is gone keep NULL (served without variants)
+    from derivatives import image_size
+    from imagestore import ImageStore
+    rows = connection.exec_driver_sql("SELECT id, file_path FROM image_files WHERE width IS NULL").all()
+    for image_id, file_path in rows:
+        path = ImageStore.legacy_path(file_path)
+        width, height = image_size(path) if path else (None, None)
+        if width:
+            connection.exec_driver_sql("UPDATE image_files SET width = ?, height = ? WHERE id = ?",
+                                       (width, height, image_id))
+
+
+@migration(5, "image_files point into the content-addressed image store")
+def move_images_to_store(connection):
+    # Files are linked into the store and left in place here; migration 6 deletes the old
+    # copies, in its own transaction, once these rows are committed
+    if not _has_table(connection, "image_files"):
+        return
+    from imagestore import ImageStore
+    store = ImageStore(_require_image_dir(connection))
+    keys = {} # Old path -> key; several rows can share a file
+    from derivatives import image_size
+    rows = connection.exec_driver_sql("SELECT id, file_path, width FROM image_files").all()
+    for image_id, file_path, width in rows:
+        if store.is_key(file_path):
+            continue
+        path = store.legacy_path(file_path, store.root)
+        if path is None:
+            print(f"Image file for image_files row {image_id} not found: {file_path}")
+            continue
+        if path not in keys:
+            keys[path] = store.link_file(path, ".jpg") # Every stored picture is a JPEG, whatever its old name
+        connection.exec_driver_sql("UPDATE image_files SET file_path = ? WHERE id = ?", (keys[path], image_id))
+        if width is None: # Migration 4 ran while the directory was missing
+            width, height = image_size(path)
+            if width:
+                connection.exec_driver_sql("UPDATE image_files SET width = ?, height = ? WHERE id = ?",
+                                           (width, height, image_id))
+
+
+@migration(6, "remove image files left behind by migration 5")
+def remove_flat_image_files(connection):
+    # Only files whose content is in the store are removed, so nothing unreferenced is lost;
+    # variants rendered for the old names are caches and are rendered again under the new ones
+    from imagestore import ImageStore, file_digest
+    image_dir = _require_image_dir(connection) if _has_table(connection, "image_files") else None
+    if image_dir is None or not os.path.isdir(image_dir): # No pictures recorded, so nothing left behind
+        return
+    store = ImageStore(image_dir)
+    for entry in os.scandir(image_dir):
+        if entry.is_file() and not entry.name.startswith("."):
+            if store.exists(store.key_for(file_digest(entry.path), ".jpg")):
+                os.remove(entry.path)
+    derived = os.path.join(image_dir, "derived")
+    if os.path.isdir(derived):
+        for variant in os.scandir(derived):
+            if variant.is_dir():
+                for entry in os.scandir(variant.path):
+                    if entry.is_file():
+                        os.remove(entry.path)
+
+
+def _begin_immediate(connection):
+    """Starts a write transaction, waiting for as long as another process holds the lock."""
+    waiting = False
+    while True:
+        try:
+            connection.exec_driver_sql("BEGIN IMMEDIATE")
+            return
+        except OperationalError as e:
+            if "locked" not in str(e.orig):
+                raise
+            if not waiting:
+                print("Waiting for another process to finish migrating the database...")
+                waiting = True
+            time.sleep(LOCK_RETRY_INTERVAL)
+
+
+def run_migrations(engine):
+    """
+    Brings the database behind `engine` up to the latest schema version, one
+    migration per transaction. Returns the list of versions applied by this
+    process.
+    """
+    with engine.connect() as connection:
+        current = schema_version(connection)
+    if all(version <= current for version, _, _ in MIGRATIONS):
+        return [] # Up to date: do not queue every starting process on the write lock
+
+    applied = []
+    with engine.connect() as connection:
+        # The driver would only BEGIN before DML and let DDL run outside the transaction
+        dbapi_connection = connection.connection.dbapi_connection
+        isolation_level = dbapi_connection.isolation_level
+        dbapi_connection.isolation_level = None
+        try:
+            for version, description, function in MIGRATIONS:
+                if version <= current:
+                    continue
+                _begin_immediate(connection)
+                try:
+                    current = schema_version(connection) # Another process may have got here first
+                    if version > current:
+                        function(connection)
+                        _set_schema_version(connection, version)
+                        current = version
+                        applied.append(version)
+                        print(f"Applied migration {version}: {description}")
+                    connection.exec_driver_sql("COMMIT")
+                except MigrationDeferred as e:
+                    connection.exec_driver_sql("ROLLBACK")
+                    print(f"Migration {version} left unapplied, retried at the next start: {e}")
+                    break
+                except BaseException:
+                    connection.exec_driver_sql("ROLLBACK")
+                    raise
+        finally:
+            dbapi_connection.isolation_level = isolation_level
+    return applied
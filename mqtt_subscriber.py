@@ -1,21 +1,42 @@
-from sqlalchemy import create_engine, Column, Integer, Float, DateTime
-from sqlalchemy.orm import sessionmaker, declarative_base 
+"""
+Dedicated MQTT ingestion process.
+
+Run it next to the web tier (`python mqtt_subscriber.py`) and start the web
+apps with INGEST_MODE=external: the web processes then only read, and the
+readings they show arrive through their reading feed (see changefeed.py).
+Readings are batched on a writer thread like in the apps (see ingest.py).
+Pictures attached to messages go into the same image store as the
+dashboard's (see imagestore.py) and are recorded in image_files, so the
+evidence gallery keeps filling; the dashboard renders their variants on
+first request.
+
+The process takes the same ingest lock as web processes that embed the
+subscriber (see leader.py), so a second copy of it, or an embedded
+subscriber, waits instead of storing every reading twice.
+"""
+from sqlalchemy import Column, Integer, Float, DateTime, Index, String
+from sqlalchemy.orm import declarative_base
 from datetime import datetime
 import paho.mqtt.client as mqtt # Import MQTT library
-import json # To parse incoming JSON data
+import os
 import time # For sleep
+from consumer import ShardedConsumer
+from imagestore import ImageStore, store_attachment
+from ingest import BatchWriter
+from leader import DEFAULT_LOCK_PATH, LeaderLock
+from rollups import apply_readings, data_version, define_rollup_tables
+from migrations import run_migrations
+from storage import create_storage_engine
+from topics import DeviceHeartbeats, TopicRouter, decode_routed, parse_topic
 
-# --- Database Configuration (Must match Flask's config) ---
-DATABASE_URL = "sqlite:///./larvae_monitoring.db" # Relative path assumes it's in the same directory
-                                                  # Make sure this path is accessible by this script
-
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# --- Database Configuration (shared with the Flask apps through storage.py) ---
+engine = create_storage_engine()
 Base = declarative_base()
 
 # --- Database Model for LarvaeData (Replicated from app.py/api.py) ---
 class LarvaeData(Base):
     __tablename__ = "larvae_data" # Ensure this matches Flask's model table name
+    __table_args__ = (Index("ix_larvae_data_tray_timestamp", "tray_number", "timestamp"),)
 
     id = Column(Integer, primary_key=True, index=True)
     tray_number = Column(Integer, nullable=False)
@@ -26,9 +47,28 @@ class LarvaeData(Base):
     count = Column(Integer, nullable=False)
     timestamp = Column(DateTime, default=datetime.utcnow)
 
-# Ensure the database table exists
-Base.metadata.create_all(bind=engine)
-print("Database table 'larvae_data' ensured to exist.")
+# --- Database Model for ImageFile (Replicated from BSFwebdashboard.py) ---
+class ImageFile(Base):
+    __tablename__ = "image_files"
+    __table_args__ = (Index("ix_image_files_tray_timestamp", "tray_number", "timestamp"),)
+
+    id = Column(Integer, primary_key=True)
+    tray_number = Column(Integer, nullable=False)
+    file_path = Column(String(255), nullable=False) # Key in the image store
+    timestamp = Column(DateTime, default=datetime.utcnow)
+    avg_length = Column(Float, nullable=True)
+    avg_weight = Column(Float, nullable=True)
+    count = Column(Integer, nullable=True)
+    bounding_boxes = Column(String, nullable=True) # JSON string
+    masks = Column(String, nullable=True) # JSON string
+    width = Column(Integer, nullable=True)
+    height = Column(Integer, nullable=True)
+
+# Per-tray minute/hour/day rollups, kept in step with every stored reading
+ROLLUPS = define_rollup_tables(Base.metadata)
+
+# Pictures attached to messages, stored where the dashboard serves them from
+image_store = ImageStore()
 
 
 # --- MQTT Configuration ---
@@ -36,64 +76,132 @@ MQTT_BROKER = "broker.hivemq.com"
 MQTT_PORT = 1883
 MQTT_TOPIC = "bsf_monitor/larvae_data" # <--- IMPORTANT: This MUST match the topic in your Pi script!
 
+# --- Ingest Configuration (same variables as the web apps) ---
+INGEST_BATCH_SIZE = int(os.environ.get("INGEST_BATCH_SIZE", 500))
+INGEST_FLUSH_INTERVAL = float(os.environ.get("INGEST_FLUSH_INTERVAL", 0.2))
+INGEST_QUEUE_MAXSIZE = int(os.environ.get("INGEST_QUEUE_MAXSIZE", 10000))
+INGEST_LOCK_PATH = os.environ.get("INGEST_LOCK_PATH", DEFAULT_LOCK_PATH)
+INGEST_LEADER_RETRY = float(os.environ.get("INGEST_LEADER_RETRY", 10))
+MQTT_CONSUMER_SHARDS = int(os.environ.get("MQTT_CONSUMER_SHARDS", 4))
+MQTT_CONSUMER_QUEUE_MAXSIZE = int(os.environ.get("MQTT_CONSUMER_QUEUE_MAXSIZE", 1000))
+MQTT_IMAGE_WORKERS = int(os.environ.get("MQTT_IMAGE_WORKERS", 2))
+MQTT_IMAGE_QUEUE_MAXSIZE = int(os.environ.get("MQTT_IMAGE_QUEUE_MAXSIZE", 50))
+
+
+def store_ingest_batch(items):
+    """
+    Inserts a batch of queued items in one transaction: their readings, folded
+    into the rollups, and the image records of messages that carried a picture
+    (a bare picture on an image topic has no reading).
+    """
+    rows = [item["larvae"] for item in items if item["larvae"]]
+    image_rows = [item["image"] for item in items if item["image"]]
+    with engine.begin() as connection:
+        if rows:
+            connection.execute(LarvaeData.__table__.insert(), rows)
+            apply_readings(connection, ROLLUPS, rows, data_version(connection, LarvaeData.__table__))
+        if image_rows:
+            connection.execute(ImageFile.__table__.insert(), image_rows)
+
+ingest_writer = BatchWriter(
+    store_ingest_batch,
+    batch_size=INGEST_BATCH_SIZE,
+    flush_interval=INGEST_FLUSH_INTERVAL,
+    max_queue=INGEST_QUEUE_MAXSIZE,
+)
+
 # --- MQTT Callbacks ---
-def on_connect(client, userdata, flags, rc):
+def on_connect(client, userdata, flags, rc, properties):
     if rc == 0:
         print("Connected to MQTT Broker!")
-        client.subscribe(MQTT_TOPIC)
-        print(f"Subscribed to topic: {MQTT_TOPIC}")
+        # bsf_monitor/<site>/<tray>/<kind> plus the legacy MQTT_TOPIC and its format subtopics
+        subscriptions = mqtt_router.subscriptions()
+        client.subscribe(subscriptions)
+        print(f"Subscribed to topics: {', '.join(topic for topic, _ in subscriptions)}")
     else:
         print(f"Failed to connect, return code {rc}\n")
 
-def on_message(client, userdata, msg):
-    print(f"Received message on topic '{msg.topic}': {msg.payload.decode()}")
+def handle_mqtt_message(topic, payload):
+    """
+    Decodes and validates one metrics or image message on its consumer shard,
+    stores its picture if it has one, then queues its reading and image record
+    for writing.
+    """
+    received_at = datetime.utcnow() # Use current UTC time for consistency
     try:
-        payload = json.loads(msg.payload.decode())
-
-        # Validate incoming data (basic check, more robust validation could be added)
-        required_keys = ["tray_number", "length", "width", "area", "weight", "count"]
-        if not all(key in payload for key in required_keys):
-            print("Error: Received payload is missing required keys.")
-            return
-
-        # Create a new database session for this message
-        db = SessionLocal()
-        try:
-            new_entry = LarvaeData(
-                tray_number=payload["tray_number"],
-                length=payload["length"],
-                width=payload["width"],
-                area=payload["area"],
-                weight=payload["weight"],
-                count=payload["count"],
-                timestamp=datetime.utcnow() # Use current UTC time for consistency
-            )
-            db.add(new_entry)
-            db.commit()
-            db.refresh(new_entry) # Refresh to get the generated ID and timestamp
-            print(f"Successfully stored data for Tray {new_entry.tray_number}, ID: {new_entry.id}")
-        except Exception as e:
-            db.rollback() # Rollback the transaction on error
-            print(f"Error storing data to database: {e}")
-        finally:
-            db.close() # Always close the session
-
-    except json.JSONDecodeError:
-        print(f"Error: Could not decode JSON from message: {msg.payload.decode()}")
-    except Exception as e:
-        print(f"An unexpected error occurred in on_message: {e}")
+        # Validated here so one bad reading cannot fail a whole batch later
+        row, attachments = decode_routed(topic, payload, MQTT_TOPIC, received_at=received_at)
+    except ValueError as e:
+        print(f"Rejected MQTT message on topic {topic}: {e}")
+        return
+
+    tray_number = row["tray_number"] if row else parse_topic(topic).tray
+    try:
+        image = store_attachment(image_store, attachments, row, tray_number, received_at)
+    except (OSError, ValueError) as e:
+        print(f"Could not store the picture for Tray {tray_number}: {e}")
+        image = None
+    if row is None and image is None:
+        return
+
+    if not ingest_writer.submit({"larvae": row, "image": image}):
+        print(f"Ingest queue full, dropping reading for Tray {tray_number}")
+
+# Messages of one tray are handled in order on one shard; different trays in parallel
+mqtt_consumer = ShardedConsumer(handle_mqtt_message, shards=MQTT_CONSUMER_SHARDS,
+                                max_queue=MQTT_CONSUMER_QUEUE_MAXSIZE)
+image_consumer = ShardedConsumer(handle_mqtt_message, shards=MQTT_IMAGE_WORKERS,
+                                 max_queue=MQTT_IMAGE_QUEUE_MAXSIZE, name="mqtt-image")
+heartbeats = DeviceHeartbeats()
+
+# Each kind of message goes to its own pool, so image bursts cannot hold up metric readings
+mqtt_router = TopicRouter(legacy_topic=MQTT_TOPIC)
+mqtt_router.route("metrics", mqtt_consumer.submit)
+mqtt_router.route("image", image_consumer.submit)
+mqtt_router.route("heartbeat", heartbeats.submit)
+
+def on_message(client, userdata, msg):
+    if not mqtt_router.dispatch(msg.topic, msg.payload):
+        print(f"Dropping MQTT message on topic {msg.topic} (unknown topic or queue full)")
+
+
+def wait_for_leadership(lock):
+    """Blocks until this process holds the ingest lock."""
+    if lock.try_acquire():
+        return
+    print(f"Another process is consuming MQTT ({lock.path}); waiting to take over...")
+    while not lock.try_acquire():
+        time.sleep(INGEST_LEADER_RETRY)
 
 
 # --- Main Execution Block ---
 if __name__ == "__main__":
-    mqtt_client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1) # Specify API version
+    lock = LeaderLock(INGEST_LOCK_PATH)
+    wait_for_leadership(lock)
+    print(f"Process {os.getpid()} is the ingest leader ({lock.path})")
+
+    # Ensure the database tables exist and are on the current schema
+    Base.metadata.create_all(bind=engine)
+    run_migrations(engine)
+    print("Database tables 'larvae_data' and 'image_files' ensured to exist.")
+
+    ingest_writer.start()
+    mqtt_consumer.start()
+    image_consumer.start()
+    mqtt_client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2) # Specify API version
     mqtt_client.on_connect = on_connect
     mqtt_client.on_message = on_message
 
     try:
         mqtt_client.connect(MQTT_BROKER, MQTT_PORT, 60)
         mqtt_client.loop_forever() # Blocks and handles reconnections
+    except KeyboardInterrupt:
+        pass
     except Exception as e:
         print(f"Failed to connect to MQTT broker or loop error: {e}")
     finally:
-        print("MQTT subscriber stopped.")
\ No newline at end of file
+        mqtt_consumer.stop() # Hands the messages still queued to the writer
+        image_consumer.stop()
+        ingest_writer.stop() # Flushes the readings still queued
+        print(f"MQTT subscriber stopped. {ingest_writer.stats()} {mqtt_router.stats()}")
+        lock.release()
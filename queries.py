@@ -0,0 +1,302 @@
+"""
+Read queries for the dashboard endpoints.
+
+The endpoints chart one point per day, so they read the day-resolution rollup
+table (see rollups.py) rather than the raw larvae_data history. Grouping and
+averaging happen inside SQLite, so each endpoint issues a fixed number of
+queries whose cost depends on the number of days shown, not on the number of
+readings. Weight histograms with caller-chosen edges and quantile sketches are
+grouped over the weight cell rollup (larvae_weight_cells), returning one row
+per tray and bin; only a time window with caller-chosen edges reads raw rows.
+Every function takes something with an `execute` method (a Session
+or a Connection) plus the table it reads, so they work for every app variant.
+
+Delta reads take a cursor: the data version (highest larvae_data id, see
+rollups.data_version) a client last saw. Only rows with a larger id and rollup
+buckets stamped with a larger version have changed since.
+"""
+from datetime import date, datetime
+
+from sqlalchemy import Integer, cast, func, select
+
+from downsample import lttb_indices
+from histogram import Histogram, QuantileSketch, bin_labels, merge_histograms, sql_bin_index
+from rollups import ROLLUP_EDGES, WEIGHT_CELL_SIZE
+
+MAX_DELTA_READINGS = 1000
+
+
+def _bin_columns(table):
+    return [table.c[f"bin_{index}"] for index in range(len(ROLLUP_EDGES))]
+
+
+def _as_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return date.fromisoformat(str(value)[:10])
+
+
+def daily_rollups(connection, day_table, tray_number=None):
+    """Day buckets ordered by tray and then by day, optionally for a single tray."""
+    query = select(day_table).order_by(day_table.c.tray_number, day_table.c.bucket)
+    if tray_number is not None:
+        query = query.where(day_table.c.tray_number == tray_number)
+    return connection.execute(query).mappings().all()
+
+
+def tray_numbers_cte(table):
+    """
+    Recursive CTE ("trays") of the tray numbers present in `table`, found by
+    a skip scan: one lookup per tray on the index that leads with
+    tray_number, instead of a pass over every row. Ends with a NULL row.
+    """
+    inner = table.alias()
+    trays = select(func.min(table.c.tray_number).label("tray_number")).cte("trays", recursive=True)
+    following = select(func.min(inner.c.tray_number)).where(inner.c.tray_number > trays.c.tray_number)
+    return trays.union_all(select(following.scalar_subquery()).where(trays.c.tray_number.isnot(None)))
+
+
+def tray_numbers(connection, table):
+    """Sorted tray numbers present in `table` (see tray_numbers_cte)."""
+    trays = tray_numbers_cte(table)
+    return connection.execute(
+        select(trays.c.tray_number).where(trays.c.tray_number.isnot(None)).order_by(trays.c.tray_number)
+    ).scalars().all()
+
+
+def parse_cursor(args):
+    """Reads ?since=<cursor>. Returns None when absent; raises ValueError on bad input."""
+    if "since" not in args:
+        return None
+    try:
+        cursor = int(args["since"])
+    except ValueError:
+        raise ValueError("since must be an integer cursor")
+    if cursor < 0:
+        raise ValueError("since must not be negative")
+    return cursor
+
+
+def latest_growth_series(buckets, start_date=None):
+    """
+    Growth series holding the latest length and weight of each day, numbered from
+    day 1 on the first bucket (whose date is returned as startDate, so live
+    readings can be placed on the same axis). `buckets` are the day rollups of
+    one tray, in order. Pass `start_date` when they do not begin on day 1.
+    """
+    growth_data = {"days": [], "length": [], "weight": []}
+    if not buckets:
+        return growth_data
+    start_date = _as_date(start_date or buckets[0]["bucket"])
+    growth_data["startDate"] = start_date.isoformat()
+    for bucket in buckets:
+        growth_data["days"].append((_as_date(bucket["bucket"]) - start_date).days + 1)
+        growth_data["length"].append(round(bucket["last_length"], 1))
+        growth_data["weight"].append(round(bucket["last_weight"], 1))
+    return growth_data
+
+
+def tray_extent(connection, day_table, tray_number):
+    """(first bucket, latest reading timestamp) of a tray, or (None, None) without data."""
+    return connection.execute(
+        select(func.min(day_table.c.bucket), func.max(day_table.c.last_timestamp))
+        .where(day_table.c.tray_number == tray_number)
+    ).one()
+
+
+def tray_version(connection, day_table, tray_number):
+    """Data version that last changed a tray (0 when it has no data)."""
+    return connection.execute(
+        select(func.coalesce(func.max(day_table.c.version), 0)).where(day_table.c.tray_number == tray_number)
+    ).scalar()
+
+
+def tray_first_buckets(connection, day_table):
+    """First day bucket of every tray, as {tray_number: bucket}."""
+    return dict(connection.execute(
+        select(day_table.c.tray_number, func.min(day_table.c.bucket)).group_by(day_table.c.tray_number)
+    ).all())
+
+
+def changed_buckets(connection, table, since, tray_number=None):
+    """Buckets stamped with a version newer than `since`, ordered by tray and then bucket."""
+    query = select(table).where(table.c.version > since).order_by(table.c.tray_number, table.c.bucket)
+    if tray_number is not None:
+        query = query.where(table.c.tray_number == tray_number)
+    return connection.execute(query).mappings().all()
+
+
+def readings_since(connection, larvae, since, tray_number=None, limit=MAX_DELTA_READINGS):
+    """
+    Raw readings with an id above `since`, oldest first, at most `limit` of them.
+    Returns (readings, truncated); a truncated delta should be followed by a full reload.
+    """
+    query = select(larvae).where(larvae.c.id > since).order_by(larvae.c.id).limit(limit + 1)
+    if tray_number is not None:
+        query = query.where(larvae.c.tray_number == tray_number)
+    rows = connection.execute(query).mappings().all()
+    readings = [dict(row, timestamp=row["timestamp"].isoformat()) for row in rows[:limit]]
+    return readings, len(rows) > limit
+
+
+def rollup_range(connection, table, tray_number, start=None, end=None):
+    """
+    Buckets of one tray between `start` and `end` (either may be None), in time
+    order. Served by a range scan of the (tray_number, bucket) primary key.
+    """
+    query = select(table).where(table.c.tray_number == tray_number).order_by(table.c.bucket)
+    if start is not None:
+        query = query.where(table.c.bucket >= start)
+    if end is not None:
+        query = query.where(table.c.bucket <= end)
+    return connection.execute(query).mappings().all()
+
+
+def downsampled_growth_series(buckets, max_points):
+    """
+    Growth series over rollup buckets of any resolution, reduced to at most
+    `max_points` with LTTB (on the weight series; length follows the same points).
+    Each point carries its bucket timestamp and a fractional day number.
+    """
+    growth_data = {"days": [], "timestamps": [], "length": [], "weight": []}
+    if not buckets:
+        return growth_data
+    start = buckets[0]["bucket"]
+    xs = [(bucket["bucket"] - start).total_seconds() for bucket in buckets]
+    ys = [bucket["last_weight"] for bucket in buckets]
+    for index in lttb_indices(xs, ys, max_points):
+        bucket = buckets[index]
+        growth_data["days"].append(round(xs[index] / 86400 + 1, 2))
+        growth_data["timestamps"].append(bucket["bucket"].isoformat())
+        growth_data["length"].append(round(bucket["last_length"], 1))
+        growth_data["weight"].append(round(bucket["last_weight"], 1))
+    return growth_data
+
+
+def latest_metrics(bucket):
+    """Metric card values from the latest reading recorded in a rollup bucket."""
+    return {
+        "length": round(bucket["last_length"], 1),
+        "width": round(bucket["last_width"], 1),
+        "area": round(bucket["last_area"], 1),
+        "weight": round(bucket["last_weight"], 1),
+        "count": bucket["last_count"],
+    }
+
+
+def bucket_weight_distribution(buckets):
+    """Adds up the weight bin counts of a list of rollup buckets."""
+    counts = [0] * len(ROLLUP_EDGES)
+    for bucket in buckets:
+        for index in range(len(ROLLUP_EDGES)):
+            counts[index] += bucket[f"bin_{index}"]
+    return {"ranges": bin_labels(ROLLUP_EDGES), "counts": counts}
+
+
+def daily_averages(connection, day_table, since=None):
+    """
+    Average length and weight of all readings per calendar day across every
+    tray, numbered from day 1 on the earliest day that has data. With `since`,
+    only the days with a bucket changed after that cursor are returned.
+    """
+    n = func.sum(day_table.c.n)
+    query = select(
+        day_table.c.bucket,
+        func.sum(day_table.c.sum_length) / n,
+        func.sum(day_table.c.sum_weight) / n,
+    ).group_by(day_table.c.bucket).order_by(day_table.c.bucket)
+    if since is not None:
+        query = query.where(day_table.c.bucket.in_(select(day_table.c.bucket).where(day_table.c.version > since)))
+    rows = connection.execute(query).all()
+
+    growth_data = {"days": [], "length": [], "weight": []}
+    if not rows:
+        return growth_data
+    start_date = _as_date(rows[0][0] if since is None else
+                          connection.execute(select(func.min(day_table.c.bucket))).scalar())
+    growth_data["startDate"] = start_date.isoformat()
+    for bucket, length, weight in rows:
+        growth_data["days"].append((_as_date(bucket) - start_date).days + 1)
+        growth_data["length"].append(round(length, 1))
+        growth_data["weight"].append(round(weight, 1))
+    return growth_data
+
+
+def weight_distribution(connection, day_table, tray_number=None):
+    """Weight bin counts over every reading of every tray, or of one tray."""
+    query = select(*[func.coalesce(func.sum(column), 0) for column in _bin_columns(day_table)])
+    if tray_number is not None:
+        query = query.where(day_table.c.tray_number == tray_number)
+    counts = connection.execute(query).one()
+    return {"ranges": bin_labels(ROLLUP_EDGES), "counts": list(counts)}
+
+
+def custom_weight_distribution(connection, larvae, edges, *criteria):
+    """
+    Weight distribution over arbitrary `edges`, from the raw readings matching
+    `criteria` (a time window of one tray). Readings under the first edge are
+    reported as "below".
+    """
+    bin_index = sql_bin_index(larvae.c.weight, edges).label("bin")
+    histogram = Histogram(edges)
+    rows = connection.execute(
+        select(bin_index, func.count()).where(larvae.c.weight.isnot(None), *criteria).group_by(bin_index)
+    )
+    for index, count in rows:
+        if index < 0:
+            histogram.below += count
+        else:
+            histogram.counts[index] += count
+    return {"ranges": histogram.labels, "counts": histogram.counts, "below": histogram.below}
+
+
+def tray_weight_histograms(connection, cells, edges, trays=None):
+    """
+    Weight histogram of every tray (or of the trays listed in `trays`) over the
+    bins defined by `edges`, with one GROUP BY over the weight cell rollup.
+    Exact for edges on the WEIGHT_CELL_SIZE grid; other edges are resolved to
+    a cell. Returns {tray_number: Histogram}.
+    """
+    bin_index = sql_bin_index(cells.c.cell * WEIGHT_CELL_SIZE, edges).label("bin")
+    query = select(cells.c.tray_number, bin_index, func.sum(cells.c.n)).group_by(cells.c.tray_number, bin_index)
+    if trays is not None:
+        query = query.where(cells.c.tray_number.in_(trays))
+    histograms = {}
+    for tray_number, index, count in connection.execute(query):
+        histogram = histograms.setdefault(tray_number, Histogram(edges))
+        if index < 0:
+            histogram.below += count
+        else:
+            histogram.counts[index] += count
+    return histograms
+
+
+def cell_weight_distribution(connection, cells, edges, tray_number=None):
+    """
+    Weight distribution over arbitrary `edges` of every reading, or of one
+    tray's, from the weight cell rollup. Readings under the first edge are
+    reported as "below".
+    """
+    trays = None if tray_number is None else [tray_number]
+    merged = merge_histograms(tray_weight_histograms(connection, cells, edges, trays).values(), edges)
+    return {"ranges": merged.labels, "counts": merged.counts, "below": merged.below}
+
+
+def tray_weight_sketches(connection, cells, resolution=1.0, trays=None):
+    """
+    Mergeable quantile sketch of the weights of every tray (or of the trays
+    listed in `trays`), regrouping the weight cell rollup into cells of
+    `resolution` mg (a resolution finer than WEIGHT_CELL_SIZE is no more
+    precise than that). Returns {tray_number: QuantileSketch}.
+    """
+    # CAST truncates toward zero, which equals floor() for the non-negative weights we store
+    cell = cast(cells.c.cell * WEIGHT_CELL_SIZE / resolution, Integer).label("cell")
+    query = select(cells.c.tray_number, cell, func.sum(cells.c.n)).group_by(cells.c.tray_number, cell)
+    if trays is not None:
+        query = query.where(cells.c.tray_number.in_(trays))
+    sketches = {}
+    for tray_number, cell_number, count in connection.execute(query):
+        sketches.setdefault(tray_number, QuantileSketch(resolution)).add_cell(cell_number, count)
+    return sketches
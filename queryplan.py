@@ -0,0 +1,112 @@
+"""
+EXPLAIN QUERY PLAN check for the dashboard endpoints.
+
+check_query_plans() requests each endpoint through the Flask test client,
+records every SELECT it sends to SQLite and asks SQLite how it would run each
+one. A plan step that reads a whole table, directly or by walking an entire
+index, is reported as a full scan unless the probe exempts that table (only
+rollup tables read by the fleet-wide views are). The apps expose it as `flask --app <app> check-query-plans`, which exits with
+status 1 when an unexpected full scan is found.
+"""
+import re
+from contextlib import contextmanager
+
+from sqlalchemy import event, inspect
+from werkzeug.exceptions import HTTPException
+
+# SQLite reports a step that reads a whole table as "SCAN <table>" (optionally "AS
+# <alias>"), also when it walks an index in full ("... USING [COVERING] INDEX <name>");
+# lookups and range reads are "SEARCH" steps
+FULL_SCAN = re.compile(r"^SCAN (\w+)\b")
+
+# (path, tables the endpoint may scan in full). {tray} is replaced by a tray that has data.
+# larvae_data is never exempt. The fleet-wide views may read a rollup table in full, as its
+# size grows with the trays and days (or weight cells) stored, not with the readings.
+ENDPOINT_PROBES = [
+    ("/get_tray_data/{tray}", set()),
+    ("/get_tray_data/{tray}?edges=60,80,100,120", set()),
+    ("/get_tray_data/{tray}?from=2000-01-01&to=2100-01-01&max_points=100", set()),
+    ("/get_tray_data/{tray}?from=2000-01-01&edges=60,80,100,120", set()),
+    ("/get_tray_data/{tray}?since=0", set()),
+    ("/api/images/{tray}", set()),
+    ("/dashboard", set()),
+    # Average per day over every tray: sums all day buckets
+    ("/get_combined_tray_data", {"larvae_rollup_day"}),
+    # ...and the histogram of every tray over custom edges: sums all weight cells
+    ("/get_combined_tray_data?edges=60,80,100,120", {"larvae_rollup_day", "larvae_weight_cells"}),
+    # Changed days are found by bucket version, which is not indexed; a delta reads few rows
+    # anyway, and indexing version would cost every ingest batch an extra index update per bucket
+    ("/get_combined_tray_data?since=0", {"larvae_rollup_day"}),
+    # Growth series, histogram and quantiles of every tray: all day buckets and weight cells
+    ("/get_comparison_data", {"larvae_rollup_day", "larvae_weight_cells"}),
+    # Changed days by bucket version, as for the combined delta
+    ("/get_comparison_data?since=0", {"larvae_rollup_day"}),
+    # The gallery of every tray lists every picture
+    ("/api/images/all", {"image_files"}),
+    ("/api/snapshot/verify", set()),
+]
+
+
+@contextmanager
+def captured_selects(engine):
+    """Collects (statement, parameters) of every SELECT run on `engine` inside the block."""
+    statements = []
+
+    def record(connection, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith(("SELECT", "WITH")):
+            statements.append((statement, parameters))
+
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+
+
+def full_scans(connection, statement, parameters, tables):
+    """Tables from `tables` that SQLite would scan in full to run `statement`."""
+    plan = connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters).all()
+    scanned = []
+    for row in plan:
+        match = FULL_SCAN.match(row[-1])
+        if match and match.group(1) in tables:
+            scanned.append(match.group(1))
+    return scanned
+
+
+def _route_exists(app, path):
+    try:
+        app.url_map.bind("localhost").match(path.split("?")[0])
+    except HTTPException:
+        return False
+    return True
+
+
+def check_query_plans(app, engine, tray_number):
+    """
+    Runs every probe that `app` has a route for and returns a list of problems,
+    one {"path", "table", "sql"} dict per unexpected full scan.
+    """
+    tables = set(inspect(engine).get_table_names())
+    client = app.test_client()
+    login_disabled = app.config.get("LOGIN_DISABLED")
+    app.config["LOGIN_DISABLED"] = True
+
+    problems = []
+    try:
+        for template, allowed in ENDPOINT_PROBES:
+            path = template.format(tray=tray_number)
+            if not _route_exists(app, path):
+                continue
+            with captured_selects(engine) as statements:
+                response = client.get(path)
+            print(f"{response.status_code} {path}: {len(statements)} queries")
+
+            with engine.connect() as connection:
+                for statement, parameters in statements:
+                    for table in full_scans(connection, statement, parameters, tables):
+                        if table not in allowed:
+                            problems.append({"path": path, "table": table, "sql": " ".join(statement.split())})
+    finally:
+        app.config["LOGIN_DISABLED"] = login_disabled
+    return problems
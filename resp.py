@@ -0,0 +1,229 @@
+"""
+Minimal Redis protocol (RESP2) client and a local stand-in server.
+
+The shared cache only needs a handful of commands, so instead of adding a
+Redis client dependency this module speaks the protocol itself. The
+stand-in server implements the same commands in memory; it lets the Redis
+cache backend be exercised (see cache_backends.py) without a Redis
+installation, and is not meant for production use.
+"""
+import socket
+import socketserver
+import threading
+import time
+from urllib.parse import urlparse
+
+
+class RespError(Exception):
+    """Error reply from the server, or a malformed reply."""
+
+
+def encode_command(*args):
+    """Encodes a command as a RESP array of bulk strings."""
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        if not isinstance(arg, bytes):
+            arg = str(arg).encode()
+        parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+    return b"".join(parts)
+
+
+def read_reply(stream):
+    """Reads one RESP reply from a buffered binary stream."""
+    line = stream.readline()
+    if not line.endswith(b"\r\n"):
+        raise ConnectionError("connection closed by server")
+    kind, payload = line[:1], line[1:-2]
+    if kind == b"+":
+        return payload.decode()
+    if kind == b"-":
+        raise RespError(payload.decode())
+    if kind == b":":
+        return int(payload)
+    if kind == b"$":
+        length = int(payload)
+        if length < 0:
+            return None
+        data = stream.read(length + 2)
+        if len(data) != length + 2:
+            raise ConnectionError("connection closed by server")
+        return data[:-2]
+    if kind == b"*":
+        length = int(payload)
+        return None if length < 0 else [read_reply(stream) for _ in range(length)]
+    raise RespError(f"unexpected reply type {kind!r}")
+
+
+def parse_url(url):
+    """(host, port, db) of a redis://host:port/db URL."""
+    parsed = urlparse(url)
+    if parsed.scheme != "redis":
+        raise ValueError(f"not a redis:// URL: {url}")
+    db = int(parsed.path.lstrip("/") or 0)
+    return parsed.hostname or "localhost", parsed.port or 6379, db
+
+
+class RespClient:
+    """One connection per thread to a Redis-protocol server, reconnecting after errors."""
+
+    def __init__(self, url="redis://localhost:6379/0", timeout=2.0):
+        self.host, self.port, self.db = parse_url(url)
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        stream = sock.makefile("rb")
+        self._local.sock, self._local.stream = sock, stream
+        if self.db:
+            self._send(b"SELECT", self.db)
+
+    def _send(self, *args):
+        self._local.sock.sendall(encode_command(*args))
+        return read_reply(self._local.stream)
+
+    def execute(self, *args):
+        """Runs one command and returns its reply. Error replies raise RespError."""
+        if getattr(self._local, "sock", None) is None:
+            self._connect()
+        try:
+            return self._send(*args)
+        except (OSError, ConnectionError):
+            self.close()
+            raise
+
+    def close(self):
+        sock = getattr(self._local, "sock", None)
+        if sock is not None:
+            self._local.stream.close()
+            sock.close()
+            self._local.sock = self._local.stream = None
+
+
+class _StandInHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        while True:
+            try:
+                command = read_reply(self.rfile)
+            except (ConnectionError, RespError, ValueError):
+                return
+            if not isinstance(command, list) or not command:
+                self.wfile.write(b"-ERR expected a command array\r\n")
+                continue
+            name = command[0].decode().upper()
+            if name == "QUIT":
+                self.wfile.write(b"+OK\r\n")
+                return
+            try:
+                reply = self.server.store.run(name, command[1:])
+            except RespError as e:
+                self.wfile.write(b"-ERR %s\r\n" % str(e).encode())
+                continue
+            self.wfile.write(_encode_reply(reply))
+
+
+def _encode_reply(reply):
+    if reply is None:
+        return b"$-1\r\n"
+    if isinstance(reply, bool):
+        return b"+OK\r\n"
+    if isinstance(reply, int):
+        return b":%d\r\n" % reply
+    if isinstance(reply, list):
+        return b"*%d\r\n" % len(reply) + b"".join(_encode_reply(item) for item in reply)
+    if isinstance(reply, str):
+        return b"+%s\r\n" % reply.encode()
+    return b"$%d\r\n%s\r\n" % (len(reply), reply)
+
+
+class _StandInStore:
+    """Keys, values and expiry times of the stand-in server (a single database)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+        self._expires = {}
+
+    def _live(self, key):
+        expires = self._expires.get(key)
+        if expires is not None and expires <= time.monotonic():
+            self._values.pop(key, None)
+            self._expires.pop(key, None)
+        return key in self._values
+
+    def run(self, name, args):
+        with self._lock:
+            if name == "PING":
+                return "PONG"
+            if name == "SELECT":
+                return True
+            if name == "GET":
+                return self._values[args[0]] if self._live(args[0]) else None
+            if name == "SET":
+                return self._set(args)
+            if name == "DEL":
+                removed = sum(1 for key in args if self._live(key))
+                for key in args:
+                    self._values.pop(key, None)
+                    self._expires.pop(key, None)
+                return removed
+            if name == "EXISTS":
+                return sum(1 for key in args if self._live(key))
+            if name == "DBSIZE":
+                return sum(1 for key in list(self._values) if self._live(key))
+            if name == "FLUSHDB":
+                self._values.clear()
+                self._expires.clear()
+                return True
+        raise RespError(f"unknown command '{name}'")
+
+    def _set(self, args):
+        key, value, options = args[0], args[1], [arg.upper() for arg in args[2:]]
+        expires = None
+        if options[:1] == [b"PX"]:
+            expires = time.monotonic() + int(options[1]) / 1000
+        elif options[:1] == [b"EX"]:
+            expires = time.monotonic() + int(options[1])
+        elif options:
+            raise RespError("syntax error")
+        self._values[key] = value
+        self._expires.pop(key, None)
+        if expires is not None:
+            self._expires[key] = expires
+        return True
+
+
+class StandInServer(socketserver.ThreadingTCPServer):
+    """
+    In-memory server for PING, SELECT, GET, SET (with EX/PX), DEL, EXISTS,
+    DBSIZE, FLUSHDB and QUIT. Binds to a free local port unless one is given.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host="127.0.0.1", port=0):
+        super().__init__((host, port), _StandInHandler)
+        self.store = _StandInStore()
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"redis://{host}:{port}/0"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name="resp-stand-in", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == "__main__":
+    # Serve the stand-in on the default port, e.g. for CACHE_URL=redis://127.0.0.1:6379/0
+    server = StandInServer(port=6379)
+    print(f"RESP stand-in server listening on {server.url}")
+    server.serve_forever()
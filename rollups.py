@@ -0,0 +1,238 @@
+"""
+Multi-resolution rollups of larvae readings.
+
+Every reading is folded into per-tray buckets at minute, hour and day
+resolution as it is ingested, so the read endpoints can chart a time span by
+scanning a number of buckets proportional to that span instead of every raw
+reading. Each bucket keeps the reading count, per-metric sum/min/max, the
+latest values and the weight-distribution bin counts.
+
+Weight histograms over other edges and quantile sketches are served from a
+fourth table, larvae_weight_cells, counting each tray's readings per weight
+cell of WEIGHT_CELL_SIZE mg. A histogram built from it is exact for edges on
+that grid (every integer and half mg, for instance).
+
+Every bucket also records the data version that last changed it: the highest
+larvae_data id at the time. Ids only grow, so "buckets with version > cursor"
+are exactly the buckets changed since a client last read id `cursor`.
+
+The tables are defined on whatever MetaData the caller owns, so the Flask apps
+and the standalone subscriber all maintain the same schema.
+"""
+import math
+
+from sqlalchemy import Column, DateTime, Float, Integer, Table, case, delete, func, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from histogram import DEFAULT_WEIGHT_EDGES, bin_index
+
+RESOLUTIONS = ("minute", "hour", "day") # Finest to coarsest
+BUCKET_SECONDS = {"minute": 60, "hour": 3600, "day": 86400}
+METRICS = ("length", "width", "area", "weight")
+ROLLUP_EDGES = DEFAULT_WEIGHT_EDGES # bin_<i> columns count readings per bin over these edges
+BIN_COLUMNS = [f"bin_{index}" for index in range(len(ROLLUP_EDGES))]
+WEIGHT_CELL_SIZE = 0.125 # mg; a power of two, so weight / WEIGHT_CELL_SIZE is exact in floating point
+REBUILD_CHUNK_SIZE = 5000
+
+
+def _complete_readings(larvae):
+    """Criteria excluding legacy rows with missing values, which cannot be rolled up."""
+    return [larvae.c[name].isnot(None) for name in ("tray_number", "count", "timestamp") + METRICS]
+
+
+def define_rollup_tables(metadata):
+    """
+    Declares larvae_rollup_<resolution> tables on `metadata`, keyed by
+    resolution name, and the larvae_weight_cells table, keyed "weights".
+    """
+    tables = {}
+    for resolution in RESOLUTIONS:
+        columns = [
+            Column("tray_number", Integer, primary_key=True),
+            Column("bucket", DateTime, primary_key=True),
+            Column("n", Integer, nullable=False),
+        ]
+        for metric in METRICS:
+            columns += [
+                Column(f"sum_{metric}", Float, nullable=False),
+                Column(f"min_{metric}", Float, nullable=False),
+                Column(f"max_{metric}", Float, nullable=False),
+                Column(f"last_{metric}", Float, nullable=False),
+            ]
+        columns += [
+            Column("sum_count", Integer, nullable=False),
+            Column("last_count", Integer, nullable=False),
+            Column("last_timestamp", DateTime, nullable=False),
+        ]
+        columns += [Column(name, Integer, nullable=False, default=0) for name in BIN_COLUMNS]
+        columns.append(Column("version", Integer, nullable=False, default=0))
+        tables[resolution] = Table(f"larvae_rollup_{resolution}", metadata, *columns)
+    tables["weights"] = Table(
+        "larvae_weight_cells", metadata,
+        Column("tray_number", Integer, primary_key=True),
+        Column("cell", Integer, primary_key=True), # Weights in [cell, cell + 1) * WEIGHT_CELL_SIZE
+        Column("n", Integer, nullable=False),
+    )
+    return tables
+
+
+def choose_resolution(span_seconds, max_points, oversample=4):
+    """
+    Coarsest rollup that still resolves a span of `span_seconds` into enough
+    points: the finest resolution whose bucket count stays within
+    `max_points * oversample` (the surplus gives LTTB something to choose
+    from), or day resolution when even that is too many.
+    """
+    for resolution in RESOLUTIONS:
+        if span_seconds / BUCKET_SECONDS[resolution] <= max_points * oversample:
+            return resolution
+    return RESOLUTIONS[-1]
+
+
+def bucket_start(timestamp, resolution):
+    """Truncates a timestamp to the start of its bucket at `resolution`."""
+    if resolution == "minute":
+        return timestamp.replace(second=0, microsecond=0)
+    if resolution == "hour":
+        return timestamp.replace(minute=0, second=0, microsecond=0)
+    return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def weight_bin_index(weight):
+    """
+    Rollup bin column of a weight. Weights under the first edge are folded into
+    the open last bin, as the dashboard's distribution chart has always counted them.
+    """
+    index = bin_index(weight, ROLLUP_EDGES)
+    return index if index >= 0 else len(ROLLUP_EDGES) - 1
+
+
+def weight_cell(weight):
+    """Number of the larvae_weight_cells cell a weight falls in."""
+    return math.floor(weight / WEIGHT_CELL_SIZE)
+
+
+def data_version(connection, larvae):
+    """Current data version: the highest larvae_data id (0 for an empty table)."""
+    return connection.execute(select(func.coalesce(func.max(larvae.c.id), 0))).scalar()
+
+
+def _fold(deltas, key, row, version):
+    delta = deltas.get(key)
+    if delta is None:
+        delta = {"tray_number": key[0], "bucket": key[1], "n": 0, "sum_count": 0, "version": version}
+        for metric in METRICS:
+            delta[f"sum_{metric}"] = 0.0
+            delta[f"min_{metric}"] = row[metric]
+            delta[f"max_{metric}"] = row[metric]
+        for name in BIN_COLUMNS:
+            delta[name] = 0
+        delta["last_timestamp"] = row["timestamp"]
+        deltas[key] = delta
+
+    delta["n"] += 1
+    delta["sum_count"] += row["count"]
+    for metric in METRICS:
+        value = row[metric]
+        delta[f"sum_{metric}"] += value
+        if value < delta[f"min_{metric}"]:
+            delta[f"min_{metric}"] = value
+        if value > delta[f"max_{metric}"]:
+            delta[f"max_{metric}"] = value
+    delta[BIN_COLUMNS[weight_bin_index(row["weight"])]] += 1
+    delta["version"] = max(delta["version"], row.get("id") or 0)
+
+    # Ties go to the reading applied last, matching "latest entry" ordering by id
+    if row["timestamp"] >= delta["last_timestamp"]:
+        delta["last_timestamp"] = row["timestamp"]
+        delta["last_count"] = row["count"]
+        for metric in METRICS:
+            delta[f"last_{metric}"] = row[metric]
+
+
+def _upsert_statement(table):
+    stmt = sqlite_insert(table)
+    excluded = stmt.excluded
+    newer = excluded.last_timestamp >= table.c.last_timestamp
+    update = {
+        "n": table.c.n + excluded.n,
+        "sum_count": table.c.sum_count + excluded.sum_count,
+        "last_count": case((newer, excluded.last_count), else_=table.c.last_count),
+        "last_timestamp": case((newer, excluded.last_timestamp), else_=table.c.last_timestamp),
+        "version": func.max(table.c.version, excluded.version),
+    }
+    for metric in METRICS:
+        update[f"sum_{metric}"] = table.c[f"sum_{metric}"] + excluded[f"sum_{metric}"]
+        update[f"min_{metric}"] = func.min(table.c[f"min_{metric}"], excluded[f"min_{metric}"])
+        update[f"max_{metric}"] = func.max(table.c[f"max_{metric}"], excluded[f"max_{metric}"])
+        update[f"last_{metric}"] = case((newer, excluded[f"last_{metric}"]), else_=table.c[f"last_{metric}"])
+    for name in BIN_COLUMNS:
+        update[name] = table.c[name] + excluded[name]
+    return stmt.on_conflict_do_update(index_elements=[table.c.tray_number, table.c.bucket], set_=update)
+
+
+def _cell_upsert_statement(table):
+    stmt = sqlite_insert(table)
+    return stmt.on_conflict_do_update(index_elements=[table.c.tray_number, table.c.cell],
+                                      set_={"n": table.c.n + stmt.excluded.n})
+
+
+def apply_readings(connection, tables, rows, version=0):
+    """
+    Folds larvae_data rows (dicts with the reading fields and a datetime
+    timestamp) into every rollup table. Rows are pre-aggregated per bucket so a
+    batch costs one upsert per touched bucket (and weight cell). Touched buckets
+    are stamped with `version` (see data_version), or with the rows' own ids
+    when they carry one. Runs in the caller's transaction.
+    """
+    if not rows:
+        return
+    for resolution in RESOLUTIONS:
+        deltas = {}
+        for row in rows:
+            _fold(deltas, (row["tray_number"], bucket_start(row["timestamp"], resolution)), row, version)
+        connection.execute(_upsert_statement(tables[resolution]), list(deltas.values()))
+    cells = {}
+    for row in rows:
+        key = (row["tray_number"], weight_cell(row["weight"]))
+        cells[key] = cells.get(key, 0) + 1
+    connection.execute(_cell_upsert_statement(tables["weights"]),
+                       [{"tray_number": tray, "cell": cell, "n": n} for (tray, cell), n in cells.items()])
+
+
+def rebuild_rollups(connection, larvae, tables, chunk_size=REBUILD_CHUNK_SIZE):
+    """Recomputes every rollup table from the raw larvae_data table, in id order."""
+    for table in tables.values():
+        connection.execute(delete(table))
+    columns = [larvae.c.id, larvae.c.tray_number, larvae.c.count, larvae.c.timestamp]
+    columns += [larvae.c[metric] for metric in METRICS]
+    last_id = 0
+    while True:
+        chunk = connection.execute(
+            select(*columns)
+            .where(larvae.c.id > last_id, *_complete_readings(larvae))
+            .order_by(larvae.c.id)
+            .limit(chunk_size)
+        ).mappings().all()
+        if not chunk:
+            break
+        apply_readings(connection, tables, chunk)
+        last_id = chunk[-1]["id"]
+
+
+def ensure_rollups(connection, larvae, tables):
+    """
+    Rebuilds the rollups when they do not account for every raw reading, e.g. on
+    the first start after upgrading (or after larvae_weight_cells was added) or
+    after rows were written by an older process. Returns True if a rebuild happened.
+    """
+    raw_rows = connection.execute(
+        select(func.count()).select_from(larvae).where(*_complete_readings(larvae))
+    ).scalar()
+    rolled_up = connection.execute(select(func.coalesce(func.sum(tables["day"].c.n), 0))).scalar()
+    in_cells = connection.execute(select(func.coalesce(func.sum(tables["weights"].c.n), 0))).scalar()
+    if raw_rows == rolled_up == in_cells:
+        return False
+    print(f"Rebuilding rollups ({rolled_up} of {raw_rows} readings accounted for, {in_cells} in weight cells)...")
+    rebuild_rollups(connection, larvae, tables)
+    return True
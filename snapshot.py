@@ -0,0 +1,142 @@
+"""
+Process-wide snapshot of the latest reading of every tray.
+
+The metric cards only ever show the newest reading per tray, so instead of
+asking SQLite for it on every request the app keeps it in memory: the map is
+warmed from the database at startup and updated after every successful insert.
+
+Warming queries larvae_data, so with several gunicorn workers it is done once:
+the first worker stores the map in the shared cache backend under the data
+version it was read at, and the others load it from there.
+"""
+import json
+import threading
+from datetime import datetime
+
+from sqlalchemy import select
+
+from queries import tray_numbers_cte
+from rollups import data_version
+
+SNAPSHOT_FIELDS = ("length", "width", "area", "weight", "count", "timestamp")
+
+
+def latest_readings_query(larvae):
+    """
+    Select returning the newest larvae_data row of every tray, with one
+    lookup per tray on the (tray_number, timestamp) index.
+    """
+    trays = tray_numbers_cte(larvae)
+    newest = larvae.alias("newest")
+    newest_id = select(newest.c.id).where(
+        newest.c.tray_number == trays.c.tray_number, newest.c.timestamp.isnot(None)
+    ).order_by(newest.c.timestamp.desc(), newest.c.id.desc()).limit(1).scalar_subquery()
+    return select(larvae.c.tray_number, *[larvae.c[field] for field in SNAPSHOT_FIELDS])\
+        .select_from(trays).join(larvae, larvae.c.id == newest_id)
+
+
+def card_metrics(entry):
+    """Rounds a snapshot entry into the metric card format used by the dashboard."""
+    return {
+        "length": round(entry["length"], 1),
+        "width": round(entry["width"], 1),
+        "area": round(entry["area"], 1),
+        "weight": round(entry["weight"], 1),
+        "count": entry["count"],
+    }
+
+
+class TraySnapshot:
+    """Thread-safe map of tray_number -> latest reading."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latest = {}
+
+    def __len__(self):
+        return len(self._latest)
+
+    def warm(self, connection, larvae, shared=None):
+        """
+        Replaces the snapshot with the latest rows currently in the database.
+        With a `shared` cache backend, a snapshot another process already read
+        at the same data version is loaded from it instead.
+        """
+        key = f"snapshot:{data_version(connection, larvae)}" if shared is not None else None
+        stored = shared.get(key) if key else None
+        if stored is not None:
+            latest = {int(tray): dict(entry, timestamp=datetime.fromisoformat(entry["timestamp"]))
+                      for tray, entry in json.loads(stored).items()}
+        else:
+            latest = {}
+            for row in connection.execute(latest_readings_query(larvae)).mappings():
+                latest[row["tray_number"]] = {field: row[field] for field in SNAPSHOT_FIELDS}
+            if key:
+                shared.set(key, json.dumps({tray: _serializable(entry) for tray, entry in latest.items()}).encode())
+        with self._lock:
+            self._latest = latest
+        return len(latest)
+
+    def update(self, rows):
+        """
+        Records newly stored readings. A reading only replaces the current entry
+        for its tray if it is at least as recent, so out-of-order arrivals are safe.
+        """
+        with self._lock:
+            for row in rows:
+                current = self._latest.get(row["tray_number"])
+                if current is None or row["timestamp"] >= current["timestamp"]:
+                    self._latest[row["tray_number"]] = {field: row[field] for field in SNAPSHOT_FIELDS}
+
+    def get(self, tray_number):
+        """Latest reading of a tray, or None if the tray has no data."""
+        with self._lock:
+            entry = self._latest.get(tray_number)
+            return dict(entry) if entry else None
+
+    def entries(self):
+        """Copy of the whole map, sorted by tray number."""
+        with self._lock:
+            return {tray: dict(entry) for tray, entry in sorted(self._latest.items())}
+
+    def combined_metrics(self):
+        """
+        Averages the latest length/width/area/weight across trays and sums their
+        counts. Returns None when no tray has data.
+        """
+        entries = list(self.entries().values())
+        if not entries:
+            return None
+        combined = {
+            metric: round(sum(entry[metric] for entry in entries) / len(entries), 1)
+            for metric in ("length", "width", "area", "weight")
+        }
+        combined["count"] = sum(entry["count"] for entry in entries)
+        return combined
+
+    def verify(self, connection, larvae):
+        """
+        Compares the snapshot with the latest rows in the database and returns a
+        list of mismatches (an empty list means the snapshot is consistent).
+        """
+        database = {}
+        for row in connection.execute(latest_readings_query(larvae)).mappings():
+            database[row["tray_number"]] = {field: row[field] for field in SNAPSHOT_FIELDS}
+        cached = self.entries()
+
+        mismatches = []
+        for tray in sorted(set(database) | set(cached)):
+            in_db, in_memory = database.get(tray), cached.get(tray)
+            if in_db != in_memory:
+                mismatches.append({
+                    "tray_number": tray,
+                    "snapshot": _serializable(in_memory),
+                    "database": _serializable(in_db),
+                })
+        return mismatches
+
+
+def _serializable(entry):
+    if entry is None:
+        return None
+    return dict(entry, timestamp=entry["timestamp"].isoformat())
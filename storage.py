@@ -0,0 +1,85 @@
+"""
+SQLite storage profile shared by every process that opens the database.
+
+The web apps and the standalone MQTT subscriber must agree on two things: which
+file they open and how SQLite is configured for it. The file is DATABASE_PATH
+(an absolute path, so the working directory no longer matters). Every new
+connection is configured through a connect-event hook:
+
+  * journal_mode=WAL lets readers keep reading while a writer commits, and
+    lets the subscriber and the web app write without failing on each other
+  * synchronous=NORMAL is durable against application crashes in WAL mode and
+    avoids an fsync on every commit
+  * cache_size, mmap_size and temp_store keep hot pages, the memory-mapped file
+    and sort/temp b-trees in memory
+  * busy_timeout makes a connection wait for a lock instead of failing at once
+
+Read-only engines open the file with mode=ro and set query_only, so dashboard
+queries cannot take the write lock by accident. Every setting can be overridden
+with the environment variable of the same name.
+"""
+import os
+
+from sqlalchemy import create_engine, event
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DATABASE_PATH = os.path.abspath(os.environ.get(
+    "DATABASE_PATH", os.path.join(BASE_DIR, "instance", "larvae_monitoring.db")))
+
+SQLITE_SYNCHRONOUS = os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_CACHE_SIZE_KB = int(os.environ.get("SQLITE_CACHE_SIZE_KB", 65536))
+SQLITE_MMAP_SIZE = int(os.environ.get("SQLITE_MMAP_SIZE", 256 * 1024 * 1024))
+SQLITE_TEMP_STORE = os.environ.get("SQLITE_TEMP_STORE", "MEMORY")
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", 5000))
+
+
+def database_url(path=DATABASE_PATH, read_only=False):
+    """SQLAlchemy URL for the database file, creating its directory if needed."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if read_only:
+        return f"sqlite:///file:{path}?mode=ro&uri=true"
+    return f"sqlite:///{path}"
+
+
+DATABASE_URL = database_url()
+
+
+def connection_pragmas(read_only=False):
+    """PRAGMA statements run on every new connection, in order."""
+    pragmas = [] if read_only else ["PRAGMA journal_mode=WAL"] # Persistent; only a writer may set it
+    pragmas += [
+        f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}",
+        f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}", # Negative means KiB rather than pages
+        f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}",
+        f"PRAGMA temp_store={SQLITE_TEMP_STORE}",
+        f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}",
+    ]
+    if read_only:
+        pragmas.append("PRAGMA query_only=ON")
+    return pragmas
+
+
+def configure_engine(engine, read_only=False):
+    """Registers the connect hook that applies the storage profile to `engine`."""
+    pragmas = connection_pragmas(read_only)
+
+    @event.listens_for(engine, "connect")
+    def apply_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+
+    return engine
+
+
+def engine_options():
+    """Options for SQLALCHEMY_ENGINE_OPTIONS so Flask-SQLAlchemy's engine matches the profile."""
+    return {"connect_args": {"check_same_thread": False, "timeout": SQLITE_BUSY_TIMEOUT_MS / 1000}}
+
+
+def create_storage_engine(path=DATABASE_PATH, read_only=False, **kwargs):
+    """Engine for the database file with the storage profile applied."""
+    options = engine_options()
+    options.update(kwargs)
+    return configure_engine(create_engine(database_url(path, read_only), **options), read_only)
@@ -0,0 +1,141 @@
+"""
+MQTT topic hierarchy and routing.
+
+Devices publish on bsf_monitor/<site>/<tray>/<kind>, where kind is:
+
+    metrics    one reading, as JSON, struct or MessagePack (see codec.py)
+    image      a reading with its picture in one of those formats, or a bare JPEG
+    heartbeat  a liveness ping; the payload is not read
+
+One wildcard subscription covers every site and tray. TopicRouter sends each
+kind to its own target: metrics and images go to separate consumer pools
+(see consumer.py), each with its own bounded queue, so a burst of large
+pictures never sits in front of the small metric readings. Heartbeats are
+only counted. The legacy topic (bsf_monitor/larvae_data and its format
+subtopics) keeps working and is routed as metrics.
+"""
+import threading
+import time
+from collections import namedtuple
+
+from codec import decode_message, format_for_topic, sniff_format
+
+TOPIC_ROOT = "bsf_monitor"
+TOPIC_KINDS = ("metrics", "image", "heartbeat")
+JPEG_MAGIC = b"\xff\xd8\xff"
+
+Topic = namedtuple("Topic", "site tray kind")
+
+
+def parse_topic(topic, root=TOPIC_ROOT):
+    """Splits <root>/<site>/<tray>/<kind> into a Topic, or returns None for any other topic."""
+    parts = topic.split("/")
+    if len(parts) != 4 or parts[0] != root or parts[3] not in TOPIC_KINDS:
+        return None
+    try:
+        tray = int(parts[2])
+    except ValueError:
+        return None
+    return Topic(parts[1], tray, parts[3])
+
+
+def decode_routed(topic, payload, legacy_topic, received_at=None):
+    """
+    Decodes a metrics or image message from either topic scheme into (row,
+    attachments) as codec.decode_message does. On the hierarchy the format is
+    recognised from the payload and the tray number in the topic must match
+    the reading's. A bare JPEG on an image topic gives row None.
+    """
+    fmt = format_for_topic(topic, legacy_topic)
+    if fmt is not None:
+        return decode_message(payload, fmt, received_at)
+    parsed = parse_topic(topic)
+    if parsed is None:
+        raise ValueError(f"unexpected topic {topic}")
+    if parsed.kind == "image" and payload[:3] == JPEG_MAGIC:
+        return None, {"image": bytes(payload), "bounding_boxes": None, "masks": None}
+    return decode_message(payload, sniff_format(payload), received_at, tray_number=parsed.tray)
+
+
+class TopicRouter:
+    """
+    Routing table from message kind to target. A target is called as
+    target(topic, payload, key) with the tray number as bytes for `key` (None
+    on the legacy topic) and returns whether it accepted the message, like
+    ShardedConsumer.submit.
+    """
+
+    def __init__(self, legacy_topic=None, root=TOPIC_ROOT):
+        self.legacy_topic = legacy_topic
+        self.root = root
+        self.routes = {}
+        self._lock = threading.Lock()
+        self._stats = {"unrouted": 0}
+
+    def route(self, kind, target):
+        if kind not in TOPIC_KINDS:
+            raise ValueError(f"unknown message kind '{kind}'")
+        self.routes[kind] = target
+        self._stats.setdefault(kind, 0)
+        self._stats.setdefault(f"{kind}_dropped", 0)
+        return self
+
+    def subscriptions(self, qos=0):
+        """(topic filter, qos) pairs covering the hierarchy and the legacy topic."""
+        topics = [(f"{self.root}/+/+/+", qos)]
+        if self.legacy_topic:
+            topics += [(self.legacy_topic, qos), (f"{self.legacy_topic}/+", qos)]
+        return topics
+
+    def dispatch(self, topic, payload):
+        """Hands a message to the target of its kind. Returns False if none took it."""
+        kind, key = None, None
+        if self.legacy_topic and format_for_topic(topic, self.legacy_topic):
+            kind = "metrics"
+        else:
+            parsed = parse_topic(topic, self.root)
+            if parsed is not None:
+                kind, key = parsed.kind, str(parsed.tray).encode()
+        target = self.routes.get(kind)
+        if target is None:
+            self._count("unrouted")
+            return False
+        accepted = target(topic, payload, key)
+        self._count(kind if accepted else f"{kind}_dropped")
+        return accepted
+
+    def _count(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+
+class DeviceHeartbeats:
+    """Last heartbeat seen from each site and tray; a TopicRouter target."""
+
+    def __init__(self, root=TOPIC_ROOT):
+        self.root = root
+        self._lock = threading.Lock()
+        self._devices = {}
+
+    def submit(self, topic, payload, key=None):
+        parsed = parse_topic(topic, self.root)
+        if parsed is None:
+            return False
+        with self._lock:
+            device = self._devices.setdefault((parsed.site, parsed.tray), {"heartbeats": 0})
+            device["heartbeats"] += 1
+            device["last_seen"] = time.time()
+        return True
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            return [
+                {"site": site, "tray": tray, "heartbeats": device["heartbeats"],
+                 "seconds_since": round(now - device["last_seen"], 1)}
+                for (site, tray), device in sorted(self._devices.items())
+            ]
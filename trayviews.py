@@ -0,0 +1,274 @@
+"""
+Response bodies of the tray data endpoints, shared by app.py and BSFwebdashboard.py.
+
+TrayViews builds what /get_tray_data, /get_combined_tray_data and
+/get_comparison_data return, in full or as a delta after a cursor (see
+queries.py), from an app's rollup tables, its larvae_data table and its
+latest-reading snapshot. The routes only parse their arguments, open a read
+connection and turn the result into a response: NoData becomes a 404.
+"""
+from collections import defaultdict
+from datetime import datetime
+
+from histogram import Histogram, QuantileSketch, parse_bin_edges
+from downsample import parse_series_range
+from queries import (bucket_weight_distribution, cell_weight_distribution, changed_buckets,
+                     custom_weight_distribution, daily_averages, daily_rollups, downsampled_growth_series,
+                     latest_growth_series, latest_metrics, parse_cursor, readings_since, rollup_range,
+                     tray_extent, tray_first_buckets, tray_version, tray_weight_histograms,
+                     tray_weight_sketches, weight_distribution)
+from rollups import ROLLUP_EDGES, bucket_start, choose_resolution, data_version
+from snapshot import card_metrics
+
+
+class NoData(LookupError):
+    """There is nothing stored to answer the request with."""
+
+
+def parse_tray_args(args):
+    """(edges, series range, cursor) of a get_tray_data request. Raises ValueError on bad input."""
+    edges = parse_bin_edges(args, default=ROLLUP_EDGES)
+    series_range = parse_series_range(args)
+    since = parse_cursor(args)
+    if since is not None and series_range is not None:
+        raise ValueError("since cannot be combined with from, to or max_points")
+    return edges, series_range, since
+
+
+def parse_combined_args(args):
+    """(edges, cursor) of a get_combined_tray_data request. Raises ValueError on bad input."""
+    return parse_bin_edges(args, default=ROLLUP_EDGES), parse_cursor(args)
+
+
+def parse_comparison_args(args):
+    """(edges, quantile resolution, cursor) of a get_comparison_data request. Raises ValueError on bad input."""
+    edges = parse_bin_edges(args)
+    resolution = float(args.get('quantile_resolution', 1.0))
+    if not resolution > 0:
+        raise ValueError("quantile_resolution must be positive")
+    return edges, resolution, parse_cursor(args)
+
+
+def unchanged_delta(since, cursor):
+    """Answer for a client that is already up to date."""
+    return {"cursor": cursor, "since": since, "changed": False}
+
+
+class TrayViews:
+    """Builds the tray endpoint bodies from `rollups` (see define_rollup_tables), `larvae` and `snapshot`."""
+
+    def __init__(self, rollups, larvae, snapshot):
+        self.rollups = rollups
+        self.larvae = larvae
+        self.snapshot = snapshot
+
+    def tray_data(self, connection, tray_number, edges, series_range=None, since=None):
+        """
+        Metrics, growth series and weight distribution of one tray; the series
+        covers `series_range` (start, end, max_points) when given. A cursor
+        `since` that is not newer than the data gets a delta instead.
+        """
+        # Read the cursor first, so anything committed afterwards is newer than it
+        cursor = data_version(connection, self.larvae)
+        if since is not None and since <= cursor:
+            return self.tray_data_delta(connection, tray_number, since, cursor, edges)
+
+        time_criteria = []
+        if series_range is None:
+            # One row per day for this tray, read from the day rollup
+            buckets = daily_rollups(connection, self.rollups["day"], tray_number)
+            if not buckets:
+                raise NoData(f"No data found for tray {tray_number}")
+            growth_data = latest_growth_series(buckets)
+        else:
+            start, end, max_points = series_range
+            first_bucket, last_reading = tray_extent(connection, self.rollups["day"], tray_number)
+            if first_bucket is None:
+                raise NoData(f"No data found for tray {tray_number}")
+
+            # Pick the rollup resolution from the span shown, then range-scan just that window
+            span = (end or last_reading) - (start or first_bucket)
+            resolution = choose_resolution(max(span.total_seconds(), 0), max_points)
+            buckets = rollup_range(connection, self.rollups[resolution], tray_number,
+                                   bucket_start(start, resolution) if start else None, end)
+            growth_data = downsampled_growth_series(buckets, max_points)
+            growth_data["resolution"] = resolution
+            if start:
+                time_criteria.append(self.larvae.c.timestamp >= start)
+            if end:
+                time_criteria.append(self.larvae.c.timestamp <= end)
+
+        # Growth data is the latest entry per day; metrics come from the in-memory snapshot,
+        # falling back to the last rollup bucket for trays written by another process
+        latest_entry = self.snapshot.get(tray_number)
+        if latest_entry:
+            metrics, latest_timestamp = card_metrics(latest_entry), latest_entry["timestamp"]
+        elif buckets:
+            metrics, latest_timestamp = latest_metrics(buckets[-1]), buckets[-1]["last_timestamp"]
+        else:
+            metrics = {"length": 0, "width": 0, "area": 0, "weight": 0, "count": 0}
+            latest_timestamp = datetime.utcnow()
+
+        # Default bins are already counted in the rollups and other edges in the weight cells;
+        # only a time window with other edges is binned from its raw readings
+        if edges == ROLLUP_EDGES:
+            weight_distribution_data = bucket_weight_distribution(buckets)
+        elif time_criteria:
+            weight_distribution_data = custom_weight_distribution(
+                connection, self.larvae, edges, self.larvae.c.tray_number == tray_number, *time_criteria)
+        else:
+            weight_distribution_data = cell_weight_distribution(connection, self.rollups["weights"], edges, tray_number)
+
+        return {
+            "metrics": metrics,
+            "growthData": growth_data,
+            "weightDistribution": weight_distribution_data,
+            "timestamp": latest_timestamp.isoformat(),
+            "cursor": cursor
+        }
+
+    def tray_data_delta(self, connection, tray_number, since, cursor, edges):
+        """The day buckets, raw readings and current totals of a tray that changed after cursor `since`."""
+        day_rollup = self.rollups["day"]
+        if tray_version(connection, day_rollup, tray_number) <= since:
+            return unchanged_delta(since, cursor)
+
+        buckets = changed_buckets(connection, day_rollup, since, tray_number)
+        first_bucket, _ = tray_extent(connection, day_rollup, tray_number)
+        readings, truncated = readings_since(connection, self.larvae, since, tray_number)
+        latest_entry = self.snapshot.get(tray_number)
+        if edges == ROLLUP_EDGES:
+            distribution = weight_distribution(connection, day_rollup, tray_number)
+        else:
+            distribution = cell_weight_distribution(connection, self.rollups["weights"], edges, tray_number)
+        return {
+            "cursor": cursor,
+            "since": since,
+            "changed": True,
+            "metrics": card_metrics(latest_entry) if latest_entry else latest_metrics(buckets[-1]),
+            "growthData": latest_growth_series(buckets, first_bucket),
+            "weightDistribution": distribution,
+            "readings": readings,
+            "readingsTruncated": truncated,
+            "timestamp": datetime.utcnow().isoformat()
+        }
+
+    def combined_data(self, connection, edges, since=None):
+        """Latest metrics averaged over every tray, the average per day and the weight distribution of every reading."""
+        cursor = data_version(connection, self.larvae)
+        if since is not None and since <= cursor:
+            return self.combined_data_delta(connection, since, cursor, edges)
+
+        day_rollup = self.rollups["day"]
+
+        # Latest reading of every tray, averaged (summed for count), straight from memory
+        combined_metrics = self.snapshot.combined_metrics()
+        if combined_metrics is None:
+            raise NoData("No tray data available")
+
+        # Average per day across all trays, and the weight distribution of every reading
+        growth_data = daily_averages(connection, day_rollup)
+        if edges == ROLLUP_EDGES:
+            weight_distribution_data = weight_distribution(connection, day_rollup)
+        else:
+            weight_distribution_data = cell_weight_distribution(connection, self.rollups["weights"], edges)
+
+        return {
+            "metrics": combined_metrics,
+            "growthData": growth_data,
+            "weightDistribution": weight_distribution_data,
+            "timestamp": datetime.utcnow().isoformat(),
+            "cursor": cursor
+        }
+
+    def combined_data_delta(self, connection, since, cursor, edges):
+        """Combined view changes after cursor `since`: changed days, new readings and current totals."""
+        if cursor <= since:
+            return unchanged_delta(since, cursor)
+
+        day_rollup = self.rollups["day"]
+        readings, truncated = readings_since(connection, self.larvae, since)
+        if edges == ROLLUP_EDGES:
+            distribution = weight_distribution(connection, day_rollup)
+        else:
+            distribution = cell_weight_distribution(connection, self.rollups["weights"], edges)
+        return {
+            "cursor": cursor,
+            "since": since,
+            "changed": True,
+            "metrics": self.snapshot.combined_metrics(),
+            "growthData": daily_averages(connection, day_rollup, since),
+            "weightDistribution": distribution,
+            "readings": readings,
+            "readingsTruncated": truncated,
+            "timestamp": datetime.utcnow().isoformat()
+        }
+
+    def comparison_data(self, connection, edges, resolution=1.0, since=None):
+        """
+        Latest metrics, growth series and weight histogram with quantiles of
+        every tray, plus the quantiles over all of them.
+        """
+        cursor = data_version(connection, self.larvae)
+        if since is not None and since <= cursor:
+            return self.comparison_data_delta(connection, since, cursor, edges, resolution)
+
+        trays_data_for_comparison = {}
+
+        # Day rollups of every tray, grouped per tray (ordered by tray, then day)
+        buckets_by_tray = defaultdict(list)
+        for bucket in daily_rollups(connection, self.rollups["day"]):
+            buckets_by_tray[bucket["tray_number"]].append(bucket)
+
+        # Weight histograms and quantile sketches of every tray, binned from the weight cell rollup
+        histograms = tray_weight_histograms(connection, self.rollups["weights"], edges)
+        sketches = tray_weight_sketches(connection, self.rollups["weights"], resolution)
+        all_trays_sketch = QuantileSketch(resolution)
+
+        for tray_num, buckets in buckets_by_tray.items():
+            latest_entry = self.snapshot.get(tray_num)
+            histogram = histograms.get(tray_num) or Histogram(edges)
+            sketch = sketches.get(tray_num, QuantileSketch(resolution))
+            all_trays_sketch.merge(sketch)
+            trays_data_for_comparison[str(tray_num)] = {
+                'latest': card_metrics(latest_entry) if latest_entry else latest_metrics(buckets[-1]),
+                'growthData': latest_growth_series(buckets),
+                # Edges, labels, counts and the readings under the first edge ("below", not charted)
+                'weightHistogram': dict(histogram.as_dict(), quantiles=sketch.summary())
+            }
+
+        return {
+            'trays': trays_data_for_comparison,
+            'weightQuantiles': all_trays_sketch.summary(),
+            'timestamp': datetime.utcnow().isoformat(),
+            'cursor': cursor
+        }
+
+    def comparison_data_delta(self, connection, since, cursor, edges, resolution):
+        """
+        Comparison entries of the trays changed after cursor `since`, holding only
+        their changed days. The fleet-wide weightQuantiles are left to full reloads.
+        """
+        if cursor <= since:
+            return unchanged_delta(since, cursor)
+
+        buckets_by_tray = defaultdict(list)
+        for bucket in changed_buckets(connection, self.rollups["day"], since):
+            buckets_by_tray[bucket["tray_number"]].append(bucket)
+        first_buckets = tray_first_buckets(connection, self.rollups["day"])
+
+        histograms = tray_weight_histograms(connection, self.rollups["weights"], edges, list(buckets_by_tray))
+        sketches = tray_weight_sketches(connection, self.rollups["weights"], resolution, list(buckets_by_tray))
+
+        trays = {}
+        for tray_num, buckets in buckets_by_tray.items():
+            latest_entry = self.snapshot.get(tray_num)
+            histogram = histograms.get(tray_num) or Histogram(edges)
+            sketch = sketches.get(tray_num, QuantileSketch(resolution))
+            trays[str(tray_num)] = {
+                'latest': card_metrics(latest_entry) if latest_entry else latest_metrics(buckets[-1]),
+                'growthData': latest_growth_series(buckets, first_buckets[tray_num]),
+                'weightHistogram': dict(histogram.as_dict(), quantiles=sketch.summary())
+            }
+        return {"cursor": cursor, "since": since, "changed": True, "trays": trays,
+                "timestamp": datetime.utcnow().isoformat()}
@@ -0,0 +1,232 @@
+"""
+Streaming image uploads.
+
+An upload is copied from the request in fixed-size chunks into a temporary
+file inside the image store, then moved into place by the store (see
+imagestore.py), so memory use per upload does not grow with the image and
+readers never see a half-written file. The temporary name starts with a dot and ends in
+".part"; leftovers from a crash can be deleted at any time. Multipart bodies
+are parsed here as they arrive rather than by Werkzeug's form parser, which
+would first spool the picture to the system temporary directory, so the
+picture is written to disk once.
+
+Uploaded JPEGs are checked from their headers and stored as sent: decoding
+and re-encoding them would cost far more CPU than the upload itself and
+lose quality every time.
+"""
+import json
+import os
+import tempfile
+
+from PIL import Image, UnidentifiedImageError
+from werkzeug.sansio.multipart import Data, Epilogue, Field, File, MultipartDecoder, NeedData
+
+UPLOAD_CHUNK_SIZE = 64 * 1024
+JPEG_END = b"\xff\xd9"
+DEFAULT_MAX_UPLOAD_BYTES = 32 * 1024 * 1024
+MAX_FIELD_BYTES = 4 * 1024 * 1024 # All form fields of one multipart upload together
+# Bodies taken as the picture itself, with the metadata in the query string
+RAW_IMAGE_MIMETYPES = {"image/jpeg", "image/png", "image/webp", "application/octet-stream"}
+# Metadata fields and their types; tray_number is required
+UPLOAD_FIELDS = (
+    ("tray_number", int),
+    ("count", int),
+    ("avg_length", float),
+    ("avg_weight", float),
+)
+
+
+class UploadTooLarge(ValueError):
+    """The body is bigger than the configured limit."""
+
+
+def spool_to_disk(stream, directory, max_bytes=DEFAULT_MAX_UPLOAD_BYTES, chunk_size=UPLOAD_CHUNK_SIZE):
+    """
+    Copies a readable stream into a temporary file in `directory`, chunk by
+    chunk. Returns (path, size). The file is removed again if the copy fails
+    or the stream exceeds `max_bytes`.
+    """
+    os.makedirs(directory, exist_ok=True)
+    fd, path = tempfile.mkstemp(dir=directory, prefix=".upload-", suffix=".part")
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as f:
+            while True:
+                chunk = stream.read(chunk_size)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if max_bytes is not None and size > max_bytes:
+                    raise UploadTooLarge(f"upload is larger than {max_bytes} bytes")
+                f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+    except BaseException:
+        discard(path)
+        raise
+    return path, size
+
+
+def spool_multipart(stream, boundary, directory, file_field="image", check_fields=None,
+                    max_bytes=DEFAULT_MAX_UPLOAD_BYTES, chunk_size=UPLOAD_CHUNK_SIZE):
+    """
+    Parses a multipart/form-data body as it is read from `stream`. Form
+    fields are collected in memory; the `file_field` part is written straight
+    to a temporary file in `directory` and other file parts are skipped. When
+    the file part starts, check_fields(fields) is called with the fields
+    received so far, so metadata sent ahead of the picture is rejected before
+    the picture is read. Returns (fields, path), path None when there was no
+    file part. Raises ValueError on a malformed body and UploadTooLarge past
+    `max_bytes` of picture or MAX_FIELD_BYTES of fields.
+    """
+    decoder = MultipartDecoder(boundary.encode("latin-1"), max_form_memory_size=MAX_FIELD_BYTES)
+    fields = {}
+    path = target = part = None
+    field_bytes = size = 0
+    value = []
+    try:
+        while True:
+            chunk = stream.read(chunk_size)
+            decoder.receive_data(chunk or None) # None marks the end of the body
+            event = decoder.next_event()
+            while not isinstance(event, (Epilogue, NeedData)):
+                if isinstance(event, Field):
+                    part, value = event, []
+                elif isinstance(event, File):
+                    part = event
+                    if event.name == file_field and path is None:
+                        if check_fields is not None:
+                            check_fields(fields)
+                        os.makedirs(directory, exist_ok=True)
+                        fd, path = tempfile.mkstemp(dir=directory, prefix=".upload-", suffix=".part")
+                        target = os.fdopen(fd, "wb")
+                elif isinstance(event, Data):
+                    if isinstance(part, Field):
+                        field_bytes += len(event.data)
+                        if field_bytes > MAX_FIELD_BYTES:
+                            raise UploadTooLarge(f"form fields are larger than {MAX_FIELD_BYTES} bytes")
+                        value.append(event.data)
+                        if not event.more_data:
+                            fields.setdefault(part.name, b"".join(value).decode("utf-8", "replace"))
+                    elif target is not None and part.name == file_field:
+                        size += len(event.data)
+                        if max_bytes is not None and size > max_bytes:
+                            raise UploadTooLarge(f"upload is larger than {max_bytes} bytes")
+                        target.write(event.data)
+                        if not event.more_data:
+                            target.flush()
+                            os.fsync(target.fileno())
+                            target.close()
+                            target = None
+                event = decoder.next_event()
+            if isinstance(event, Epilogue):
+                break
+            if not chunk:
+                raise ValueError("Incomplete multipart body")
+        if target is not None:
+            raise ValueError("Incomplete multipart body")
+    except BaseException:
+        if target is not None:
+            target.close()
+        discard(path)
+        raise
+    return fields, path
+
+
+def store_image(temp_path, store):
+    """
+    Puts the picture in `temp_path` into `store` (an imagestore.ImageStore) as
+    a JPEG. A valid JPEG is stored byte for byte; anything else Pillow can
+    read is transcoded first. `temp_path` is gone afterwards. Returns (key,
+    format received, width, height). Raises ValueError if it is not a usable
+    image.
+    """
+    encoded = None
+    try:
+        image_format, width, height = check_image(temp_path)
+        if image_format != "JPEG":
+            with Image.open(temp_path) as img:
+                if img.mode not in ("RGB", "L", "CMYK"):
+                    img = img.convert("RGB") # JPEG has no alpha or palette
+                fd, encoded = tempfile.mkstemp(dir=os.path.dirname(temp_path) or ".", prefix=".upload-",
+                                               suffix=".part")
+                with os.fdopen(fd, "wb") as f:
+                    img.save(f, "JPEG")
+            discard(temp_path)
+            temp_path, encoded = encoded, None
+        key = store.put_file(temp_path, ".jpg")
+        temp_path = None
+        return key, image_format, width, height
+    finally:
+        discard(encoded)
+        discard(temp_path)
+
+
+def check_image(path):
+    """
+    Checks a picture without decoding its pixels: Image.open only parses the
+    header (format, dimensions, mode) and verify() checks what the format
+    allows (chunk CRCs for PNG; nothing for JPEG, so its end-of-image marker
+    is checked here to catch truncated uploads). Returns (format, width, height).
+    """
+    try:
+        with Image.open(path) as img:
+            image_format = img.format
+            width, height = img.size
+            img.verify()
+    except UnidentifiedImageError:
+        raise ValueError("Not a recognised image format")
+    except Image.DecompressionBombError:
+        raise ValueError("Image dimensions are too large")
+    except (OSError, SyntaxError) as e: # What verify() raises for corrupt data
+        raise ValueError(f"Corrupt image: {e}")
+    if not width or not height:
+        raise ValueError("Image has no pixels")
+    if image_format == "JPEG":
+        with open(path, "rb") as f:
+            f.seek(-2, os.SEEK_END)
+            if f.read(2) != JPEG_END:
+                raise ValueError("Truncated JPEG image")
+    return image_format, width, height
+
+
+def discard(path):
+    """Removes a temporary file, if there is one."""
+    if path:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def upload_metadata(fields):
+    """
+    Validates the metadata sent with a picture (form fields, query string or
+    JSON object) into an image_files row. bounding_boxes and masks are kept
+    as JSON strings. Raises ValueError naming the bad field.
+    """
+    row = {}
+    for name, kind in UPLOAD_FIELDS:
+        value = fields.get(name)
+        if value in (None, ""):
+            row[name] = None
+            continue
+        try:
+            row[name] = kind(value)
+        except (TypeError, ValueError):
+            raise ValueError(f"{name} must be a number")
+    if row["tray_number"] is None:
+        raise ValueError("Missing tray number")
+    for name in ("bounding_boxes", "masks"):
+        value = fields.get(name)
+        if value in (None, ""):
+            row[name] = None
+        elif isinstance(value, str):
+            try:
+                json.loads(value)
+            except ValueError:
+                raise ValueError(f"{name} must be JSON")
+            row[name] = value
+        else:
+            row[name] = json.dumps(value)
+    return row